@@ -0,0 +1,245 @@
+"""
+Контроль допуска: ограничение параллельных тяжелых запросов по классу эндпоинта и роли.
+
+Годовой отчет или Гант на большом заводе держит поток из пула и соединение с БД.
+Несколько таких запросов не должны вытеснять операторские завершения задач, поэтому
+тяжелые эндпоинты проходят через лимиты:
+- общий лимит класса ("heavy") — на все роли вместе;
+- лимит класса для конкретной роли ("heavy/technologist").
+Запрос сначала занимает слот роли, затем общий. При занятых слотах он ждет в очереди
+не дольше max_wait секунд. Если очередь полна, сразу возвращается 429. Если слот не
+освободился за max_wait, возвращается 503. Оба ответа идут с Retry-After.
+
+Лимиты настраиваются переменной ADMISSION_LIMITS, элементы через ";":
+    "<класс>[/<роль>]=<параллельно>:<очередь>:<ожидание, с>"
+    например "heavy=4:8:10;heavy/technologist=2:4:10;write/operator=16:64:5"
+Отсутствующий в настройке ключ не ограничен.
+
+Роль определяется по JWT до открытия сессии БД эндпоинта: ожидающий в очереди запрос
+не держит соединение из пула. Запрос без токена ограничивается только общим лимитом класса.
+
+Роль пользователя кэшируется на ROLE_CACHE_SECONDS в каждом воркере. Эндпоинтов смены
+роли нет (роли меняются в БД напрямую), поэтому события на шине для этого нет: новая роль
+применяется к лимитам не позже чем через ROLE_CACHE_SECONDS. Событие RESYNC шины
+инвалидации сбрасывает кэш сразу.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from jose import JWTError, jwt
+from starlette.concurrency import run_in_threadpool
+
+import auth
+import database
+import invalidation
+import models
+from metrics import format_labels
+
+HEAVY = "heavy"  # Отчеты, Гант, аналитика, импорт
+WRITE = "write"  # Операторские и диспетчерские записи
+
+DEFAULT_LIMITS = f"{HEAVY}=4:8:10;{HEAVY}/{models.UserRole.TECHNOLOGIST.value}=2:4:10"
+ROLE_CACHE_SECONDS = 60.0
+
+
+@dataclass(frozen=True)
+class Limit:
+    concurrency: int
+    queue: int
+    max_wait: float
+
+
+def parse_limits(spec: str) -> Dict[Tuple[str, Optional[str]], Limit]:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        key, _, values = item.partition("=")
+        endpoint_class, _, role = key.strip().partition("/")
+        concurrency, queue, max_wait = values.split(":")
+        limits[(endpoint_class, role or None)] = Limit(int(concurrency), int(queue), float(max_wait))
+    return limits
+
+
+LIMITS = parse_limits(os.getenv("ADMISSION_LIMITS", DEFAULT_LIMITS))
+
+
+class _Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop, future):
+        self.loop = loop
+        self.future = future
+        self.granted = False  # Слот передан этому ожидающему при release()
+
+
+def _wake(waiter: _Waiter):
+    if not waiter.future.done():
+        waiter.future.set_result(None)
+
+
+class Limiter:
+    """
+    Счетчик слотов с ограниченной FIFO-очередью. Состояние под threading.Lock,
+    ожидающие — future своего цикла событий, поэтому лимитер не привязан к конкретному циклу.
+    """
+
+    def __init__(self, name: str, limit: Limit):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.rejected = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _reject(self, status_code: int, detail: str):
+        self.rejected += 1
+        retry_after = max(1, round(self.limit.max_wait))
+        raise HTTPException(status_code=status_code, detail=detail, headers={"Retry-After": str(retry_after)})
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.active < self.limit.concurrency:
+                self.active += 1
+                return
+            if len(self._waiters) >= self.limit.queue:
+                queue_full = True
+            else:
+                queue_full = False
+                waiter = _Waiter(loop, loop.create_future())
+                self._waiters.append(waiter)
+        if queue_full:
+            self._reject(429, f"Too many concurrent requests ({self.name}), retry later")
+
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.limit.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                if waiter.granted:  # Слот успели передать одновременно с таймаутом — он наш
+                    if isinstance(e, asyncio.CancelledError):
+                        self._release_locked()
+                        raise
+                    return
+                self._waiters.remove(waiter)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject(503, f"Server is busy ({self.name}), retry later")
+
+    def _release_locked(self):
+        if self._waiters:
+            # Слот переходит первому в очереди, счетчик active не меняется
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            waiter.loop.call_soon_threadsafe(_wake, waiter)
+        else:
+            self.active -= 1
+
+    def release(self):
+        with self._lock:
+            self._release_locked()
+
+
+_limiters: Dict[Tuple[str, Optional[str]], Limiter] = {
+    key: Limiter(f"{key[0]}/{key[1]}" if key[1] else key[0], limit) for key, limit in LIMITS.items()
+}
+
+
+# --- РОЛЬ ИЗ ТОКЕНА ---
+
+_role_cache: Dict[Tuple[int, str], Tuple[Optional[str], float]] = {}
+_role_cache_lock = threading.Lock()
+
+
+def _load_role(plant_id: int, username: str) -> Optional[str]:
+    db = database.plant_session(plant_id)
+    try:
+        user = db.query(models.User).filter(models.User.username == username).first()
+        return user.role.value if user is not None and user.role is not None else None
+    finally:
+        db.close()
+
+
+async def _role_of(request: Request) -> Optional[str]:
+    """Роль по JWT; неверный токен — None (ошибку авторизации вернет сам эндпоинт)."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        payload = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM])
+    except JWTError:
+        return None
+    username = payload.get("sub")
+    if username is None:
+        return None
+    key = (payload.get("plant") or database.DEFAULT_PLANT_ID, username)
+
+    now = time.monotonic()
+    with _role_cache_lock:
+        cached = _role_cache.get(key)
+    if cached is not None and now - cached[1] < ROLE_CACHE_SECONDS:
+        return cached[0]
+    role = await run_in_threadpool(_load_role, *key)
+    with _role_cache_lock:
+        _role_cache[key] = (role, now)
+    return role
+
+
+def _clear_role_cache(event: invalidation.InvalidationEvent):
+    with _role_cache_lock:
+        _role_cache.clear()
+
+
+invalidation.subscribe(invalidation.EventKind.RESYNC, _clear_role_cache)
+
+
+# --- ЗАВИСИМОСТЬ ---
+
+class Admit:
+    """
+    Зависимость FastAPI для параметра dependencies декоратора (выполняется раньше остальных):
+        @app.get("/gantt", dependencies=[Depends(admission.Admit(admission.HEAVY))])
+    """
+
+    def __init__(self, endpoint_class: str):
+        self.endpoint_class = endpoint_class
+
+    async def __call__(self, request: Request):
+        role = await _role_of(request)
+        limiters = [
+            limiter for limiter in (_limiters.get((self.endpoint_class, role)) if role else None,
+                                    _limiters.get((self.endpoint_class, None)))
+            if limiter is not None
+        ]
+        acquired: List[Limiter] = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire()
+                acquired.append(limiter)
+            yield
+        finally:
+            for limiter in reversed(acquired):
+                limiter.release()
+
+
+def render() -> str:
+    """Метрики лимитов в формате Prometheus (дополняет metrics.render)."""
+    lines = []
+    for name, help_text, metric_type, attribute in (
+            ("admission_active", "Запросы, занявшие слот", "gauge", "active"),
+            ("admission_waiting", "Запросы в очереди допуска", "gauge", "waiting"),
+            ("admission_rejected_total", "Отказы (429/503) по лимитам", "counter", "rejected"),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for limiter in _limiters.values():
+            lines.append(f"{name}{format_labels(limiter=limiter.name)} {getattr(limiter, attribute)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,146 @@
+"""
+Архивация завершенных заказов.
+
+Заказы в статусе COMPLETED, по которым ничего не происходило дольше ARCHIVE_AFTER_DAYS,
+переносятся вместе с задачами в orders_archive / production_tasks_archive. Горячие таблицы
+остаются небольшими: списки, Гант и очереди не сканируют историю.
+
+Перенос идет пачками по ARCHIVE_BATCH_SIZE заказов, каждая пачка — отдельная транзакция
+(INSERT ... SELECT в архив, затем DELETE). Кандидаты выбираются с FOR UPDATE SKIP LOCKED,
+поэтому фоновые потоки нескольких воркеров не мешают друг другу. Фоновый перенос идет
+по заводам, каждый — в сессии своего завода (и своей БД, если завод вынесен в шард).
+Отчеты (reports.py, rollups.rebuild) читают архив сами, когда он попадает в период.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timedelta, UTC
+from typing import List, Optional
+
+from sqlalchemy import insert, literal, select
+from sqlalchemy.orm import Session
+
+import database
+import invalidation
+import models
+import plants
+import sync
+from invalidation import EventKind, InvalidationEvent
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))  # 0 — фоновый перенос выключен
+ARCHIVE_BATCH_PAUSE = 0.5  # Пауза между пачками, чтобы не держать таблицы под нагрузкой подряд
+
+
+def _copy(db: Session, source, target, where, archived_at: Optional[datetime] = None):
+    """INSERT INTO target SELECT ... FROM source WHERE ... по одноименным колонкам."""
+    target_table, source_table = target.__table__, source.__table__
+    names = [column.name for column in target_table.columns if column.name in source_table.columns]
+    columns = [source_table.c[name] for name in names]
+    if archived_at is not None:
+        names.append("archived_at")
+        columns.append(literal(archived_at, target_table.c.archived_at.type))
+    db.execute(insert(target_table).from_select(names, select(*columns).where(where)))
+
+
+def select_candidates(db: Session, cutoff: datetime, limit: int) -> List[int]:
+    """id завершенных заказов, начатых и законченных (по последней задаче) раньше cutoff."""
+    rows = db.query(models.ProductionOrder.id).filter(
+        models.ProductionOrder.status == models.OrderStatus.COMPLETED,
+        models.ProductionOrder.start_date < cutoff,
+        ~models.ProductionOrder.tasks.any(models.ProductionTask.end_time_actual >= cutoff),
+    ).order_by(models.ProductionOrder.id).limit(limit).with_for_update(
+        skip_locked=True, of=models.ProductionOrder
+    ).all()
+    return [row.id for row in rows]
+
+
+def archive_batch(db: Session, cutoff: datetime, limit: int = ARCHIVE_BATCH_SIZE) -> List[int]:
+    """Переносит одну пачку заказов в архив и коммитит. Возвращает id перенесенных заказов."""
+    order_ids = select_candidates(db, cutoff, limit)
+    if not order_ids:
+        db.rollback()
+        return []
+
+    task_ids = [row.id for row in db.query(models.ProductionTask.id).filter(
+        models.ProductionTask.order_id.in_(order_ids)
+    )]
+    # Для терминалов перенос в архив — удаление (sync.py)
+    sync.mark_deleted(db, "tasks", task_ids)
+    sync.mark_deleted(db, "orders", order_ids)
+
+    now = datetime.now(UTC)
+    _copy(db, models.ProductionOrder, models.ArchivedOrder, models.ProductionOrder.id.in_(order_ids), now)
+    _copy(db, models.ProductionTask, models.ArchivedTask, models.ProductionTask.order_id.in_(order_ids))
+
+    db.query(models.ProductionTask).filter(
+        models.ProductionTask.order_id.in_(order_ids)
+    ).delete(synchronize_session=False)
+    db.query(models.ProductionOrder).filter(
+        models.ProductionOrder.id.in_(order_ids)
+    ).delete(synchronize_session=False)
+    db.commit()
+
+    invalidation.publish(InvalidationEvent(EventKind.ORDER_CHANGED, order_ids, plant_id=plants.plant_of(db)))
+    return order_ids
+
+
+def run(db: Session, older_than_days: int = ARCHIVE_AFTER_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE,
+        stop_event: Optional[threading.Event] = None) -> int:
+    """Переносит пачками все подходящие заказы. Возвращает число перенесенных заказов."""
+    cutoff = datetime.now(UTC) - timedelta(days=older_than_days)
+    total = 0
+    while stop_event is None or not stop_event.is_set():
+        moved = archive_batch(db, cutoff, batch_size)
+        total += len(moved)
+        if len(moved) < batch_size:
+            break
+        if stop_event is not None:
+            stop_event.wait(ARCHIVE_BATCH_PAUSE)
+    return total
+
+
+# --- ФОНОВЫЙ ПЕРЕНОС ---
+
+_stopped = threading.Event()
+_thread: Optional[threading.Thread] = None
+
+
+def _run_all():
+    for plant_id in plants.plant_ids():
+        with database.plant_session(plant_id) as db:
+            moved = run(db, stop_event=_stopped)
+            if moved:
+                logger.info("Archived %d completed orders of plant %s", moved, plant_id)
+    for bind in database.all_engines():
+        with database.SessionLocal(bind=bind) as db:
+            sync.purge_tombstones(db)
+
+
+def _loop():
+    while not _stopped.is_set():
+        try:
+            _run_all()
+        except Exception:
+            logger.exception("Order archival failed")
+        _stopped.wait(ARCHIVE_INTERVAL_SECONDS)
+
+
+def start():
+    global _thread
+    if ARCHIVE_INTERVAL_SECONDS <= 0 or _thread is not None:
+        return
+    _stopped.clear()
+    _thread = threading.Thread(target=_loop, daemon=True, name="order-archiver")
+    _thread.start()
+
+
+def stop():
+    global _thread
+    _stopped.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+        _thread = None
@@ -0,0 +1,428 @@
+"""
+Обещание срока (available-to-promise) для нового заказа без записи в БД.
+
+Проектное расписание — тот же прогноз, что в deadlines.py, но с учетом мощности цехов:
+у этапа (цеха) capacity параллельных линий; открытые заказы занимают линии в порядке
+поступления (по id), этапы заказа идут последовательно, начатый этап занимает линию
+до своего окончания по норме. Новый заказ встает в конец очереди каждого цеха — прежние
+обещания он не сдвигает, поэтому котировка — жадная вставка за O(число этапов).
+
+Мощность цеха — число операторов, выполнявших этап за ATP_HISTORY_DAYS дней
+(StageCycleRollup), но не меньше 1; ATP_STAGE_CAPACITY переопределяет: "Литье=2;Окраска=1".
+
+Материалы: доступно = остаток - потребность невыполненных этапов открытых заказов
+(как в /analytics/inventory-check). Если заказу не хватает, этап, которому нужен материал,
+начнется не раньше поставки — через ATP_MATERIAL_LEAD_DAYS дней. Полуфабрикаты делаются
+своими заказами и в котировку не входят.
+
+Состояние (работа открытых заказов, линии цехов, резерв материалов) держится в памяти
+по заводу. События шины инвалидации помечают измененные заказы, задачи и материалы; перед
+котировкой перечитываются только они. Новый заказ дописывается в конец линий, прочие
+изменения пересобирают расписание из памяти без запросов к БД. Полная перезагрузка —
+при смене техкарт и раз в ATP_REFRESH_SECONDS (фактический ход работ расходится с нормой).
+"""
+import heapq
+import os
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import distinct, func
+from sqlalchemy.orm import Session
+
+import invalidation
+import models
+import plants
+import schemas
+from deadlines import OPEN_STATUSES, as_utc
+from invalidation import EventKind
+
+
+def parse_capacity(spec: str) -> Dict[str, int]:
+    capacity = {}
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        stage_name, _, lines = item.partition("=")
+        capacity[stage_name.strip()] = max(1, int(lines))
+    return capacity
+
+
+ATP_HISTORY_DAYS = int(os.getenv("ATP_HISTORY_DAYS", "30"))
+ATP_STAGE_CAPACITY = parse_capacity(os.getenv("ATP_STAGE_CAPACITY", ""))
+ATP_MATERIAL_LEAD_DAYS = float(os.getenv("ATP_MATERIAL_LEAD_DAYS", "7"))
+ATP_REFRESH_SECONDS = float(os.getenv("ATP_REFRESH_SECONDS", "300"))
+
+
+@dataclass
+class _Stage:
+    name: str
+    norm_time_minutes: int
+    materials: List[Tuple[int, float]]  # (material_id, расход на единицу)
+
+
+@dataclass
+class _Step:
+    stage_name: str
+    minutes: float
+    ends_at: Optional[float] = None  # Начатый этап: окончание по норме (timestamp)
+
+
+@dataclass
+class _OrderWork:
+    """Оставшаяся работа открытого заказа: этапы по порядку и непотраченные материалы."""
+    steps: List[_Step]
+    materials: Dict[int, float]
+
+
+@dataclass
+class _Placement:
+    stage_name: str
+    start: float
+    finish: float
+    wait_stage: float = 0.0  # Секунды ожидания линии цеха
+    wait_material: float = 0.0  # Секунды ожидания поставки материала
+
+
+class _Lanes:
+    """Линии цехов: куча моментов освобождения (timestamp) по каждому этапу."""
+
+    def __init__(self, capacity: Dict[str, int]):
+        self.capacity = capacity
+        self._heaps: Dict[str, List[float]] = {}
+
+    def _heap(self, stage_name: str, scratch: Optional[Dict[str, List[float]]] = None) -> List[float]:
+        if scratch is not None:
+            # Котировка работает с копиями затронутых куч и не меняет общее расписание
+            if stage_name not in scratch:
+                scratch[stage_name] = list(self._heap(stage_name))
+            return scratch[stage_name]
+        heap = self._heaps.get(stage_name)
+        if heap is None:
+            heap = self._heaps[stage_name] = [0.0] * self.capacity.get(stage_name, 1)
+        return heap
+
+    def book_running(self, steps: Iterable[_Step], now: float):
+        """Начатые этапы уже на линиях — бронируются раньше очереди, до своего окончания."""
+        for step in steps:
+            if step.ends_at is not None:
+                heap = self._heap(step.stage_name)
+                heapq.heapreplace(heap, max(heap[0], now, step.ends_at))
+
+    def place(self, steps: Iterable[_Step], now: float, ready: Optional[Dict[str, float]] = None,
+              commit: bool = True) -> List[_Placement]:
+        """
+        Последовательная постановка этапов заказа на самые ранние свободные линии.
+        ready — этап -> самый ранний старт (поставка материала). commit=False — только расчет.
+        """
+        scratch = None if commit else {}
+        cursor = now
+        placements = []
+        for step in steps:
+            if step.ends_at is not None:
+                finish = max(now, step.ends_at)  # Линия забронирована в book_running
+                placements.append(_Placement(step.stage_name, now, finish))
+                cursor = max(cursor, finish)
+                continue
+            heap = self._heap(step.stage_name, scratch)
+            lane_free = heap[0]
+            material_ready = (ready or {}).get(step.stage_name, 0.0)
+            start = max(cursor, lane_free, material_ready)
+            placement = _Placement(step.stage_name, start, start + step.minutes * 60)
+            if start > cursor:
+                if material_ready >= lane_free:
+                    placement.wait_material = start - cursor
+                else:
+                    placement.wait_stage = start - cursor
+            heapq.heapreplace(heap, placement.finish)
+            placements.append(placement)
+            cursor = placement.finish
+        return placements
+
+
+# --- СОСТОЯНИЕ ЗАВОДА ---
+
+class _PlantState:
+    def __init__(self):
+        self.loaded_at = 0.0  # time.monotonic() полной загрузки
+        self.orders: Dict[int, _OrderWork] = {}
+        self.stages: Dict[int, List[_Stage]] = {}  # product_id -> этапы техкарты по порядку
+        self.capacity: Dict[str, int] = {}
+        self.stock: Dict[int, float] = {}
+        self.material_info: Dict[int, Tuple[str, str]] = {}
+        self.reserved: Dict[int, float] = defaultdict(float)
+        self.lanes: Optional[_Lanes] = None  # None — пересобрать из orders
+        self.dirty_orders: Set[int] = set()
+        self.dirty_tasks: Set[int] = set()
+        self.dirty_materials: Set[int] = set()
+
+    # Загрузка
+
+    def expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > ATP_REFRESH_SECONDS
+
+    def load(self, db: Session, now: datetime):
+        since = (now - timedelta(days=ATP_HISTORY_DAYS)).date()
+        self.capacity = {
+            row.stage_name: row.operators for row in db.query(
+                models.StageCycleRollup.stage_name,
+                func.count(distinct(models.StageCycleRollup.operator_id)).label("operators"),
+            ).filter(models.StageCycleRollup.day >= since).group_by(models.StageCycleRollup.stage_name)
+        }
+        self.capacity.update(ATP_STAGE_CAPACITY)
+        self._load_materials(db, None)
+        self._load_orders(db, None, now)
+        self.loaded_at = time.monotonic()
+
+    def _load_materials(self, db: Session, ids: Optional[Set[int]]):
+        query = db.query(models.Material.id, models.Material.name, models.Material.unit,
+                         models.Material.quantity_in_stock)
+        if ids is not None:
+            query = query.filter(models.Material.id.in_(ids))
+        for row in query:
+            self.stock[row.id] = row.quantity_in_stock or 0.0
+            self.material_info[row.id] = (row.name or "", row.unit or "")
+
+    def stages_of(self, db: Session, product_id: int) -> List[_Stage]:
+        stages = self.stages.get(product_id)
+        if stages is None:
+            self._load_stages(db, {product_id})
+            stages = self.stages[product_id]
+        return stages
+
+    def _load_stages(self, db: Session, product_ids: Set[int]):
+        missing = product_ids - self.stages.keys()
+        if not missing:
+            return
+        for product_id in missing:
+            self.stages[product_id] = []
+        by_id = {}
+        for row in db.query(models.TechStage.id, models.TechStage.product_id, models.TechStage.name,
+                            models.TechStage.norm_time_minutes).filter(
+                models.TechStage.product_id.in_(missing)
+        ).order_by(models.TechStage.order_in_chain, models.TechStage.id):
+            stage = by_id[row.id] = _Stage(row.name, row.norm_time_minutes or 0, [])
+            self.stages[row.product_id].append(stage)
+        if by_id:
+            for req in db.query(models.StageMaterialRequirement.tech_stage_id, models.StageMaterialRequirement.material_id,
+                                models.StageMaterialRequirement.quantity_needed).filter(
+                    models.StageMaterialRequirement.tech_stage_id.in_(by_id.keys())
+            ):
+                by_id[req.tech_stage_id].materials.append((req.material_id, req.quantity_needed or 0.0))
+
+    def _load_orders(self, db: Session, ids: Optional[Set[int]], now: datetime):
+        """
+        Перечитывает работу заказов (всех открытых или ids). True — изменились только новые
+        заказы в конце очереди, и расписание можно дописать, не пересобирая.
+        """
+        query = db.query(models.ProductionOrder.id, models.ProductionOrder.product_id,
+                         models.ProductionOrder.quantity).filter(models.ProductionOrder.status.in_(OPEN_STATUSES))
+        if ids is not None:
+            query = query.filter(models.ProductionOrder.id.in_(ids))
+        orders = query.order_by(models.ProductionOrder.id).all()
+        tasks = defaultdict(dict)
+        task_query = db.query(models.ProductionTask.order_id, models.ProductionTask.stage_name,
+                              models.ProductionTask.status, models.ProductionTask.start_time_actual)
+        if ids is not None:
+            task_query = task_query.filter(models.ProductionTask.order_id.in_(ids))
+        else:
+            task_query = task_query.join(models.ProductionOrder).filter(
+                models.ProductionOrder.status.in_(OPEN_STATUSES))
+        for row in task_query:
+            tasks[row.order_id][row.stage_name] = row
+        self._load_stages(db, {order.product_id for order in orders})
+
+        appended = self.lanes is not None
+        newest = max(self.orders, default=0)
+        for order_id in (ids or ()):
+            old = self.orders.pop(order_id, None)
+            if old is not None:
+                self._reserve(old.materials, -1)
+                appended = False  # Работа заказа в середине очереди изменилась
+        for order in orders:
+            work = self._order_work(order, tasks[order.id], now)
+            if work is None:
+                continue
+            self.orders[order.id] = work
+            self._reserve(work.materials, 1)
+            if order.id < newest:
+                appended = False
+        return appended
+
+    def _order_work(self, order, tasks: Dict, now: datetime) -> Optional[_OrderWork]:
+        steps, materials = [], defaultdict(float)
+        for stage in self.stages.get(order.product_id, []):
+            task = tasks.get(stage.name)
+            if task is not None and task.status == "done":
+                continue
+            minutes = stage.norm_time_minutes * (order.quantity or 0)
+            ends_at = None
+            if task is not None and task.status == "working" and task.start_time_actual is not None:
+                ends_at = (as_utc(task.start_time_actual) + timedelta(minutes=minutes)).timestamp()
+            steps.append(_Step(stage.name, minutes, ends_at))
+            for material_id, amount in stage.materials:
+                materials[material_id] += amount * (order.quantity or 0)
+        return _OrderWork(steps, dict(materials)) if steps else None
+
+    def _reserve(self, materials: Dict[int, float], sign: int):
+        for material_id, amount in materials.items():
+            self.reserved[material_id] += sign * amount
+
+    # Обновление
+
+    def refresh(self, db: Session, now: datetime):
+        if self.dirty_materials:
+            self._load_materials(db, self.dirty_materials)
+        if self.dirty_tasks:
+            self.dirty_orders.update(row.order_id for row in db.query(models.ProductionTask.order_id).filter(
+                models.ProductionTask.id.in_(self.dirty_tasks)
+            ))
+        new_orders = sorted(self.dirty_orders - self.orders.keys())
+        if self.dirty_orders and not self._load_orders(db, self.dirty_orders, now):
+            self.lanes = None
+        elif self.lanes is not None:
+            # Только новые заказы в конце очереди: дописываем их, не пересобирая расписание
+            timestamp = now.timestamp()
+            for order_id in new_orders:
+                if order_id in self.orders:
+                    self.lanes.book_running(self.orders[order_id].steps, timestamp)
+                    self.lanes.place(self.orders[order_id].steps, timestamp)
+        self.dirty_materials, self.dirty_tasks, self.dirty_orders = set(), set(), set()
+        if self.lanes is None:
+            self.lanes = _Lanes(self.capacity)
+            timestamp = now.timestamp()
+            for work in self.orders.values():
+                self.lanes.book_running(work.steps, timestamp)
+            for order_id in sorted(self.orders):
+                self.lanes.place(self.orders[order_id].steps, timestamp)
+
+
+class AtpEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plants: Dict[Optional[int], _PlantState] = {}
+
+    def quote(self, db: Session, product_id: int, quantity: int,
+              deadline: Optional[datetime] = None, now: Optional[datetime] = None) -> schemas.OrderQuote:
+        now = now or datetime.now(UTC)
+        with self._lock:
+            plant_id = plants.plant_of(db)
+            state = self._plants.get(plant_id)
+            if state is None or state.expired():
+                state = self._plants[plant_id] = _PlantState()
+                state.load(db, now)
+            state.refresh(db, now)
+            stages = state.stages_of(db, product_id)
+
+            # Материалы: что останется после открытых заказов; нехватка — ждать поставки
+            required = defaultdict(float)
+            for stage in stages:
+                for material_id, amount in stage.materials:
+                    required[material_id] += amount * quantity
+            supply_at = (now + timedelta(days=ATP_MATERIAL_LEAD_DAYS)).timestamp()
+            ready: Dict[str, float] = {}
+            short_stage_material: Dict[str, int] = {}
+            material_lines = []
+            for material_id, amount in required.items():
+                available = state.stock.get(material_id, 0.0) - state.reserved.get(material_id, 0.0)
+                shortage = max(0.0, amount - max(0.0, available))
+                name, unit = state.material_info.get(material_id, ("", ""))
+                material_lines.append(schemas.QuoteMaterial(
+                    material_id=material_id, material_name=name, unit=unit, required=round(amount, 3),
+                    available=round(available, 3), shortage=round(shortage, 3),
+                ))
+                if shortage > 0:
+                    for stage in stages:
+                        if any(mid == material_id for mid, _ in stage.materials):
+                            ready[stage.name] = supply_at
+                            short_stage_material.setdefault(stage.name, material_id)
+
+            steps = [_Step(stage.name, stage.norm_time_minutes * quantity) for stage in stages]
+            placements = state.lanes.place(steps, now.timestamp(), ready, commit=False)
+
+            # Узкое место — причина наибольшего ожидания. Под блокировкой: material_info
+            # меняет refresh параллельной котировки
+            waits = defaultdict(float)
+            for placement in placements:
+                if placement.wait_stage:
+                    waits[("stage", placement.stage_name)] += placement.wait_stage
+                if placement.wait_material:
+                    material_id = short_stage_material[placement.stage_name]
+                    waits[("material", state.material_info.get(material_id, ("", ""))[0])] += placement.wait_material
+            blocking = None
+            if waits:
+                (kind, name), seconds = max(waits.items(), key=lambda item: item[1])
+                blocking = schemas.QuoteBlocking(kind=kind, name=name, wait_minutes=round(seconds / 60, 1))
+
+        finish = datetime.fromtimestamp(placements[-1].finish, UTC) if placements else now
+        return schemas.OrderQuote(
+            product_id=product_id,
+            quantity=quantity,
+            earliest_finish_at=finish,
+            lead_time_minutes=round((finish - now).total_seconds() / 60, 1),
+            meets_deadline=None if deadline is None else finish <= as_utc(deadline),
+            blocking=blocking,
+            stages=[
+                schemas.QuoteStage(
+                    stage_name=p.stage_name,
+                    start_at=datetime.fromtimestamp(p.start, UTC),
+                    finish_at=datetime.fromtimestamp(p.finish, UTC),
+                    wait_minutes=round((p.wait_stage + p.wait_material) / 60, 1),
+                )
+                for p in placements
+            ],
+            materials=sorted(material_lines, key=lambda line: line.material_name),
+        )
+
+    # Инвалидация
+
+    def mark(self, plant_id: Optional[int], orders: Iterable[int] = (), tasks: Iterable[int] = (),
+             materials: Iterable[int] = (), reload: bool = False):
+        with self._lock:
+            for state_plant, state in list(self._plants.items()):
+                if plant_id is not None and plant_id != state_plant:
+                    continue
+                if reload:
+                    del self._plants[state_plant]  # Перезагрузится при следующей котировке
+                    continue
+                state.dirty_orders.update(orders)
+                state.dirty_tasks.update(tasks)
+                state.dirty_materials.update(materials)
+
+    def reset(self):
+        with self._lock:
+            self._plants.clear()
+
+
+engine = AtpEngine()
+
+
+def quote(db: Session, product_id: int, quantity: int, deadline: Optional[datetime] = None) -> schemas.OrderQuote:
+    """Самый ранний срок выполнения нового заказа и что его ограничивает (цех или материал)."""
+    return engine.quote(db, product_id, quantity, deadline)
+
+
+# --- ИНВАЛИДАЦИЯ ---
+
+def _on_order_event(event: invalidation.InvalidationEvent):
+    engine.mark(event.plant_id, orders=event.ids, reload=not event.ids)
+
+
+def _on_task_event(event: invalidation.InvalidationEvent):
+    engine.mark(event.plant_id, tasks=event.ids, reload=not event.ids)
+
+
+def _on_material_event(event: invalidation.InvalidationEvent):
+    engine.mark(event.plant_id, materials=event.ids, reload=not event.ids)
+
+
+def _on_techcard_event(event: invalidation.InvalidationEvent):
+    engine.mark(event.plant_id, reload=True)
+
+
+invalidation.subscribe(EventKind.ORDER_CHANGED, _on_order_event)
+invalidation.subscribe([EventKind.TASK_CHANGED, EventKind.TASK_COMPLETED], _on_task_event)
+invalidation.subscribe([EventKind.MATERIAL_CHANGED, EventKind.STOCK_CHANGED], _on_material_event)
+invalidation.subscribe([EventKind.PRODUCT_CHANGED, EventKind.TECHCARD_CHANGED], _on_techcard_event)
+invalidation.subscribe(EventKind.RESYNC, lambda event: engine.reset())
@@ -0,0 +1,206 @@
+"""
+Журнал действий: кто назначил, завершил, забраковал, изменил.
+
+Эндпоинты после коммита вызывают audit.record(...) — это только постановка словаря
+в ограниченную очередь (микросекунды). Фоновый поток собирает события пачками до
+AUDIT_BATCH_SIZE или AUDIT_FLUSH_INTERVAL секунд и пишет их одним многострочным INSERT.
+При остановке приложения очередь дописывается до конца.
+
+Очередь ограничена AUDIT_QUEUE_SIZE событиями: если БД недоступна долго, новые события
+отбрасываются со счетчиком dropped (виден в /metrics), а не растят память процесса.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, UTC
+from typing import Dict, List, Optional
+
+from sqlalchemy import insert, tuple_
+from sqlalchemy.orm import Session
+
+import database
+import models
+
+logger = logging.getLogger(__name__)
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "0.5"))
+MAX_QUERY_LIMIT = 1000
+
+
+class AuditLog:
+    def __init__(self, maxsize: int = AUDIT_QUEUE_SIZE, batch_size: int = AUDIT_BATCH_SIZE,
+                 flush_interval: float = AUDIT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize)
+        self._write_lock = threading.Lock()  # flush() из другого потока не пишет параллельно с фоновым
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def record(self, action: str, user: Optional[models.User] = None, *, order_id: Optional[int] = None,
+               task_id: Optional[int] = None, entity: Optional[str] = None, entity_id: Optional[int] = None,
+               details: Optional[Dict] = None):
+        """Ставит событие в очередь. Вызывать после коммита действия."""
+        event = {
+            "created_at": datetime.now(UTC),
+            "action": action,
+            "plant_id": user.plant_id if user is not None else None,
+            "user_id": user.id if user is not None else None,
+            "username": user.username if user is not None else None,
+            "order_id": order_id,
+            "task_id": task_id,
+            "entity": entity,
+            "entity_id": entity_id,
+            "details": details or {},
+        }
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Audit queue is full, %d events dropped so far", self.dropped)
+
+    def _take_batch(self, first: Dict) -> List[Dict]:
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stopped.is_set():
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self) -> List[Dict]:
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: List[Dict]):
+        # События пишутся в БД своего завода; обычно вся пачка — одна БД
+        by_engine = defaultdict(list)
+        for event in batch:
+            by_engine[database.get_engine(event["plant_id"])].append(event)
+        with self._write_lock:
+            for bind, events in by_engine.items():
+                db = database.SessionLocal(bind=bind)
+                try:
+                    db.execute(insert(models.AuditEvent.__table__), events)  # executemany — одна пачка
+                    db.commit()
+                    self.written += len(events)
+                except Exception:
+                    logger.exception("Failed to write %d audit events", len(events))
+                    db.rollback()
+                    self.dropped += len(events)
+                finally:
+                    db.close()
+
+    def flush(self):
+        """Синхронно записывает все, что сейчас в очереди."""
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+    def _loop(self):
+        while not self._stopped.is_set():
+            try:
+                first = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            self._write(self._take_batch(first))
+        self.flush()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="audit-writer")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+            self._thread = None
+        self.flush()  # Если поток не запускался (скрипты) или не успел
+
+    def render(self) -> str:
+        """Метрики журнала в формате Prometheus (дополняет metrics.render)."""
+        lines = []
+        for name, help_text, metric_type, value in (
+                ("audit_queue_size", "События в очереди на запись", "gauge", self._queue.qsize()),
+                ("audit_written_total", "Записано событий журнала", "counter", self.written),
+                ("audit_dropped_total", "Отброшено событий журнала (очередь полна или ошибка записи)",
+                 "counter", self.dropped),
+        ):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+log = AuditLog()
+
+
+def record(action: str, user: Optional[models.User] = None, **fields):
+    log.record(action, user, **fields)
+
+
+def start():
+    log.start()
+
+
+def stop():
+    log.stop()
+
+
+# --- ЧТЕНИЕ ---
+
+def query_events(
+        db: Session,
+        order_id: Optional[int] = None,
+        task_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+        action: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        before_id: Optional[int] = None,
+        limit: int = 100,
+) -> List[models.AuditEvent]:
+    """
+    События от новых к старым. Следующая страница — тот же запрос с end и before_id,
+    равными created_at и id последнего полученного события: пачка audit.record пишется
+    с одинаковым created_at, и курсор только по времени пропускал бы события на границе страниц.
+    """
+    query = db.query(models.AuditEvent)
+    if order_id is not None:
+        query = query.filter(models.AuditEvent.order_id == order_id)
+    if task_id is not None:
+        query = query.filter(models.AuditEvent.task_id == task_id)
+    if user_id is not None:
+        query = query.filter(models.AuditEvent.user_id == user_id)
+    if action is not None:
+        query = query.filter(models.AuditEvent.action == action)
+    if start is not None:
+        query = query.filter(models.AuditEvent.created_at >= start)
+    if end is not None and before_id is not None:
+        query = query.filter(tuple_(models.AuditEvent.created_at, models.AuditEvent.id) < tuple_(end, before_id))
+    elif end is not None:
+        query = query.filter(models.AuditEvent.created_at < end)
+    return query.order_by(
+        models.AuditEvent.created_at.desc(), models.AuditEvent.id.desc()
+    ).limit(min(limit, MAX_QUERY_LIMIT)).all()
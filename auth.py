@@ -5,6 +5,7 @@ from jose import JWTError, jwt
 from sqlalchemy.orm import Session
 import models
 import database
+import plants  # noqa: F401  (ограничение запросов заводом сессии)
 
 # Секретный ключ (в реальном проекте хранить в .env)
 SECRET_KEY = "super-secret-key-for-hackathon"
@@ -22,12 +23,44 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    credentials_exception = HTTPException(
+def find_user(username: str):
+    """Пользователь для входа: ищется в основной БД, затем в БД заводов из карты шардов."""
+    for bind in database.all_engines():
+        with database.SessionLocal(bind=bind) as db:
+            user = db.query(models.User).filter(models.User.username == username).first()
+            if user is not None:
+                return user
+    return None
+
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+def get_plant_id(token: str = Depends(oauth2_scheme)) -> int:
+    """Завод вызывающего из токена (токены без завода — выданные до разделения — основной завод)."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        raise _credentials_exception()
+    return payload.get("plant") or database.DEFAULT_PLANT_ID
+
+
+def get_plant_db(plant_id: int = Depends(get_plant_id)):
+    """Сессия в БД завода вызывающего; все ORM-запросы ограничены его заводом (plants.py)."""
+    db = database.plant_session(plant_id)
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_plant_db)):
+    credentials_exception = _credentials_exception()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
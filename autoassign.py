@@ -0,0 +1,245 @@
+"""
+Автоматическое назначение операторов на ожидающие задачи с балансировкой нагрузки.
+
+Оценка длительности задачи для оператора: норма этапа * количество в заказе * коэффициент
+скорости оператора на этом этапе. Коэффициент — факт / норма по StageCycleRollup за
+AUTO_ASSIGN_HISTORY_DAYS дней, сглаженный к 1 (SPEED_PRIOR_MINUTES минут "нормальной"
+работы): два быстрых выполнения не делают оператора вдвое быстрее. Кто этап еще не делал,
+получает коэффициент UNFAMILIAR_PENALTY.
+
+Загрузка оператора — оценка оставшихся минут по его незавершенным задачам (у начатой
+вычитается уже прошедшее время).
+
+Жадный алгоритм (EDF): задачи по срочности — запас заказа (slack_minutes), затем дедлайн
+и порядок этапа. Каждая задача уходит оператору с наименьшим ожидаемым окончанием
+"загрузка + длительность". Кандидаты — AUTO_ASSIGN_CANDIDATES наименее загруженных из тех,
+кто делал этот этап, и наименее загруженный вообще; их достают из куч по загрузке,
+поэтому задача стоит O(log N), а не перебор всех операторов.
+
+Назначение не начинает задачу (статус остается pending) — она встает в очередь оператора.
+Время назначения пишется в assigned_at: по нему считается длительность этапа, если задачу
+завершили, не начав (rollups.task_cycle), и заказ с назначенными задачами уже в работе.
+Порядок этапов внутри заказа не учитывается: это балансировка очередей, а не расписание.
+"""
+import heapq
+import os
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, update
+from sqlalchemy.orm import Session
+
+import models
+import schemas
+import sync
+from deadlines import OPEN_STATUSES, as_utc
+
+AUTO_ASSIGN_HISTORY_DAYS = int(os.getenv("AUTO_ASSIGN_HISTORY_DAYS", "90"))
+AUTO_ASSIGN_CANDIDATES = int(os.getenv("AUTO_ASSIGN_CANDIDATES", "5"))
+SPEED_PRIOR_MINUTES = 120.0
+UNFAMILIAR_PENALTY = 1.25
+OPEN_TASK_STATUSES = ["pending", "working", "rework_needed"]
+
+
+@dataclass
+class _Operator:
+    id: int
+    username: str
+    load: float = 0.0  # Минут незавершенной работы
+    assigned: int = 0  # Назначено в этом прогоне
+    ratios: Dict[str, float] = field(default_factory=dict)  # Этап -> факт/норма
+
+    def minutes(self, stage_name: str, base_minutes: float) -> float:
+        return base_minutes * self.ratios.get(stage_name, UNFAMILIAR_PENALTY)
+
+
+@dataclass
+class Assignment:
+    task_id: int
+    order_id: int
+    stage_name: str
+    user_id: int
+    username: str
+    estimated_minutes: float
+    finish_in_minutes: float  # Когда оператор закончит эту задачу с учетом очереди
+
+
+class _LoadHeap:
+    """Куча операторов по загрузке с ленивым удалением устаревших записей."""
+
+    def __init__(self, operators: Iterable[_Operator]):
+        self._heap = [(op.load, op.id, op) for op in operators]
+        heapq.heapify(self._heap)
+
+    def push(self, op: _Operator):
+        heapq.heappush(self._heap, (op.load, op.id, op))
+
+    def smallest(self, count: int) -> List[_Operator]:
+        taken: Dict[int, _Operator] = {}
+        while self._heap and len(taken) < count:
+            load, op_id, op = heapq.heappop(self._heap)
+            if load == op.load and op_id not in taken:
+                taken[op_id] = op
+        for op in taken.values():
+            self.push(op)
+        return list(taken.values())
+
+
+# --- ДАННЫЕ ---
+
+def _load_operators(db: Session, now: datetime) -> Dict[int, _Operator]:
+    operators = {
+        user.id: _Operator(user.id, user.username)
+        for user in db.query(models.User.id, models.User.username).filter(
+            models.User.role == models.UserRole.OPERATOR, models.User.is_active.is_(True)
+        )
+    }
+    since = (now - timedelta(days=AUTO_ASSIGN_HISTORY_DAYS)).date()
+    for row in db.query(
+            models.StageCycleRollup.operator_id,
+            models.StageCycleRollup.stage_name,
+            func.sum(models.StageCycleRollup.total_cycle_minutes).label("cycle"),
+            func.sum(models.StageCycleRollup.total_norm_minutes).label("norm"),
+    ).filter(
+        models.StageCycleRollup.operator_id.in_(operators.keys()),
+        models.StageCycleRollup.day >= since,
+    ).group_by(models.StageCycleRollup.operator_id, models.StageCycleRollup.stage_name):
+        operators[row.operator_id].ratios[row.stage_name] = (
+            ((row.cycle or 0.0) + SPEED_PRIOR_MINUTES) / ((row.norm or 0.0) + SPEED_PRIOR_MINUTES)
+        )
+    return operators
+
+
+def _task_query(db: Session):
+    return db.query(
+        models.ProductionTask.id,
+        models.ProductionTask.order_id,
+        models.ProductionTask.stage_name,
+        models.ProductionTask.status,
+        models.ProductionTask.responsible_user_id,
+        models.ProductionTask.start_time_actual,
+        models.ProductionOrder.quantity,
+        models.ProductionOrder.deadline_date,
+        models.ProductionOrder.slack_minutes,
+        models.TechStage.order_in_chain,
+        models.TechStage.norm_time_minutes,
+    ).join(
+        models.ProductionOrder, models.ProductionTask.order_id == models.ProductionOrder.id
+    ).outerjoin(
+        models.TechStage, and_(models.TechStage.product_id == models.ProductionOrder.product_id,
+                               models.TechStage.name == models.ProductionTask.stage_name)
+    )
+
+
+def _base_minutes(row) -> float:
+    return float((row.norm_time_minutes or 0) * (row.quantity or 0))
+
+
+def _apply_current_load(db: Session, operators: Dict[int, _Operator], now: datetime):
+    for row in _task_query(db).filter(
+            models.ProductionTask.responsible_user_id.in_(operators.keys()),
+            models.ProductionTask.status.in_(OPEN_TASK_STATUSES),
+    ):
+        op = operators[row.responsible_user_id]
+        remaining = op.minutes(row.stage_name, _base_minutes(row))
+        if row.status == "working" and row.start_time_actual is not None:
+            remaining -= (now - as_utc(row.start_time_actual)).total_seconds() / 60
+        op.load += max(0.0, remaining)
+
+
+def _urgency(row, now: datetime):
+    if row.slack_minutes is not None:
+        slack = row.slack_minutes
+    elif row.deadline_date is not None:
+        slack = (as_utc(row.deadline_date) - now).total_seconds() / 60
+    else:
+        slack = float("inf")
+    return slack, row.order_in_chain or 0, row.id
+
+
+# --- НАЗНАЧЕНИЕ ---
+
+def plan(db: Session, now: Optional[datetime] = None) -> Tuple[List[Assignment], List[_Operator]]:
+    """
+    Рассчитывает назначения для всех неназначенных задач в статусе pending открытых заказов.
+    Выбранные задачи блокируются до конца транзакции (занятые другим воркером пропускаются).
+    """
+    now = now or datetime.now(UTC)
+    operators = _load_operators(db, now)
+    if not operators:
+        return [], []
+    _apply_current_load(db, operators, now)
+
+    tasks = _task_query(db).filter(
+        models.ProductionTask.status == "pending",
+        models.ProductionTask.responsible_user_id.is_(None),
+        models.ProductionOrder.status.in_(OPEN_STATUSES),
+    ).with_for_update(skip_locked=True, of=models.ProductionTask).all()
+    tasks.sort(key=lambda row: _urgency(row, now))
+
+    everyone = _LoadHeap(operators.values())
+    by_stage_members: Dict[str, List[_Operator]] = defaultdict(list)
+    for op in operators.values():
+        for stage_name in op.ratios:
+            by_stage_members[stage_name].append(op)
+    by_stage = {stage_name: _LoadHeap(members) for stage_name, members in by_stage_members.items()}
+
+    assignments = []
+    for row in tasks:
+        base = _base_minutes(row)
+        stage_heap = by_stage.get(row.stage_name)
+        candidates = everyone.smallest(1)
+        if stage_heap is not None:
+            candidates += stage_heap.smallest(AUTO_ASSIGN_CANDIDATES)
+        best = min(candidates, key=lambda op: (op.load + op.minutes(row.stage_name, base), op.load, op.id))
+
+        minutes = best.minutes(row.stage_name, base)
+        best.load += minutes
+        best.assigned += 1
+        everyone.push(best)
+        for stage_name in best.ratios:
+            by_stage[stage_name].push(best)
+        assignments.append(Assignment(
+            task_id=row.id, order_id=row.order_id, stage_name=row.stage_name, user_id=best.id,
+            username=best.username, estimated_minutes=minutes, finish_in_minutes=best.load,
+        ))
+    return assignments, sorted(operators.values(), key=lambda op: op.id)
+
+
+def apply(db: Session, assignments: List[Assignment], now: Optional[datetime] = None):
+    """Записывает назначения одним bulk UPDATE по первичному ключу и коммитит."""
+    now = now or datetime.now(UTC)
+    if assignments:
+        db.execute(update(models.ProductionTask), [
+            {"id": a.task_id, "responsible_user_id": a.user_id, "assigned_at": now} for a in assignments
+        ])
+        sync.mark_changed(db, "tasks", [a.task_id for a in assignments])
+    db.commit()
+
+
+def run(db: Session, dry_run: bool = False) -> schemas.AutoAssignResult:
+    """Расчет и запись назначений. При dry_run только расчет: блокировки снимаются откатом."""
+    assignments, operators = plan(db)
+    if dry_run:
+        db.rollback()
+    else:
+        apply(db, assignments)
+    return schemas.AutoAssignResult(
+        dry_run=dry_run,
+        assigned=len(assignments),
+        operators=[
+            schemas.OperatorLoad(user_id=op.id, username=op.username, assigned=op.assigned,
+                                 queue_minutes=round(op.load, 1))
+            for op in operators
+        ],
+        assignments=[
+            schemas.AutoAssignment(
+                task_id=a.task_id, order_id=a.order_id, stage_name=a.stage_name,
+                responsible_user_id=a.user_id, responsible_username=a.username,
+                estimated_minutes=round(a.estimated_minutes, 1), finish_in_minutes=round(a.finish_in_minutes, 1),
+            )
+            for a in assignments
+        ],
+    )
@@ -0,0 +1,84 @@
+"""
+Бенчмарк форматов ответа /gantt: размер и время кодирования.
+
+Данные синтетические (без БД), по форме совпадают с ответом /gantt:
+на каждый заказ — строка заказа и по строке на этап.
+
+    python bench_payloads.py --orders 5000 --stages 6
+"""
+import argparse
+import gzip
+import time
+from datetime import datetime, timedelta
+
+import encoding
+import main
+import schemas
+
+STAGES = ["Заготовка", "Литье", "Механообработка", "Термообработка", "Сборка", "Окраска", "Испытания", "Упаковка"]
+PRODUCTS = ["Насос ЦНС-38", "Задвижка ЗКЛ-100", "Редуктор Ц2У", "Корпус подшипника", "Фланец ДУ-150"]
+
+
+def make_gantt_rows(orders: int, stages: int):
+    rows = []
+    task_id = 1000
+    start = datetime(2026, 1, 1, 8, 0)
+    for order_id in range(1, orders + 1):
+        quantity = 1 + order_id % 40
+        current = start + timedelta(hours=order_id)
+        rows.append(schemas.GanttTask(
+            id=order_id, text=f"Заказ #{order_id} ({PRODUCTS[order_id % len(PRODUCTS)]})",
+            start_date=current.strftime("%Y-%m-%d %H:%M"), duration=round(stages * quantity / 8, 2),
+            progress=0.5, parent=0,
+        ))
+        for stage in STAGES[:stages]:
+            task_id += 1
+            minutes = 30 * quantity
+            rows.append(schemas.GanttTask(
+                id=task_id, text=f"{stage} x{quantity}", start_date=current.strftime("%Y-%m-%d %H:%M"),
+                duration=max(1, round(minutes / 480 * 100)) / 100, progress=1.0 if task_id % 3 else 0.0,
+                parent=order_id,
+            ))
+            current += timedelta(minutes=minutes)
+    return rows
+
+
+def measure(rows, media_type: str, repeat: int):
+    best = float("inf")
+    body = b""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        body = encoding.encode(rows, main.GANTT_FIELDS, media_type, envelope="data")
+        best = min(best, time.perf_counter() - started)
+
+    started = time.perf_counter()
+    compressed = gzip.compress(body, compresslevel=6)  # Как GZipMiddleware в main.py
+    gzip_time = time.perf_counter() - started
+    return len(body), best, len(compressed), gzip_time
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--orders", type=int, default=5000)
+    parser.add_argument("--stages", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_gantt_rows(args.orders, args.stages)
+    print(f"Строк: {len(rows)}")
+    print(f"{'Формат':<40} {'Размер, КБ':>11} {'Кодир., мс':>11} {'gzip, КБ':>9} {'gzip, мс':>9}")
+
+    media_types = [encoding.JSON, encoding.COLUMNAR_JSON]
+    if encoding.msgpack is not None:
+        media_types += [encoding.MSGPACK, encoding.COLUMNAR_MSGPACK]
+    else:
+        print("(msgpack не установлен — форматы MessagePack пропущены)")
+
+    for media_type in media_types:
+        size, encode_time, gzip_size, gzip_time = measure(rows, media_type, args.repeat)
+        print(f"{media_type:<40} {size / 1024:>11.1f} {encode_time * 1000:>11.1f} "
+              f"{gzip_size / 1024:>9.1f} {gzip_time * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,226 @@
+"""
+Многоуровневый состав изделия (BOM): разузлование до сырья и трудоемкости этапов.
+
+На вход этапа техкарты идут материалы (StageMaterialRequirement) и полуфабрикаты —
+другие изделия (StageComponentRequirement), у которых своя техкарта. Разузлование
+раскрывает полуфабрикаты рекурсивно и дает на единицу изделия:
+- суммарный расход сырья по материалам;
+- минуты по этапам (цехам), включая этапы полуфабрикатов;
+- сколько штук каждого полуфабриката нужно на всех уровнях.
+
+Справочник техкарт целиком держится в памяти (три запроса), результат по каждому
+изделию запоминается: полуфабрикат, входящий в десятки изделий, раскрывается один раз.
+Снимок и результаты сбрасываются событиями шины инвалидации (импорт техкарт, правка
+изделий и материалов), в том числе от других воркеров.
+
+Снимок и результаты — свои у каждого завода (техкарты завода видны только его сессии).
+
+Циклы (изделие прямо или через полуфабрикаты входит само в себя) не допускаются:
+импорт техкарт проверяет граф перед коммитом (find_cycle).
+"""
+import threading
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import invalidation
+import models
+import plants
+import schemas
+from invalidation import EventKind
+
+
+class BomCycleError(ValueError):
+    """Изделие входит само в себя через полуфабрикаты."""
+
+    def __init__(self, path: List[str]):
+        self.path = path
+        super().__init__("Цикл в составе изделий: " + " → ".join(path))
+
+
+@dataclass
+class Explosion:
+    """Потребность на ЕДИНИЦУ изделия. Словари не изменяются после расчета."""
+    product_id: int
+    materials: Dict[int, float] = field(default_factory=dict)  # material_id -> количество
+    stage_minutes: Dict[str, float] = field(default_factory=dict)  # Этап (цех) -> минуты
+    components: Dict[int, float] = field(default_factory=dict)  # product_id полуфабриката -> штук
+    depth: int = 0  # 0 — только сырье, 1 — есть полуфабрикаты и т.д.
+
+
+@dataclass
+class _Stage:
+    name: str
+    norm_time_minutes: int
+    materials: List[Tuple[int, float]] = field(default_factory=list)
+    components: List[Tuple[int, float]] = field(default_factory=list)
+
+
+class Catalog:
+    """Снимок техкарт: изделия, материалы и этапы с входами."""
+
+    def __init__(self, db: Session):
+        self.products: Dict[int, Tuple[str, str]] = {
+            row.id: (row.code, row.name) for row in db.query(models.Product.id, models.Product.code, models.Product.name)
+        }
+        self.material_info: Dict[int, Tuple[str, str]] = {
+            row.id: (row.name, row.unit) for row in db.query(models.Material.id, models.Material.name, models.Material.unit)
+        }
+        self.stages: Dict[int, _Stage] = {}
+        self.stages_by_product: Dict[int, List[_Stage]] = defaultdict(list)
+        for row in db.query(
+                models.TechStage.id, models.TechStage.product_id, models.TechStage.name, models.TechStage.norm_time_minutes
+        ).join(models.Product, models.TechStage.product_id == models.Product.id).order_by(models.TechStage.order_in_chain, models.TechStage.id):
+            stage = _Stage(row.name, row.norm_time_minutes or 0)
+            self.stages[row.id] = stage
+            self.stages_by_product[row.product_id].append(stage)
+        for req in db.query(models.StageMaterialRequirement.tech_stage_id, models.StageMaterialRequirement.material_id,
+                            models.StageMaterialRequirement.quantity_needed):
+            if req.tech_stage_id in self.stages:
+                self.stages[req.tech_stage_id].materials.append((req.material_id, req.quantity_needed or 0.0))
+        for req in db.query(models.StageComponentRequirement.tech_stage_id,
+                            models.StageComponentRequirement.component_product_id,
+                            models.StageComponentRequirement.quantity_needed):
+            if req.tech_stage_id in self.stages:
+                self.stages[req.tech_stage_id].components.append((req.component_product_id, req.quantity_needed or 0.0))
+
+    def code(self, product_id: int) -> str:
+        return self.products.get(product_id, (str(product_id), ""))[0]
+
+
+class _Exploder:
+    """Разузлование по одному снимку с запоминанием результата по изделию."""
+
+    def __init__(self, catalog: Catalog):
+        self.catalog = catalog
+        self.memo: Dict[int, Explosion] = {}
+        self._path: List[int] = []  # Текущая цепочка раскрытия — для обнаружения цикла
+
+    def explode(self, product_id: int) -> Explosion:
+        cached = self.memo.get(product_id)
+        if cached is not None:
+            return cached
+        if product_id in self._path:
+            cycle = self._path[self._path.index(product_id):] + [product_id]
+            raise BomCycleError([self.catalog.code(pid) for pid in cycle])
+
+        self._path.append(product_id)
+        try:
+            result = Explosion(product_id)
+            materials = defaultdict(float)
+            minutes = defaultdict(float)
+            components = defaultdict(float)
+            for stage in self.catalog.stages_by_product.get(product_id, []):
+                for component_id, quantity in stage.components:
+                    sub = self.explode(component_id)
+                    components[component_id] += quantity
+                    for sub_id, amount in sub.components.items():
+                        components[sub_id] += amount * quantity
+                    for material_id, amount in sub.materials.items():
+                        materials[material_id] += amount * quantity
+                    for stage_name, stage_minutes in sub.stage_minutes.items():
+                        minutes[stage_name] += stage_minutes * quantity
+                    result.depth = max(result.depth, sub.depth + 1)
+                for material_id, quantity in stage.materials:
+                    materials[material_id] += quantity
+                minutes[stage.name] += stage.norm_time_minutes
+            result.materials = dict(materials)
+            result.stage_minutes = dict(minutes)
+            result.components = dict(components)
+        finally:
+            self._path.pop()
+        self.memo[product_id] = result
+        return result
+
+    def explode_all(self) -> Dict[int, Explosion]:
+        for product_id in self.catalog.products:
+            self.explode(product_id)
+        return self.memo
+
+
+def find_cycle(db: Session) -> Optional[List[str]]:
+    """Проверка текущего (в том числе несохраненного, после flush) состояния техкарт."""
+    try:
+        _Exploder(Catalog(db)).explode_all()
+    except BomCycleError as e:
+        return e.path
+    return None
+
+
+# --- ЗАПОМИНАЮЩИЙ ДВИЖОК ---
+
+class BomEngine:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._exploders: Dict[Optional[int], _Exploder] = {}  # Завод -> разузлование
+
+    def _current(self, db: Session) -> _Exploder:
+        plant_id = plants.plant_of(db)
+        exploder = self._exploders.get(plant_id)
+        if exploder is None:
+            exploder = self._exploders[plant_id] = _Exploder(Catalog(db))
+        return exploder
+
+    def per_unit(self, db: Session, product_id: int) -> Tuple[Explosion, Catalog]:
+        with self._lock:
+            exploder = self._current(db)
+            return exploder.explode(product_id), exploder.catalog
+
+    def explode_all(self, db: Session) -> Dict[int, Explosion]:
+        """Разузлование всего каталога (на единицу каждого изделия)."""
+        with self._lock:
+            return dict(self._current(db).explode_all())
+
+    def invalidate(self):
+        with self._lock:
+            self._exploders.clear()
+
+
+engine = BomEngine()
+
+
+def explode(db: Session, product_id: int, quantity: float = 1) -> schemas.BomExplosion:
+    """Потребность в сырье и времени этапов на quantity единиц изделия."""
+    per_unit, catalog = engine.per_unit(db, product_id)
+    code, name = catalog.products.get(product_id, ("", ""))
+
+    materials = []
+    for material_id, amount in per_unit.materials.items():
+        material_name, unit = catalog.material_info.get(material_id, ("", ""))
+        materials.append(schemas.BomMaterialLine(
+            material_id=material_id, material_name=material_name, unit=unit, quantity=amount * quantity
+        ))
+    stages = [
+        schemas.BomStageLine(stage_name=stage_name, minutes=minutes * quantity)
+        for stage_name, minutes in per_unit.stage_minutes.items()
+    ]
+    components = []
+    for component_id, amount in per_unit.components.items():
+        component_code, component_name = catalog.products.get(component_id, ("", ""))
+        components.append(schemas.BomComponentLine(
+            product_id=component_id, product_code=component_code, product_name=component_name,
+            quantity=amount * quantity
+        ))
+    return schemas.BomExplosion(
+        product_id=product_id,
+        product_code=code,
+        product_name=name,
+        quantity=quantity,
+        depth=per_unit.depth,
+        total_minutes=sum(line.minutes for line in stages),
+        materials=sorted(materials, key=lambda line: line.material_name),
+        stages=stages,
+        components=sorted(components, key=lambda line: line.product_code),
+    )
+
+
+# --- ИНВАЛИДАЦИЯ ---
+
+def _on_catalog_changed(event: invalidation.InvalidationEvent):
+    engine.invalidate()
+
+
+invalidation.subscribe([EventKind.PRODUCT_CHANGED, EventKind.MATERIAL_CHANGED, EventKind.TECHCARD_CHANGED,
+                        EventKind.RESYNC], _on_catalog_changed)
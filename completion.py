@@ -0,0 +1,181 @@
+"""
+Завершение производственных задач: списание материалов, ОТК и переделки.
+
+Общая логика для POST /tasks/{task_id}/complete и пакетного POST /tasks/complete-batch.
+Функции не коммитят — транзакцией управляет вызывающий.
+"""
+from datetime import datetime, UTC
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+import models
+import quality
+import rollups
+import schemas
+
+CLOSED_TASK_STATUSES = ("done", "rework_needed")
+
+
+class CompletionError(Exception):
+    """Задачу нельзя завершить (брак больше партии, не хватает материала и т.п.)."""
+
+
+def find_stage(db: Session, task: models.ProductionTask) -> Optional[models.TechStage]:
+    return db.query(models.TechStage).join(models.Product).filter(
+        models.TechStage.name == task.stage_name,
+        models.Product.id == task.order.product_id
+    ).first()
+
+
+def validate(task: models.ProductionTask, defective_qty: int):
+    if defective_qty > task.order.quantity:
+        raise CompletionError("Количество брака не может превышать количество в партии.")
+
+
+def check_stock(stage: Optional[models.TechStage], order_qty: int):
+    """Проверяет остатки по всем нормам этапа до списания."""
+    if not stage:
+        return
+    for req in stage.requirements:
+        total_needed = req.quantity_needed * order_qty
+        if req.material.quantity_in_stock < total_needed:
+            raise CompletionError(
+                f"Недостаточно {req.material.name}. Нужно {total_needed}, есть {req.material.quantity_in_stock}"
+            )
+
+
+def apply_completion(
+        db: Session,
+        task: models.ProductionTask,
+        stage: Optional[models.TechStage],
+        defective_qty: int,
+        comment: Optional[str],
+        user: models.User,
+) -> Dict:
+    """Списывает материалы, применяет решение ОТК и обновляет агрегаты. Остатки уже проверены."""
+    order_qty = task.order.quantity
+    good_qty = order_qty - defective_qty
+    logs = []
+
+    # --- 1. ЛОГИКА СПИСАНИЯ ---
+    if stage:
+        for req in stage.requirements:
+            total_needed = req.quantity_needed * order_qty
+            req.material.quantity_in_stock -= total_needed
+            db.add(req.material)
+            logs.append(f"Списано {total_needed} {req.material.unit} {req.material.name}")
+
+    # --- 2. ЛОГИКА ОТК И ПЕРЕДЕЛКИ (REWORK) ---
+    if defective_qty > 0:
+        task.status = "rework_needed"
+        task.order.status = models.OrderStatus.DELAYED  # Ставим задержку
+
+        # Комментарий для ответственного за партию
+        rework_comment = (
+            f"БРАК: {defective_qty} шт. Ответственный: {user.username}. "
+            f"Комментарий ОТК: {comment or 'Нет'}. Партия отправлена на повторный цикл."
+        )
+        logs.append(rework_comment)
+
+    else:
+        # Если брака нет, этап завершен
+        task.status = "done"
+        task.end_time_actual = datetime.now(UTC)  # Фиксируем время завершения
+        rollups.record_task_completion(db, task, stage)  # Агрегаты длительности этапов
+
+    # Событие ОТК сохраняется при каждом завершении (и при браке, и без)
+    quality.record_completion(db, task, user, good_qty, defective_qty, comment)
+
+    return {"status": task.status, "good_quantity": good_qty, "defective_quantity": defective_qty, "logs": logs}
+
+
+# --- ПАКЕТНОЕ ЗАВЕРШЕНИЕ ---
+
+def _load_tasks(db: Session, task_ids: Iterable[int]) -> Dict[int, models.ProductionTask]:
+    tasks = db.query(models.ProductionTask).options(
+        joinedload(models.ProductionTask.order)
+    ).filter(models.ProductionTask.id.in_(set(task_ids))).all()
+    return {task.id: task for task in tasks}
+
+
+def _load_stages(db: Session, tasks: Iterable[models.ProductionTask]) -> Dict[Tuple[int, str], models.TechStage]:
+    keys = {(task.order.product_id, task.stage_name) for task in tasks}
+    if not keys:
+        return {}
+    stages = db.query(models.TechStage).options(
+        selectinload(models.TechStage.requirements)
+    ).filter(or_(*[
+        and_(models.TechStage.product_id == product_id, models.TechStage.name == stage_name)
+        for product_id, stage_name in keys
+    ])).order_by(models.TechStage.id).all()
+
+    result = {}
+    for stage in stages:
+        result.setdefault((stage.product_id, stage.name), stage)  # Как .first() в одиночном режиме
+    return result
+
+
+def _lock_materials(db: Session, stages: Iterable[models.TechStage]) -> Dict[int, models.Material]:
+    material_ids = {req.material_id for stage in stages for req in stage.requirements}
+    if not material_ids:
+        return {}
+    # Блокируем остатки одним запросом в порядке id, чтобы параллельные пакеты не взаимоблокировались.
+    # Загруженные объекты попадают в identity map, и req.material берется оттуда без SQL.
+    materials = db.query(models.Material).filter(
+        models.Material.id.in_(material_ids)
+    ).order_by(models.Material.id).with_for_update().all()
+    return {material.id: material for material in materials}
+
+
+def complete_batch(
+        db: Session,
+        items: List[schemas.BatchCompleteItem],
+        user: models.User,
+        partial: bool = True,
+) -> Tuple[List[schemas.BatchCompleteItemResult], List[models.ProductionTask], List[int]]:
+    """
+    Завершает задачи пакетом: задачи, этапы и материалы грузятся по одному запросу,
+    списание идет одним проходом по заблокированным остаткам.
+    Возвращает (результаты по позициям, завершенные задачи, id списанных материалов).
+    При partial=False любая ошибка помечает весь пакет как отклоненный.
+    """
+    tasks = _load_tasks(db, [item.task_id for item in items])
+    stages = _load_stages(db, tasks.values())
+    _lock_materials(db, stages.values())
+
+    results = []
+    completed_tasks = []
+    material_ids = set()
+
+    for item in items:
+        task = tasks.get(item.task_id)
+        try:
+            if task is None:
+                raise CompletionError("Task not found")
+            if task.status in CLOSED_TASK_STATUSES:
+                raise CompletionError(f"Task status is already {task.status}")
+            validate(task, item.defective_quantity)
+
+            stage = stages.get((task.order.product_id, task.stage_name))
+            check_stock(stage, task.order.quantity)
+        except CompletionError as e:
+            results.append(schemas.BatchCompleteItemResult(task_id=item.task_id, ok=False, error=str(e)))
+            continue
+
+        outcome = apply_completion(db, task, stage, item.defective_quantity, item.comment, user)
+        results.append(schemas.BatchCompleteItemResult(task_id=item.task_id, ok=True, **outcome))
+        completed_tasks.append(task)
+        if stage:
+            material_ids.update(req.material_id for req in stage.requirements)
+
+    if not partial and any(not result.ok for result in results):
+        for result in results:
+            if result.ok:
+                result.ok = False
+                result.status, result.logs = None, []
+                result.error = "Пакет отклонен: есть позиции с ошибками"
+        return results, [], []
+
+    return results, completed_tasks, sorted(material_ids)
@@ -0,0 +1,245 @@
+"""
+Мониторинг сроков заказов.
+
+Для каждого открытого заказа хранится прогноз завершения (predicted_finish_at) и запас
+до дедлайна (slack_minutes). Прогноз — как в /gantt: этапы техкарты идут последовательно,
+этап длится norm_time_minutes * quantity; выполненные этапы пропускаются, начатый
+заканчивается не раньше текущего момента.
+
+По прогнозу поддерживается статус заказа:
+- все задачи выполнены                                  -> COMPLETED
+- есть переделка (rework_needed) или прогноз > дедлайна -> DELAYED
+- хотя бы одна задача начата или назначена              -> IN_PROGRESS
+- иначе                                                 -> NEW
+
+Пересчет инкрементальный: события задач и заказов из шины инвалидации помечают заказы
+(по заводу события), фоновый поток пересчитывает только их в сессии этого завода. Раз в
+DEADLINE_SWEEP_SECONDS пересчитываются все открытые заказы каждого завода — прогноз
+зависит и от времени (начатый этап может затянуться).
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session, selectinload
+
+import database
+import invalidation
+import models
+import plants
+from invalidation import EventKind
+
+logger = logging.getLogger(__name__)
+
+DEADLINE_SWEEP_SECONDS = float(os.getenv("DEADLINE_SWEEP_SECONDS", "300"))  # 0 — фоновый пересчет выключен
+DEADLINE_AT_RISK_HOURS = float(os.getenv("DEADLINE_AT_RISK_HOURS", "24"))  # Порог /orders/at-risk по умолчанию
+EVALUATE_BATCH_SIZE = 500
+
+OPEN_STATUSES = [models.OrderStatus.NEW, models.OrderStatus.IN_PROGRESS, models.OrderStatus.DELAYED]
+
+
+def as_utc(value: datetime) -> datetime:
+    """Время из БД в UTC: SQLite отдает наивные значения, PostgreSQL — с часовым поясом."""
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value.astimezone(UTC)
+
+
+# --- ПРОГНОЗ ---
+
+def predict_finish(order: models.ProductionOrder, stages: List[models.TechStage], now: datetime) -> datetime:
+    """Прогноз завершения заказа по этапам техкарты (stages отсортированы по order_in_chain)."""
+    tasks = {task.stage_name: task for task in order.tasks}
+    cursor = now
+    for stage in stages:
+        task = tasks.get(stage.name)
+        if task is not None and task.status == "done":
+            continue
+        duration = timedelta(minutes=(stage.norm_time_minutes or 0) * order.quantity)
+        if task is not None and task.status == "working" and task.start_time_actual is not None:
+            # Начатый этап: по норме от фактического начала, но не раньше текущего момента
+            cursor = max(cursor, as_utc(task.start_time_actual) + duration)
+        else:
+            cursor += duration
+    return cursor
+
+
+def next_status(order: models.ProductionOrder, predicted: datetime) -> models.OrderStatus:
+    statuses = [task.status for task in order.tasks]
+    if statuses and all(status == "done" for status in statuses):
+        return models.OrderStatus.COMPLETED
+    if "rework_needed" in statuses:
+        return models.OrderStatus.DELAYED
+    if order.deadline_date is not None and predicted > as_utc(order.deadline_date):
+        return models.OrderStatus.DELAYED
+    if any(task.status != "pending" or task.assigned_at is not None for task in order.tasks):
+        return models.OrderStatus.IN_PROGRESS
+    return models.OrderStatus.NEW
+
+
+def load_stages(db: Session, product_ids: Iterable[int]) -> Dict[int, List[models.TechStage]]:
+    """Этапы изделий по порядку цепочки одним запросом (прогноз сроков, Гант)."""
+    stages = defaultdict(list)
+    for stage in db.query(models.TechStage).filter(
+            models.TechStage.product_id.in_(set(product_ids))
+    ).order_by(models.TechStage.order_in_chain):
+        stages[stage.product_id].append(stage)
+    return stages
+
+
+def _evaluate_batch(db: Session, order_ids: List[int], now: datetime) -> int:
+    # Строки, которые сейчас пересчитывает другой воркер, пропускаем
+    orders = db.query(models.ProductionOrder).options(
+        selectinload(models.ProductionOrder.tasks)
+    ).filter(
+        models.ProductionOrder.id.in_(order_ids),
+        models.ProductionOrder.status.in_(OPEN_STATUSES),
+    ).with_for_update(skip_locked=True, of=models.ProductionOrder).all()
+    stages = load_stages(db, [order.product_id for order in orders])
+
+    changed = 0
+    for order in orders:
+        predicted = predict_finish(order, stages.get(order.product_id, []), now)
+        status = next_status(order, predicted)
+        if status == models.OrderStatus.COMPLETED:
+            # Фактическое завершение — по последней задаче
+            ends = [as_utc(task.end_time_actual) for task in order.tasks if task.end_time_actual is not None]
+            predicted = max(ends) if ends else now
+        order.predicted_finish_at = predicted
+        order.slack_minutes = (
+            (as_utc(order.deadline_date) - predicted).total_seconds() / 60 if order.deadline_date else None
+        )
+        if order.status != status:
+            order.status = status
+            changed += 1
+    db.commit()
+    return changed
+
+
+def evaluate(db: Session, order_ids: Optional[Iterable[int]] = None) -> int:
+    """Пересчитывает прогноз и статус открытых заказов (всех или указанных). Возвращает число смен статуса."""
+    if order_ids is None:
+        order_ids = [row.id for row in db.query(models.ProductionOrder.id).filter(
+            models.ProductionOrder.status.in_(OPEN_STATUSES)
+        )]
+    order_ids = sorted(set(order_ids))
+    now = datetime.now(UTC)
+    changed = 0
+    for start in range(0, len(order_ids), EVALUATE_BATCH_SIZE):
+        changed += _evaluate_batch(db, order_ids[start:start + EVALUATE_BATCH_SIZE], now)
+    return changed
+
+
+def at_risk(db: Session, within_hours: float = DEADLINE_AT_RISK_HOURS) -> List[models.ProductionOrder]:
+    """Открытые заказы с запасом меньше within_hours (включая опаздывающие), по возрастанию запаса."""
+    return db.query(models.ProductionOrder).filter(
+        models.ProductionOrder.status.in_(OPEN_STATUSES),
+        models.ProductionOrder.slack_minutes <= within_hours * 60,
+    ).order_by(models.ProductionOrder.slack_minutes, models.ProductionOrder.id).all()
+
+
+# --- ФОНОВЫЙ ПЕРЕСЧЕТ ---
+
+class DeadlineMonitor:
+    def __init__(self, sweep_seconds: float = DEADLINE_SWEEP_SECONDS):
+        self.sweep_seconds = sweep_seconds
+        self._lock = threading.Lock()
+        # Завод -> id (id разных БД заводов могут совпадать); None — события без завода
+        self._dirty_orders: Dict[Optional[int], Set[int]] = defaultdict(set)
+        self._dirty_tasks: Dict[Optional[int], Set[int]] = defaultdict(set)
+        self._sweep_requested = True  # Первый проход — полный
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def mark(self, order_ids: Iterable[int] = (), task_ids: Iterable[int] = (), sweep: bool = False,
+             plant_id: Optional[int] = None):
+        with self._lock:
+            self._dirty_orders[plant_id].update(order_ids)
+            self._dirty_tasks[plant_id].update(task_ids)
+            self._sweep_requested = self._sweep_requested or sweep
+        self._wakeup.set()
+
+    def _take(self) -> Tuple[Dict[Optional[int], Set[int]], Dict[Optional[int], Set[int]], bool]:
+        with self._lock:
+            taken = self._dirty_orders, self._dirty_tasks, self._sweep_requested
+            self._dirty_orders, self._dirty_tasks = defaultdict(set), defaultdict(set)
+            self._sweep_requested = False
+        self._wakeup.clear()
+        return taken
+
+    @staticmethod
+    def _evaluate_marked(db: Session, order_ids: Set[int], task_ids: Set[int]):
+        if task_ids:
+            order_ids |= {row.order_id for row in db.query(models.ProductionTask.order_id).filter(
+                models.ProductionTask.id.in_(task_ids)
+            )}
+        if order_ids:
+            evaluate(db, order_ids)
+
+    def run_once(self):
+        orders_by_plant, tasks_by_plant, sweep = self._take()
+        if sweep:
+            for plant_id in plants.plant_ids():
+                with database.plant_session(plant_id) as db:
+                    evaluate(db)
+            return
+        for plant_id in set(orders_by_plant) | set(tasks_by_plant):
+            with database.plant_session(plant_id) as db:
+                self._evaluate_marked(db, orders_by_plant.get(plant_id, set()), tasks_by_plant.get(plant_id, set()))
+
+    def _loop(self):
+        next_sweep = 0.0
+        while not self._stopped.is_set():
+            now = datetime.now(UTC).timestamp()
+            if now >= next_sweep:
+                self.mark(sweep=True)
+                next_sweep = now + self.sweep_seconds
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Deadline evaluation failed")
+            self._wakeup.wait(max(0.0, next_sweep - datetime.now(UTC).timestamp()))
+
+    def start(self):
+        if self.sweep_seconds <= 0 or self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="deadline-monitor")
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+
+monitor = DeadlineMonitor()
+
+
+def start():
+    monitor.start()
+
+
+def stop():
+    monitor.stop()
+
+
+# --- СОБЫТИЯ ---
+# Пересчитывает тот воркер, который опубликовал событие; у остальных заказ догонит периодический проход.
+
+def _on_task_event(event: invalidation.InvalidationEvent):
+    if event.origin == invalidation.WORKER_ID:
+        monitor.mark(task_ids=event.ids, sweep=not event.ids, plant_id=event.plant_id)
+
+
+def _on_order_event(event: invalidation.InvalidationEvent):
+    if event.origin == invalidation.WORKER_ID:
+        monitor.mark(order_ids=event.ids, sweep=not event.ids, plant_id=event.plant_id)
+
+
+invalidation.subscribe([EventKind.TASK_CHANGED, EventKind.TASK_COMPLETED], _on_task_event)
+invalidation.subscribe(EventKind.ORDER_CHANGED, _on_order_event)
@@ -0,0 +1,155 @@
+"""
+Компактные форматы ответов для больших списков (/gantt, /orders/, /tasks/).
+
+Формат выбирается заголовком Accept; по умолчанию — обычный JSON (массив объектов).
+- application/vnd.mes.columnar+json   — колоночный JSON
+- application/msgpack                 — те же строки, что в JSON, но в MessagePack
+- application/vnd.mes.columnar+msgpack — колоночный формат в MessagePack
+
+Колоночный формат: по массиву на поле вместо повторения ключей в каждой строке.
+    {"format": "columnar", "count": N,
+     "encodings": {"id": "delta", "text": "dict", "start_date": "minutes-delta", ...},
+     "columns": {"id": [1001, 1, 1, ...], "text": [0, 1, 0, ...], ...},
+     "dictionaries": {"text": ["Литье x3", "Окраска x3"]}}
+- plain          — значения как есть;
+- dict           — индекс в dictionaries[поле] (повторяющиеся строки: этапы, изделия, статусы);
+- delta          — первое значение, затем разности с предыдущим (id идут подряд);
+- minutes-delta  — время в минутах Unix-времени (UTC), затем разности.
+null в delta-колонках остается null и не сдвигает базу.
+"""
+import json
+from dataclasses import dataclass
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from fastapi import Request
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from starlette.responses import Response
+
+try:  # MessagePack — опциональная зависимость
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+JSON = "application/json"
+COLUMNAR_JSON = "application/vnd.mes.columnar+json"
+MSGPACK = "application/msgpack"
+COLUMNAR_MSGPACK = "application/vnd.mes.columnar+msgpack"
+
+_ALIASES = {"application/x-msgpack": MSGPACK}
+_BINARY = (MSGPACK, COLUMNAR_MSGPACK)
+
+PLAIN, DICT, DELTA, MINUTES_DELTA = "plain", "dict", "delta", "minutes-delta"
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    encoding: str = PLAIN
+
+
+def _to_minutes(value) -> Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return int(value.timestamp()) // 60
+
+
+def _encode_column(values: List[Any], encoding: str, dictionary: Optional[List[str]]):
+    if encoding == DICT:
+        index: Dict[Any, int] = {}
+        column = []
+        for value in values:
+            if value is None:
+                column.append(None)
+                continue
+            position = index.get(value)
+            if position is None:
+                position = index[value] = len(dictionary)
+                dictionary.append(value)
+            column.append(position)
+        return column
+
+    if encoding in (DELTA, MINUTES_DELTA):
+        if encoding == MINUTES_DELTA:
+            values = [_to_minutes(value) for value in values]
+        column, previous = [], 0
+        for value in values:
+            if value is None:
+                column.append(None)
+                continue
+            column.append(value - previous)
+            previous = value
+        return column
+
+    return list(values)
+
+
+def to_columnar(rows: Sequence[Dict[str, Any]], fields: Sequence[Field]) -> Dict[str, Any]:
+    """Строки (словари) -> колоночное представление по описанию полей."""
+    columns, dictionaries = {}, {}
+    for field in fields:
+        dictionary = dictionaries.setdefault(field.name, []) if field.encoding == DICT else None
+        columns[field.name] = _encode_column([row.get(field.name) for row in rows], field.encoding, dictionary)
+    return {
+        "format": "columnar",
+        "count": len(rows),
+        "encodings": {field.name: field.encoding for field in fields},
+        "columns": columns,
+        "dictionaries": dictionaries,
+    }
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """Выбирает поддерживаемый формат с наибольшим q из Accept; иначе JSON."""
+    best, best_q = JSON, 0.0
+    for part in (accept or "").split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        media_type = _ALIASES.get(media_type.lower(), media_type.lower())
+        if media_type not in (JSON, COLUMNAR_JSON, MSGPACK, COLUMNAR_MSGPACK):
+            continue
+        if media_type in _BINARY and msgpack is None:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def _dump(payload: Any, media_type: str) -> bytes:
+    if media_type in _BINARY:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode(rows: Iterable, fields: Sequence[Field], media_type: str, envelope: Optional[str] = None) -> bytes:
+    """Сериализует строки (pydantic-модели или словари) в выбранный формат. rows может быть генератором."""
+    rows = [row.model_dump(mode="json") if isinstance(row, BaseModel) else jsonable_encoder(row) for row in rows]
+    if media_type in (COLUMNAR_JSON, COLUMNAR_MSGPACK):
+        payload = to_columnar(rows, fields)
+    else:
+        payload = {envelope: rows} if envelope else rows
+    return _dump(payload, media_type)
+
+
+def negotiated_response(request: Request, rows: Iterable, fields: Sequence[Field],
+                        envelope: Optional[str] = None) -> Optional[Response]:
+    """
+    Ответ в формате из Accept или None, если клиент хочет обычный JSON —
+    тогда эндпоинт возвращает данные как раньше (с валидацией response_model).
+    envelope — ключ, под которым строки лежат в обычном ответе ({"data": [...]} у /gantt).
+    """
+    media_type = negotiate(request.headers.get("accept"))
+    if media_type == JSON:
+        return None
+    return Response(encode(rows, fields, media_type, envelope), media_type=media_type, headers={"Vary": "Accept"})
@@ -0,0 +1,132 @@
+"""
+Идемпотентность запросов по заголовку Idempotency-Key.
+
+Терминалы с нестабильным Wi-Fi повторяют POST. Ответ на первый успешный запрос сохраняется
+в idempotency_keys в той же транзакции, что и сама операция; повтор с тем же ключом
+получает сохраненный ответ без повторного выполнения. Записи живут IDEMPOTENCY_TTL_HOURS
+и удаляются попутно при сохранении новых.
+
+Использование в эндпоинте:
+
+    idem: idempotency.IdempotencyContext = Depends(idempotency.IdempotencyKey("orders.create"))
+    ...
+    replay = idem.replay(db)
+    if replay is not None:
+        return replay
+    ... операция, db.flush() ...
+    return idem.commit(db, body)
+"""
+import hashlib
+import os
+import random
+from datetime import datetime, timedelta, UTC
+from typing import Any, Optional
+
+from fastapi import Depends, Header, HTTPException, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import auth
+import models
+
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+PURGE_PROBABILITY = 0.01  # Доля сохранений, которые заодно удаляют просроченные записи
+REPLAY_HEADER = "Idempotent-Replayed"
+
+
+def _sha256(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value
+
+
+class IdempotencyContext:
+    def __init__(self, key_hash: Optional[str], request_hash: str):
+        self.key_hash = key_hash
+        self.request_hash = request_hash
+
+    @property
+    def enabled(self) -> bool:
+        return self.key_hash is not None
+
+    def _response(self, record: models.IdempotencyRecord) -> JSONResponse:
+        if record.request_hash != self.request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        return JSONResponse(status_code=record.status_code, content=record.response_body,
+                            headers={REPLAY_HEADER: "true"})
+
+    def replay(self, db: Session) -> Optional[JSONResponse]:
+        """Сохраненный ответ на этот ключ или None, если запрос нужно выполнить."""
+        if not self.enabled:
+            return None
+        record = db.get(models.IdempotencyRecord, self.key_hash)
+        if record is None:
+            return None
+        if _utc(record.expires_at) < datetime.now(UTC):
+            db.delete(record)
+            db.flush()
+            return None
+        return self._response(record)
+
+    def commit(self, db: Session, body: Any, status_code: int = 200) -> Any:
+        """
+        Коммитит операцию вместе с сохраненным ответом. Если параллельный повтор успел
+        закоммитить тот же ключ раньше, своя транзакция откатывается и отдается его ответ.
+        """
+        if not self.enabled:
+            db.commit()
+            return body
+
+        now = datetime.now(UTC)
+        db.add(models.IdempotencyRecord(
+            key_hash=self.key_hash,
+            request_hash=self.request_hash,
+            status_code=status_code,
+            response_body=body,
+            created_at=now,
+            expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS),
+        ))
+        if random.random() < PURGE_PROBABILITY:
+            purge_expired(db)
+
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            record = db.get(models.IdempotencyRecord, self.key_hash)
+            if record is None:
+                raise
+            return self._response(record)
+        return body
+
+
+class IdempotencyKey:
+    """Зависимость FastAPI: читает Idempotency-Key и хеширует тело запроса."""
+
+    def __init__(self, operation: str):
+        self.operation = operation
+
+    async def __call__(
+            self,
+            request: Request,
+            idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key", max_length=255),
+            user: models.User = Depends(auth.get_current_user),
+    ) -> IdempotencyContext:
+        body = await request.body()
+        request_hash = _sha256(request.url.path, request.url.query, body)
+        if not idempotency_key:
+            return IdempotencyContext(None, request_hash)
+        return IdempotencyContext(_sha256(user.id, self.operation, idempotency_key), request_hash)
+
+
+def purge_expired(db: Session) -> int:
+    return db.query(models.IdempotencyRecord).filter(
+        models.IdempotencyRecord.expires_at < datetime.now(UTC)
+    ).delete(synchronize_session=False)
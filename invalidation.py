@@ -0,0 +1,244 @@
+"""
+Шина инвалидации кэшей между воркерами uvicorn.
+
+Эндпоинты записи после коммита публикуют типизированные события (InvalidationEvent).
+Событие сразу применяется к кэшам своего процесса и рассылается остальным:
+- PostgresTransport — LISTEN/NOTIFY на канале INVALIDATION_CHANNEL (боевой режим);
+- FileTransport — общий файл JSON-строк, который читают все процессы (тесты, один хост без Postgres);
+- LocalTransport — без рассылки (один процесс).
+
+Транспорт выбирается переменной INVALIDATION_BUS: "postgres", "file:/путь/к/файлу" или "local".
+По умолчанию — postgres для PostgreSQL-движка, иначе local.
+"""
+import enum
+import json
+import logging
+import os
+import select
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "mes_invalidation")
+NOTIFY_PAYLOAD_LIMIT = 7900  # Лимит PostgreSQL — 8000 байт
+FILE_POLL_INTERVAL = 0.01
+
+# Уникален для процесса: свои события из транспорта не применяем повторно
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class EventKind(str, enum.Enum):
+    PRODUCT_CHANGED = "product.changed"
+    MATERIAL_CHANGED = "material.changed"  # Справочные поля материала
+    STOCK_CHANGED = "material.stock_changed"  # Только остатки (списание)
+    TECHCARD_CHANGED = "techcard.changed"  # Этапы/нормы расхода (импорт техкарт)
+    ORDER_CHANGED = "order.changed"
+    TASK_CHANGED = "task.changed"  # Назначение/смена статуса без завершения
+    TASK_COMPLETED = "task.completed"
+    RESYNC = "resync"  # События могли потеряться (переподключение) — сбросить все
+
+
+@dataclass
+class InvalidationEvent:
+    kind: EventKind
+    ids: List[int] = field(default_factory=list)  # Пустой список — "все объекты этого типа"
+    day: Optional[str] = None  # ISO-дата, например дата завершения задачи
+    origin: str = WORKER_ID
+    plant_id: Optional[int] = None  # Завод, к которому относятся ids (id разных БД заводов могут совпадать)
+
+    def to_dict(self) -> Dict:
+        data = asdict(self)
+        data["kind"] = self.kind.value
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "InvalidationEvent":
+        return cls(kind=EventKind(data["kind"]), ids=data.get("ids") or [], day=data.get("day"),
+                   origin=data.get("origin", ""), plant_id=data.get("plant_id"))
+
+
+Handler = Callable[[InvalidationEvent], None]
+
+
+# --- ТРАНСПОРТЫ ---
+
+class LocalTransport:
+    def start(self, on_message: Callable[[str], None]):
+        pass
+
+    def send(self, payload: str):
+        pass
+
+    def stop(self):
+        pass
+
+
+class FileTransport:
+    """Общий файл: запись — одна строка с O_APPEND (атомарно), чтение — хвост файла в потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, on_message: Callable[[str], None]):
+        open(self.path, "a").close()
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+        self._thread = threading.Thread(target=self._tail, args=(on_message, offset),
+                                        daemon=True, name="invalidation-file")
+        self._thread.start()
+
+    def _tail(self, on_message, offset: int):
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while not self._stopped.is_set():
+                position = f.tell()
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    f.seek(position)  # Строка дописывается — дочитаем в следующий раз
+                    time.sleep(FILE_POLL_INTERVAL)
+                    continue
+                on_message(line.decode("utf-8"))
+
+    def send(self, payload: str):
+        with open(self.path, "ab") as f:
+            f.write(payload.encode("utf-8") + b"\n")
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+
+class PostgresTransport:
+    """LISTEN в отдельном соединении psycopg2, NOTIFY — через пул движка."""
+
+    def __init__(self, engine, channel: str = INVALIDATION_CHANNEL):
+        self.engine = engine
+        self.channel = channel
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, on_message: Callable[[str], None]):
+        self._thread = threading.Thread(target=self._listen, args=(on_message,),
+                                        daemon=True, name="invalidation-listen")
+        self._thread.start()
+
+    def _listen(self, on_message):
+        first_connect = True
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = self.engine.raw_connection()
+                dbapi_conn = conn.dbapi_connection
+                dbapi_conn.autocommit = True
+                with dbapi_conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                if not first_connect:
+                    # Пока соединения не было, события могли потеряться
+                    on_message(json.dumps([InvalidationEvent(EventKind.RESYNC, origin="").to_dict()]))
+                first_connect = False
+
+                while not self._stopped.is_set():
+                    if select.select([dbapi_conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        on_message(dbapi_conn.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("Invalidation listener failed, reconnecting")
+                self._stopped.wait(1.0)
+            finally:
+                if conn is not None:
+                    conn.invalidate()  # Соединение с LISTEN не возвращаем в пул
+
+    def send(self, payload: str):
+        with self.engine.connect() as conn:
+            conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                         {"channel": self.channel, "payload": payload})
+            conn.commit()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+
+# --- ШИНА ---
+
+class InvalidationBus:
+    def __init__(self):
+        self._handlers: Dict[EventKind, List[Handler]] = {}
+        self._transport = LocalTransport()
+
+    def subscribe(self, kinds, handler: Handler):
+        for kind in ([kinds] if isinstance(kinds, EventKind) else kinds):
+            self._handlers.setdefault(kind, []).append(handler)
+
+    def _dispatch(self, event: InvalidationEvent):
+        for handler in self._handlers.get(event.kind, ()):
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("Invalidation handler failed for %s", event.kind.value)
+
+    def _on_message(self, payload: str):
+        try:
+            events = [InvalidationEvent.from_dict(item) for item in json.loads(payload)]
+        except (ValueError, KeyError):
+            logger.warning("Malformed invalidation payload: %r", payload[:200])
+            return
+        for event in events:
+            if event.origin != WORKER_ID:
+                self._dispatch(event)
+
+    def publish(self, *events: InvalidationEvent):
+        """Применяет события локально и рассылает другим воркерам. Вызывать после коммита."""
+        for event in events:
+            self._dispatch(event)
+
+        payload = json.dumps([event.to_dict() for event in events], ensure_ascii=False)
+        if len(payload.encode("utf-8")) > NOTIFY_PAYLOAD_LIMIT:
+            # Слишком длинные списки id заменяем на "все объекты типа"
+            payload = json.dumps([InvalidationEvent(e.kind, [], e.day, plant_id=e.plant_id).to_dict() for e in events])
+        try:
+            self._transport.send(payload)
+        except Exception:
+            # Свой процесс уже в актуальном состоянии; остальные догонят по TTL кэшей
+            logger.exception("Failed to broadcast invalidation events")
+
+    def start(self, engine=None):
+        setting = os.getenv("INVALIDATION_BUS")
+        if setting is None:
+            setting = "postgres" if engine is not None and engine.dialect.name == "postgresql" else "local"
+
+        if setting == "postgres":
+            self._transport = PostgresTransport(engine)
+        elif setting.startswith("file:"):
+            self._transport = FileTransport(setting[len("file:"):])
+        else:
+            self._transport = LocalTransport()
+        self._transport.start(self._on_message)
+
+    def stop(self):
+        self._transport.stop()
+        self._transport = LocalTransport()
+
+
+bus = InvalidationBus()
+
+
+def subscribe(kinds, handler: Handler):
+    bus.subscribe(kinds, handler)
+
+
+def publish(*events: InvalidationEvent):
+    bus.publish(*events)
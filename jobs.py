@@ -0,0 +1,175 @@
+"""
+Фоновое построение тяжелых отчетов.
+
+Задание записывается в report_jobs и выполняется в пуле потоков процесса; результат
+сохраняется файлом в REPORTS_DIR. Готовые результаты переиспользуются: задание с тем же
+типом отчета, параметрами и версией данных (data_version) не пересчитывается.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, UTC
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import database
+import models
+import reports
+
+logger = logging.getLogger(__name__)
+
+REPORTS_DIR = os.getenv("REPORTS_DIR", "report_artifacts")
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", "2"))
+# Задания в queued/running старше этого срока считаются потерянными (процесс перезапущен)
+REPORT_JOB_STALE_MINUTES = int(os.getenv("REPORT_JOB_STALE_MINUTES", "30"))
+
+ACTIVE_STATUSES = ("queued", "running")
+
+
+class ReportDefinition:
+    def __init__(self, build: Callable[[Session, Dict], Tuple[Iterator[str], int]],
+                 data_version: Callable[[Session], str], extensions: Dict[str, str]):
+        self.build = build
+        self.data_version = data_version
+        self.extensions = extensions  # format -> расширение файла
+
+
+def _parse_date(value: Optional[str]) -> Optional[date]:
+    return date.fromisoformat(value) if value else None
+
+
+def _build_materials_by_stage(db: Session, params: Dict) -> Tuple[Iterator[str], int]:
+    rows = reports.build_materials_report(
+        db, start_date=_parse_date(params.get("start_date")), end_date=_parse_date(params.get("end_date"))
+    )
+    if params.get("format") == "json":
+        return iter([json.dumps([row.model_dump(mode="json") for row in rows], ensure_ascii=False)]), len(rows)
+    return reports.iter_materials_csv(rows), len(rows)
+
+
+REPORT_TYPES: Dict[str, ReportDefinition] = {
+    "materials-by-stage": ReportDefinition(
+        build=_build_materials_by_stage,
+        data_version=reports.materials_data_version,
+        extensions={"csv": "csv", "json": "json"},
+    ),
+}
+
+MEDIA_TYPES = {"csv": "text/csv", "json": "application/json"}
+
+
+# --- ПУЛ ИСПОЛНИТЕЛЕЙ ---
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            os.makedirs(REPORTS_DIR, exist_ok=True)
+            _executor = ThreadPoolExecutor(max_workers=REPORT_JOB_WORKERS, thread_name_prefix="report-job")
+        return _executor
+
+
+def start():
+    _get_executor()
+
+
+def stop():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+# --- ЗАДАНИЯ ---
+
+def params_key(params: Dict) -> str:
+    return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+
+def _is_reusable(job: models.ReportJob) -> bool:
+    if job.status == "done":
+        return bool(job.file_path) and os.path.exists(job.file_path)
+    created_at = job.created_at if job.created_at.tzinfo else job.created_at.replace(tzinfo=UTC)
+    return datetime.now(UTC) - created_at < timedelta(minutes=REPORT_JOB_STALE_MINUTES)
+
+
+def submit(db: Session, report_type: str, params: Dict, user: Optional[models.User] = None) -> models.ReportJob:
+    """Ставит отчет в очередь или возвращает уже готовое/выполняющееся задание с тем же ключом."""
+    definition = REPORT_TYPES[report_type]
+    key = params_key(params)
+    version = definition.data_version(db)
+
+    candidates = db.query(models.ReportJob).filter(
+        models.ReportJob.report_type == report_type,
+        models.ReportJob.params_key == key,
+        models.ReportJob.data_version == version,
+        models.ReportJob.status.in_(("done",) + ACTIVE_STATUSES),
+    ).order_by(models.ReportJob.id.desc()).all()
+    for job in candidates:
+        if _is_reusable(job):
+            return job
+
+    job = models.ReportJob(
+        report_type=report_type,
+        params=params,
+        params_key=key,
+        data_version=version,
+        status="queued",
+        created_by_id=user.id if user else None,
+        created_at=datetime.now(UTC),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    _get_executor().submit(_run_job, job.id, job.plant_id)
+    return job
+
+
+def _run_job(job_id: int, plant_id: Optional[int] = None):
+    db = database.plant_session(plant_id)  # Отчет строится по данным завода, поставившего задание
+    try:
+        job = db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+        if job is None:
+            return
+        job.status = "running"
+        job.started_at = datetime.now(UTC)
+        db.commit()
+
+        try:
+            definition = REPORT_TYPES[job.report_type]
+            chunks, row_count = definition.build(db, job.params)
+
+            extension = definition.extensions[job.params.get("format", "csv")]
+            file_path = os.path.join(REPORTS_DIR, f"{job.report_type}-{job.plant_id}-{job.id}.{extension}")
+            tmp_path = file_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8-sig" if extension == "csv" else "utf-8") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, file_path)  # Файл появляется атомарно, уже целиком
+
+            job.file_path = file_path
+            job.row_count = row_count
+            job.status = "done"
+        except Exception as e:
+            logger.exception("Report job %s failed", job_id)
+            db.rollback()
+            job.status = "failed"
+            job.error = str(e)[:1000]
+
+        job.finished_at = datetime.now(UTC)
+        db.commit()
+    finally:
+        db.close()
+
+
+def media_type(job: models.ReportJob) -> str:
+    return MEDIA_TYPES.get((job.params or {}).get("format", "csv"), "application/octet-stream")
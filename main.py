@@ -1,26 +1,72 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Query, Request
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import StreamingResponse
-from sqlalchemy.orm import Session
+from fastapi.middleware.gzip import GZipMiddleware
+from starlette.responses import StreamingResponse, PlainTextResponse, FileResponse
+from contextlib import asynccontextmanager
+from sqlalchemy import and_
+from sqlalchemy.orm import Session, joinedload, selectinload
+import os
 from typing import List, Optional  # Добавлен Optional и List
 from datetime import timedelta, datetime, date, UTC  # Добавлен UTC и date
 import models, database, security, auth, schemas
+import tech_import
+import metrics
+import profiling
+import rollups
+import sync
+import quality
+import reports
+import jobs
+import completion
+import admission
+import archive
+import audit
+import autoassign
+import atp
+import plants
+import search
+import bom
+import deadlines
+import encoding
+from encoding import Field, DICT, DELTA, MINUTES_DELTA
+import report_cache  # noqa: F401  (подписывает кэш отчетов на события инвалидации)
+import idempotency
+import invalidation
+from invalidation import EventKind, InvalidationEvent
+
+HEAVY = [Depends(admission.Admit(admission.HEAVY))]  # Лимиты допуска (admission.py)
+WRITE = [Depends(admission.Admit(admission.WRITE))]
 
 
 # --- DEPENDENCY: Получение сессии БД ---
-
-def get_db():
-    db = database.SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Сессия в БД завода вызывающего (по токену); запросы ограничены его заводом (plants.py).
+# Та же зависимость у auth.get_current_user, поэтому на запрос открывается одна сессия.
+get_db = auth.get_plant_db
 
 
 # --- КОНФИГУРАЦИЯ ---
 
-app = FastAPI(title="Metallurgy MES API")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    plants.ensure_plants()
+    for bind in database.all_engines():
+        with database.SessionLocal(bind=bind) as db:
+            sync.ensure_clock(db)  # Счетчик версий для /sync/changes — в каждой БД
+    jobs.start()  # Пул фоновых отчетов
+    invalidation.bus.start(database.engine)  # Инвалидация кэшей между воркерами
+    archive.start()  # Перенос старых завершенных заказов в архив
+    deadlines.start()  # Прогноз сроков и статусы заказов
+    audit.start()  # Журнал действий пишется пачками в фоне
+    yield
+    audit.stop()  # Дописывает очередь журнала
+    deadlines.stop()
+    archive.stop()
+    invalidation.bus.stop()
+    jobs.stop()
+
+
+app = FastAPI(title="Metallurgy MES API", lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -35,16 +81,52 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Метрики: латентность по маршрутам и счетчики SQL на запрос
+for _bind in database.all_engines():
+    metrics.instrument_engine(_bind)
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Профилирование по запросу (заголовок X-Debug-Profile или PROFILE_SAMPLE_RATE)
+for _bind in database.all_engines():
+    profiling.instrument_engine(_bind)
+app.add_middleware(profiling.ProfilingMiddleware)
+
+# Сжатие ответов (Гант и списки на больших заводах — мегабайты JSON)
+app.add_middleware(GZipMiddleware, minimum_size=int(os.getenv("GZIP_MIN_SIZE", "1024")),
+                   compresslevel=int(os.getenv("GZIP_LEVEL", "6")))
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Метрики в формате Prometheus."""
+    return PlainTextResponse(metrics.render(database.engine) + admission.render() + audit.log.render(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profiles", tags=["Debug"])
+def list_profiles(user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))):
+    """Последние профили запросов (кратко: время, число SQL, найденные N+1)."""
+    return profiling.list_reports()
+
+
+@app.get("/debug/profiles/{profile_id}", tags=["Debug"])
+def get_profile(profile_id: int, user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))):
+    """Полный профиль запроса: трассировка SQL, N+1 и сэмплы стеков."""
+    report = profiling.get_report(profile_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return report
+
 
 
 
 @app.post("/token", response_model=schemas.Token, tags=["Auth"])
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = auth.find_user(form_data.username)
     if not user or not security.verify_password(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
 
-    access_token = auth.create_access_token(data={"sub": user.username})
+    access_token = auth.create_access_token(data={"sub": user.username, "plant": user.plant_id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -65,6 +147,8 @@ def create_product(
     db.add(new_product)
     db.commit()
     db.refresh(new_product)
+    invalidation.publish(InvalidationEvent(EventKind.PRODUCT_CHANGED, [new_product.id], plant_id=plants.plant_of(db)))
+    audit.record("product.create", user, entity="product", entity_id=new_product.id, details=product.model_dump())
     return new_product
 
 
@@ -80,10 +164,13 @@ def update_product(
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
 
-    for key, value in product_update.model_dump(exclude_unset=True).items():
+    changes = product_update.model_dump(exclude_unset=True)
+    for key, value in changes.items():
         setattr(product, key, value)
 
     db.commit()
+    invalidation.publish(InvalidationEvent(EventKind.PRODUCT_CHANGED, [product_id], plant_id=plants.plant_of(db)))
+    audit.record("product.update", user, entity="product", entity_id=product_id, details=changes)
     db.refresh(product)
     return product
 
@@ -109,11 +196,36 @@ def delete_product(
     if active_orders > 0:
         raise HTTPException(status_code=400, detail="Cannot delete product: There are active orders linked to it.")
 
+    used_as_component = db.query(models.StageComponentRequirement.id).filter(
+        models.StageComponentRequirement.component_product_id == product_id
+    ).first()
+    if used_as_component is not None:
+        raise HTTPException(status_code=400, detail="Cannot delete product: It is a component of other products.")
+
+    product_name = product.name
     db.delete(product)
     db.commit()
+    invalidation.publish(InvalidationEvent(EventKind.PRODUCT_CHANGED, [product_id], plant_id=plants.plant_of(db)))
+    audit.record("product.delete", user, entity="product", entity_id=product_id, details={"name": product_name})
     return {"message": "Product deleted successfully"}
 
 
+@app.get("/products/{product_id}/bom", response_model=schemas.BomExplosion, tags=["Reference"])
+def explode_product(
+        product_id: int,
+        quantity: float = Query(1, gt=0),
+        db: Session = Depends(get_db),
+        user=Depends(auth.get_current_user)
+):
+    """
+    Разузлование изделия: сырье и минуты этапов на quantity штук с учетом полуфабрикатов.
+    Материалы полуфабрикатов списываются при выполнении их собственных заказов.
+    """
+    if db.get(models.Product, product_id) is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return bom.explode(db, product_id, quantity)
+
+
 # --- Управление Материалами (CRUD) ---
 @app.get("/materials/", response_model=List[schemas.MaterialOut], tags=["Reference"])
 def get_materials(db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
@@ -132,6 +244,8 @@ def create_material(
     db.add(new_material)
     db.commit()
     db.refresh(new_material)
+    invalidation.publish(InvalidationEvent(EventKind.MATERIAL_CHANGED, [new_material.id], plant_id=plants.plant_of(db)))
+    audit.record("material.create", user, entity="material", entity_id=new_material.id, details=material.model_dump())
     return new_material
 
 
@@ -147,25 +261,83 @@ def update_material(
     if not material:
         raise HTTPException(status_code=404, detail="Material not found")
 
-    for key, value in material_update.model_dump(exclude_unset=True).items():
+    changes = material_update.model_dump(exclude_unset=True)
+    for key, value in changes.items():
         setattr(material, key, value)
 
     db.commit()
+    invalidation.publish(InvalidationEvent(EventKind.MATERIAL_CHANGED, [material_id], plant_id=plants.plant_of(db)))
+    audit.record("material.update", user, entity="material", entity_id=material_id, details=changes)
     db.refresh(material)
     return material
 
 
+# --- Поиск по справочникам и заказам ---
+@app.get("/search", response_model=schemas.SearchResults, tags=["Reference"])
+def search_everything(
+        q: str = Query(..., min_length=2, max_length=100),
+        kinds: Optional[List[schemas.SearchKind]] = Query(None),
+        limit: int = Query(20, ge=1, le=100),
+        db: Session = Depends(get_db),
+        user=Depends(auth.get_current_user)
+):
+    """
+    Нечеткий поиск изделий (название, код), материалов, клиентов и заказов (по номеру).
+    Результаты ранжированы по оценке совпадения; kinds ограничивает виды.
+    """
+    return search.search(db, q, kinds, limit)
+
+
+# --- Импорт техкарт (CSV/XLSX) ---
+@app.post("/import/tech-cards", response_model=schemas.ImportReport, tags=["Reference"], dependencies=HEAVY)
+def import_tech_cards(
+        file: UploadFile = File(...),
+        dry_run: bool = False,
+        db: Session = Depends(get_db),
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST]))
+):
+    """
+    Потоковый импорт изделий, материалов, этапов техкарт и норм расхода из CSV/XLSX.
+    Все строки применяются одной транзакцией; ошибочные строки пропускаются и попадают в отчет.
+    При dry_run=true файл только проверяется, изменения откатываются.
+    """
+    report = tech_import.import_tech_cards(db, file.filename or "", file.file, dry_run=dry_run)
+    if report.committed and report.rows_imported:
+        invalidation.publish(
+            InvalidationEvent(EventKind.PRODUCT_CHANGED, plant_id=plants.plant_of(db)),
+            InvalidationEvent(EventKind.MATERIAL_CHANGED, plant_id=plants.plant_of(db)),
+            InvalidationEvent(EventKind.TECHCARD_CHANGED, plant_id=plants.plant_of(db)),
+        )
+        audit.record("techcards.import", user, details={
+            "filename": file.filename, **report.model_dump(exclude={"errors", "dry_run", "committed"})
+        })
+    return report
+
+
 # =======================================================
 #               III. УПРАВЛЕНИЕ ЗАКАЗАМИ (Диспетчер)
 # =======================================================
 
-@app.post("/orders/", response_model=schemas.OrderOut, tags=["Orders"])
+@app.post("/orders/", response_model=schemas.OrderOut, tags=["Orders"], dependencies=WRITE)
 def create_order(
         order_data: schemas.OrderCreate,
         db: Session = Depends(get_db),
-        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER])),
+        idem: idempotency.IdempotencyContext = Depends(idempotency.IdempotencyKey("orders.create"))
 ):
-    """Создает заказ и автоматически генерирует задачи по техкарте."""
+    """
+    Создает заказ и автоматически генерирует задачи по техкарте.
+    Повтор с тем же Idempotency-Key возвращает уже созданный заказ.
+    """
+    replay = idem.replay(db)
+    if replay is not None:
+        return replay
+
+    # Изделие должно быть видно сессии — то есть принадлежать заводу вызывающего
+    product = db.query(models.Product).filter(models.Product.id == order_data.product_id).first()
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+
     new_order = models.ProductionOrder(
         client_name=order_data.client_name,
         product_id=order_data.product_id,
@@ -175,11 +347,9 @@ def create_order(
         status=models.OrderStatus.NEW
     )
     db.add(new_order)
-    db.commit()
-    db.refresh(new_order)
+    db.flush()  # id заказа для задач; заказ и задачи коммитятся вместе
 
     # Генерация задач на основе техкарты
-    product = db.query(models.Product).filter(models.Product.id == order_data.product_id).first()
     for stage in product.tech_stages:
         task = models.ProductionTask(
             order_id=new_order.id,
@@ -188,27 +358,89 @@ def create_order(
         )
         db.add(task)
 
-    db.commit()
-    return new_order
+    db.flush()
+    order_id = new_order.id
+    body = schemas.OrderOut.model_validate(new_order, from_attributes=True).model_dump(mode="json")
+    response = idem.commit(db, body)
+    invalidation.publish(InvalidationEvent(EventKind.ORDER_CHANGED, [order_id], plant_id=plants.plant_of(db)))
+    if response is body:  # Иначе заказ создал параллельный повтор запроса
+        audit.record("order.create", user, order_id=order_id, details=order_data.model_dump(mode="json"))
+    return response
+
+
+# Колоночное представление списков (Accept: application/vnd.mes.columnar+json, см. encoding.py)
+ORDER_FIELDS = [Field("id", DELTA), Field("client_name", DICT), Field("product_id", DICT), Field("quantity"),
+                Field("status", DICT), Field("start_date")]
+
+
+@app.post("/orders/quote", response_model=schemas.OrderQuote, tags=["Orders"])
+def quote_order(
+        quote_data: schemas.OrderQuoteRequest,
+        db: Session = Depends(get_db),
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))
+):
+    """
+    Самый ранний срок выполнения заказа, если создать его сейчас, и что его ограничивает.
+    Заказ в БД не создается: он ставится в конец очереди проектного расписания в памяти (atp.py).
+    """
+    if quote_data.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+    if db.get(models.Product, quote_data.product_id) is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+    return atp.quote(db, quote_data.product_id, quote_data.quantity, quote_data.deadline_date)
 
 
 @app.get("/orders/", response_model=List[schemas.OrderOut], tags=["Orders"])
-def get_orders(db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
-    """Возвращает список всех заказов."""
-    return db.query(models.ProductionOrder).all()
+def get_orders(request: Request, db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
+    """Возвращает список всех заказов. Формат ответа выбирается по Accept."""
+    orders = db.query(models.ProductionOrder).order_by(models.ProductionOrder.id).all()
+    compact = encoding.negotiated_response(
+        request, (schemas.OrderOut.model_validate(order, from_attributes=True) for order in orders), ORDER_FIELDS
+    )
+    return compact if compact is not None else orders
+
+
+@app.get("/orders/at-risk", response_model=List[schemas.AtRiskOrder], tags=["Orders"])
+def get_orders_at_risk(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER])),
+        within_hours: float = Query(deadlines.DEADLINE_AT_RISK_HOURS, ge=0)
+):
+    """
+    Открытые заказы, у которых прогноз завершения ближе чем within_hours к дедлайну
+    (или уже позже него). Отсортированы по запасу: самые срочные первыми.
+    """
+    return deadlines.at_risk(db, within_hours)
 
 
 # =======================================================
 #              IV. ПРОИЗВОДСТВО И ЛОГИКА ОТК
 # =======================================================
 
+TASK_FIELDS = [Field("id", DELTA), Field("order_id", DELTA), Field("stage_name", DICT), Field("status", DICT),
+               Field("responsible_user_id", DICT), Field("responsible_username", DICT)]
+
+
 @app.get("/tasks/", response_model=List[schemas.TaskOut], tags=["Production"])
-def get_all_tasks(db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
-    """Возвращает список всех производственных задач (этапов)."""
-    return db.query(models.ProductionTask).all()
+def get_all_tasks(request: Request, db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
+    """Возвращает список всех производственных задач (этапов). Формат ответа выбирается по Accept."""
+    tasks = db.query(models.ProductionTask).options(
+        joinedload(models.ProductionTask.responsible_user)
+    ).order_by(models.ProductionTask.id).all()
+
+    # Добавляем имя ответственного для каждой задачи
+    tasks_out = []
+    for task in tasks:
+        task_out = schemas.TaskOut.model_validate(task)
+        if task.responsible_user:
+            task_out.responsible_username = task.responsible_user.username
+        tasks_out.append(task_out)
 
+    compact = encoding.negotiated_response(request, tasks_out, TASK_FIELDS)
+    return compact if compact is not None else tasks_out
 
-@app.put("/tasks/{task_id}/assign", response_model=schemas.TaskOut, tags=["Production"])
+
+@app.put("/tasks/{task_id}/assign", response_model=schemas.TaskOut, tags=["Production"], dependencies=WRITE)
 def assign_responsible_user(
         task_id: int,
         assignment_data: schemas.TaskAssign,
@@ -232,14 +464,20 @@ def assign_responsible_user(
         raise HTTPException(status_code=400, detail="Only users with the role 'OPERATOR' can be assigned to tasks.")
 
     task.responsible_user_id = assignment_data.responsible_user_id
+    task.assigned_at = datetime.now(UTC)
 
     # Если задача была "pending", ставим ее в "working" при назначении
     if task.status == "pending":
         task.status = "working"
-        task.start_time_actual = datetime.now(UTC)
+        task.start_time_actual = task.assigned_at
 
     db.commit()
     db.refresh(task)
+    invalidation.publish(InvalidationEvent(EventKind.TASK_CHANGED, [task_id], plant_id=plants.plant_of(db)))
+    audit.record("task.assign", user, order_id=task.order_id, task_id=task_id, details={
+        "responsible_user_id": responsible_user.id, "responsible_username": responsible_user.username,
+        "status": task.status,
+    })
 
     # Добавляем имя пользователя для вывода
     task_out = schemas.TaskOut.model_validate(task)
@@ -248,95 +486,229 @@ def assign_responsible_user(
     return task_out
 
 
-@app.get("/tasks/", response_model=List[schemas.TaskOut], tags=["Production"])
-def get_all_tasks(db: Session = Depends(get_db), user=Depends(auth.get_current_user)):
-    """Возвращает список всех производственных задач (этапов)."""
-    tasks = db.query(models.ProductionTask).all()
+@app.post("/tasks/auto-assign", response_model=schemas.AutoAssignResult, tags=["Production"], dependencies=HEAVY)
+def auto_assign_tasks(
+        dry_run: bool = False,
+        db: Session = Depends(get_db),
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))
+):
+    """
+    Распределяет все неназначенные задачи (pending) между операторами с учетом их очередей,
+    скорости на этапах и срочности заказов. Задачи встают в очереди операторов, не начинаясь.
+    При dry_run=true только показывает план.
+    """
+    result = autoassign.run(db, dry_run=dry_run)
+    if not dry_run and result.assignments:
+        invalidation.publish(InvalidationEvent(EventKind.TASK_CHANGED, [a.task_id for a in result.assignments],
+                                               plant_id=plants.plant_of(db)))
+        for a in result.assignments:
+            audit.record("task.assign", user, order_id=a.order_id, task_id=a.task_id, details={
+                "responsible_user_id": a.responsible_user_id, "responsible_username": a.responsible_username,
+                "status": "pending", "auto": True,
+            })
+    return result
+
+
+# Статусы задач, которые оператор видит в своей очереди
+ACTIVE_TASK_STATUSES = ["pending", "working", "rework_needed"]
+
+
+@app.get("/tasks/my-queue", response_model=List[schemas.OperatorQueueItem], tags=["Production"])
+def get_my_work_queue(db: Session = Depends(get_db), user: models.User = Depends(auth.get_current_user)):
+    """
+    Очередь оператора: его активные задачи вместе с заказом, изделием и нормами материалов.
+    Один запрос к БД по индексу (responsible_user_id, status).
+    """
+    rows = db.query(
+        models.ProductionTask.id,
+        models.ProductionTask.status,
+        models.ProductionTask.stage_name,
+        models.ProductionTask.start_time_actual,
+        models.ProductionOrder.id,
+        models.ProductionOrder.client_name,
+        models.ProductionOrder.quantity,
+        models.ProductionOrder.deadline_date,
+        models.Product.id,
+        models.Product.name,
+        models.Product.code,
+        models.TechStage.order_in_chain,
+        models.TechStage.norm_time_minutes,
+        models.Material.id,
+        models.Material.name,
+        models.Material.unit,
+        models.Material.quantity_in_stock,
+        models.StageMaterialRequirement.quantity_needed,
+    ).join(
+        models.ProductionOrder, models.ProductionTask.order_id == models.ProductionOrder.id
+    ).join(
+        models.Product, models.ProductionOrder.product_id == models.Product.id
+    ).outerjoin(
+        models.TechStage, and_(models.TechStage.product_id == models.Product.id,
+                               models.TechStage.name == models.ProductionTask.stage_name)
+    ).outerjoin(
+        models.StageMaterialRequirement, models.StageMaterialRequirement.tech_stage_id == models.TechStage.id
+    ).outerjoin(
+        models.Material, models.StageMaterialRequirement.material_id == models.Material.id
+    ).filter(
+        models.ProductionTask.responsible_user_id == user.id,
+        models.ProductionTask.status.in_(ACTIVE_TASK_STATUSES)
+    ).order_by(
+        models.ProductionOrder.deadline_date, models.ProductionTask.id
+    ).all()
+
+    # Строки "задача x материал" сворачиваем в задачи с вложенным списком материалов
+    queue = {}
+    for (task_id, task_status, stage_name, started, order_id, client_name, order_qty, deadline,
+         product_id, product_name, product_code, order_in_chain, norm_time,
+         material_id, material_name, unit, stock, quantity_needed) in rows:
+        item = queue.get(task_id)
+        if item is None:
+            item = queue[task_id] = schemas.OperatorQueueItem(
+                task_id=task_id,
+                status=task_status,
+                stage_name=stage_name,
+                order_id=order_id,
+                client_name=client_name,
+                order_quantity=order_qty,
+                deadline_date=deadline,
+                product_id=product_id,
+                product_name=product_name,
+                product_code=product_code,
+                order_in_chain=order_in_chain,
+                norm_time_minutes=norm_time,
+                start_time_actual=started,
+            )
+        if material_id is not None:
+            item.materials.append(schemas.QueueMaterial(
+                material_id=material_id,
+                material_name=material_name,
+                unit=unit,
+                quantity_required=round(quantity_needed * order_qty, 2),
+                stock_available=round(stock, 2),
+            ))
+
+    return list(queue.values())
 
-    # Добавляем имя ответственного для каждой задачи
-    tasks_out = []
-    for task in tasks:
-        task_out = schemas.TaskOut.model_validate(task)
-        if task.responsible_user:
-            task_out.responsible_username = task.responsible_user.username
-        tasks_out.append(task_out)
 
-    return tasks_out
+def _audit_completion(user: models.User, order_id: int, task_id: int, result: dict, comment: Optional[str],
+                      batch: bool = False):
+    """Сдача партии в журнал: с браком — task.rework (с комментарием ОТК), без — task.complete."""
+    audit.record("task.rework" if result["defective_quantity"] else "task.complete", user,
+                 order_id=order_id, task_id=task_id, details={
+                     "good_quantity": result["good_quantity"], "defective_quantity": result["defective_quantity"],
+                     "status": result["status"], "comment": comment, "logs": result["logs"], "batch": batch,
+                 })
 
 
 # --- Task Completion/Rework Logic (TaskCompleteData должна быть в schemas.py) ---
-@app.post("/tasks/{task_id}/complete", tags=["Production"])
+@app.post("/tasks/{task_id}/complete", tags=["Production"], dependencies=WRITE)
 def complete_task(
         task_id: int,
         complete_data: schemas.TaskCompleteData,
         db: Session = Depends(get_db),
-        user: models.User = Depends(auth.RoleChecker([models.UserRole.OPERATOR, models.UserRole.DISPATCHER]))
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.OPERATOR, models.UserRole.DISPATCHER])),
+        idem: idempotency.IdempotencyContext = Depends(idempotency.IdempotencyKey("tasks.complete"))
 ):
     """
     Завершение задачи с проверкой ОТК и логикой Rework.
+    Повтор с тем же Idempotency-Key возвращает первый результат без повторного списания.
     """
+    replay = idem.replay(db)
+    if replay is not None:
+        return replay
+
     task = db.query(models.ProductionTask).filter(models.ProductionTask.id == task_id).first()
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    order_qty = task.order.quantity
     defective_qty = complete_data.defective_quantity
 
-    if task.status == "done" or task.status == "rework_needed":
+    if task.status in completion.CLOSED_TASK_STATUSES:
         return {"msg": f"Task status is already {task.status}"}
 
-    if defective_qty > order_qty:
-        raise HTTPException(status_code=400, detail="Количество брака не может превышать количество в партии.")
+    stage = completion.find_stage(db, task)
+    try:
+        completion.validate(task, defective_qty)
+        completion.check_stock(stage, task.order.quantity)
+    except completion.CompletionError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = completion.apply_completion(db, task, stage, defective_qty, complete_data.comment, user)
+
+    # day заполнен только для завершенных задач: в отчет по материалам попадают лишь они
+    completion_day = task.end_time_actual.date().isoformat() if task.status == "done" else None
+    deducted_material_ids = [req.material_id for req in stage.requirements] if stage else []
+    order_id = task.order_id
+
+    response = idem.commit(db, result)
+    invalidation.publish(
+        InvalidationEvent(EventKind.TASK_COMPLETED, [task_id], completion_day, plant_id=plants.plant_of(db)),
+        InvalidationEvent(EventKind.STOCK_CHANGED, deducted_material_ids, plant_id=plants.plant_of(db)),
+    )
+    if response is result:
+        _audit_completion(user, order_id, task_id, result, complete_data.comment)
 
-    good_qty = order_qty - defective_qty
-    logs = []
+    return response
 
-    # --- 1. ЛОГИКА СПИСАНИЯ ---
-    stage = db.query(models.TechStage).join(models.Product).filter(
-        models.TechStage.name == task.stage_name,
-        models.Product.id == task.order.product_id
-    ).first()
 
-    if stage:
-        for req in stage.requirements:
-            total_needed = req.quantity_needed * order_qty
-
-            # Проверка остатков
-            if req.material.quantity_in_stock < total_needed:
-                raise HTTPException(status_code=400,
-                                    detail=f"Недостаточно {req.material.name}. Нужно {total_needed}, есть {req.material.quantity_in_stock}")
-
-            # Списание
-            req.material.quantity_in_stock -= total_needed
-            db.add(req.material)
-            logs.append(f"Списано {total_needed} {req.material.unit} {req.material.name}")
-
-    # --- 2. ЛОГИКА ОТК И ПЕРЕДЕЛКИ (REWORK) ---
-    if defective_qty > 0:
-        task.status = "rework_needed"
-        task.order.status = models.OrderStatus.DELAYED  # Ставим задержку
-
-        # Комментарий для ответственного за партию
-        rework_comment = (
-            f"БРАК: {defective_qty} шт. Ответственный: {user.username}. "
-            f"Комментарий ОТК: {complete_data.comment or 'Нет'}. Партия отправлена на повторный цикл."
-        )
-        logs.append(rework_comment)
+@app.post("/tasks/complete-batch", response_model=schemas.BatchCompleteResult, tags=["Production"], dependencies=WRITE)
+def complete_tasks_batch(
+        batch: schemas.BatchCompleteRequest,
+        db: Session = Depends(get_db),
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.OPERATOR, models.UserRole.DISPATCHER])),
+        idem: idempotency.IdempotencyContext = Depends(idempotency.IdempotencyKey("tasks.complete-batch"))
+):
+    """
+    Пакетное завершение задач (сканирование партий в конце смены).
+    Задачи, этапы и материалы загружаются пакетно, остатки блокируются, коммит один.
+    partial=true — отклоняются только позиции с ошибками (например, нехватка материала);
+    partial=false — при любой ошибке не применяется ни одна позиция.
+    Результат закоммиченного пакета сохраняется по Idempotency-Key.
+    """
+    replay = idem.replay(db)
+    if replay is not None:
+        return replay
+
+    results, completed_tasks, material_ids = completion.complete_batch(db, batch.items, user, partial=batch.partial)
+    response = schemas.BatchCompleteResult(
+        committed=bool(completed_tasks),
+        completed=len(completed_tasks),
+        rejected=len(results) - len(completed_tasks),
+        results=results,
+    )
 
-    else:
-        # Если брака нет, этап завершен
-        task.status = "done"
-        task.end_time_actual = datetime.now(UTC)  # Фиксируем время завершения
+    if not completed_tasks:
+        # Ничего не применено — ответ не сохраняем, повтор выполнится заново
+        db.rollback()
+        return response
 
-    db.commit()
-    return {"status": task.status, "good_quantity": good_qty, "defective_quantity": defective_qty, "logs": logs}
+    events = [
+        InvalidationEvent(EventKind.TASK_COMPLETED, [task.id],
+                          task.end_time_actual.date().isoformat() if task.status == "done" else None,
+                          plant_id=plants.plant_of(db))
+        for task in completed_tasks
+    ]
+    events.append(InvalidationEvent(EventKind.STOCK_CHANGED, material_ids, plant_id=plants.plant_of(db)))
+    order_ids = {task.id: task.order_id for task in completed_tasks}
+    comments = {item.task_id: item.comment for item in batch.items}
+
+    body = response.model_dump(mode="json")
+    response = idem.commit(db, body)
+    invalidation.publish(*events)
+    if response is body:
+        for result in body["results"]:
+            if result["ok"]:
+                _audit_completion(user, order_ids[result["task_id"]], result["task_id"], result,
+                                  comments.get(result["task_id"]), batch=True)
+    return response
 
 
 # =======================================================
 #               V. АНАЛИТИКА И ОТЧЕТНОСТЬ
 # =======================================================
 
-@app.get("/reports/materials-by-stage", tags=["Analytics"], response_model=List[schemas.MaterialReportRow])
+@app.get("/reports/materials-by-stage", tags=["Analytics"], response_model=List[schemas.MaterialReportRow],
+         dependencies=HEAVY)
 def get_materials_report(
         db: Session = Depends(get_db),
         user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST])),
@@ -347,46 +719,10 @@ def get_materials_report(
     Генерирует отчет об использованных материалах (для отображения на фронте).
     Фильтрация по дате завершения.
     """
+    return reports.get_materials_report_cached(db, start_date=start_date, end_date=end_date)
 
-    query = db.query(models.ProductionTask).filter(models.ProductionTask.status == 'done')
 
-    if start_date:
-        query = query.filter(models.ProductionTask.end_time_actual >= start_date)
-    if end_date:
-        # Учитываем весь день end_date
-        next_day = end_date + timedelta(days=1)
-        query = query.filter(models.ProductionTask.end_time_actual < next_day)
-
-    completed_tasks = query.all()
-
-    report_data = []
-
-    for task in completed_tasks:
-        stage = db.query(models.TechStage).join(models.Product).filter(
-            models.TechStage.name == task.stage_name,
-            models.Product.id == task.order.product_id
-        ).first()
-
-        if stage and task.order and task.order.product:
-            order_qty = task.order.quantity
-
-            for req in stage.requirements:
-                total_spent = req.quantity_needed * order_qty
-
-                report_data.append(schemas.MaterialReportRow(
-                    order_id=task.order_id,
-                    product_name=task.order.product.name,
-                    stage_name=task.stage_name,
-                    material_name=req.material.name,
-                    unit=req.material.unit,
-                    quantity_spent=round(total_spent, 2),
-                    completion_date=task.end_time_actual
-                ))
-
-    return report_data
-
-
-@app.get("/reports/materials-by-stage/export", tags=["Analytics"])
+@app.get("/reports/materials-by-stage/export", tags=["Analytics"], dependencies=HEAVY)
 def export_materials_report(
         db: Session = Depends(get_db),
         user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST])),
@@ -400,45 +736,91 @@ def export_materials_report(
     # Получаем отфильтрованные данные
     report_data_list = get_materials_report(db=db, user=user, start_date=start_date, end_date=end_date)
 
-    header = [
-        "ID Заказа", "Изделие", "Этап", "Материал", "Ед. изм.",
-        "Кол-во потрачено", "Дата завершения"
-    ]
-
-    def generate():
-        # Первая строка - заголовки
-        yield ";".join(header) + "\n"
-        for row in report_data_list:
-            date_str = row.completion_date.strftime("%Y-%m-%d %H:%M") if row.completion_date else ""
-
-            # Собираем строку CSV, заменяем точку на запятую для корректной работы в русской версии Excel
-            csv_row = [
-                str(row.order_id),
-                row.product_name,
-                row.stage_name,
-                row.material_name,
-                row.unit,
-                str(row.quantity_spent).replace('.', ','),
-                date_str
-            ]
-            yield ";".join(csv_row) + "\n"
-
     # Отдаем файл как StreamingResponse
     return StreamingResponse(
-        generate(),
+        reports.iter_materials_csv(report_data_list),
         media_type="text/csv",
         headers={"Content-Disposition": "attachment; filename=material_report.csv"}
     )
 
 
+# --- Фоновые отчеты (для больших периодов) ---
+
+def _report_job_out(job: models.ReportJob) -> schemas.ReportJobOut:
+    job_out = schemas.ReportJobOut.model_validate(job)
+    if job.status == "done":
+        job_out.download_url = f"/reports/jobs/{job.id}/download"
+    return job_out
+
+
+@app.post("/reports/jobs", response_model=schemas.ReportJobOut, status_code=status.HTTP_202_ACCEPTED,
+          tags=["Analytics"])
+def submit_report_job(
+        job_data: schemas.ReportJobCreate,
+        db: Session = Depends(get_db),
+        user: models.User = Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST]))
+):
+    """
+    Ставит отчет в фоновую очередь. Если такой же отчет по тем же данным уже построен
+    или строится, возвращается существующее задание.
+    """
+    if job_data.report_type not in jobs.REPORT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown report type: {job_data.report_type}")
+
+    params = job_data.model_dump(mode="json", exclude={"report_type"})
+    job = jobs.submit(db, job_data.report_type, params, user)
+    audit.record("report_job.submit", user, entity="report_job", entity_id=job.id,
+                 details={"report_type": job_data.report_type, **params})
+    return _report_job_out(job)
+
+
+@app.get("/reports/jobs/{job_id}", response_model=schemas.ReportJobOut, tags=["Analytics"])
+def get_report_job(
+        job_id: int,
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST]))
+):
+    """Статус фонового отчета."""
+    job = db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    return _report_job_out(job)
+
+
+@app.get("/reports/jobs/{job_id}/download", tags=["Analytics"])
+def download_report_job(
+        job_id: int,
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST]))
+):
+    """Скачивание готового файла отчета."""
+    job = db.query(models.ReportJob).filter(models.ReportJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Report job not found")
+    if job.status != "done" or not job.file_path:
+        raise HTTPException(status_code=409, detail=f"Report job is {job.status}")
+
+    return FileResponse(job.file_path, media_type=jobs.media_type(job),
+                        filename=os.path.basename(job.file_path))
+
+
 # --- ГАНТ (Использует логику, внедренную ранее) ---
 
-@app.get("/gantt", response_model=schemas.GanttData, tags=["Analytics"])
-def get_gantt_data(db: Session = Depends(get_db)):
+GANTT_FIELDS = [Field("id", DELTA), Field("text", DICT), Field("start_date", MINUTES_DELTA), Field("duration"),
+                Field("progress"), Field("parent", DICT)]
+
+
+@app.get("/gantt", response_model=schemas.GanttData, tags=["Analytics"], dependencies=HEAVY)
+def get_gantt_data(request: Request, db: Session = Depends(get_db)):
     """
     Генерирует данные для визуализации на диаграмме Ганта с прогнозированием длительности этапов.
+    Формат ответа выбирается по Accept: JSON, колоночный JSON или MessagePack (см. encoding.py).
     """
-    orders = db.query(models.ProductionOrder).all()
+    # Заказы с изделием и задачами, этапы всех изделий — постоянное число запросов
+    orders = db.query(models.ProductionOrder).options(
+        joinedload(models.ProductionOrder.product), selectinload(models.ProductionOrder.tasks)
+    ).all()
+    stages_by_product = deadlines.load_stages(db, [order.product_id for order in orders])
     gantt_tasks = []
     task_id_counter = 1000
 
@@ -449,10 +831,8 @@ def get_gantt_data(db: Session = Depends(get_db)):
         total_progress_minutes = 0
         completed_minutes = 0
 
-        tech_stages = db.query(models.TechStage).filter(models.TechStage.product_id == order.product_id).order_by(
-            models.TechStage.order_in_chain).all()
-        actual_tasks = db.query(models.ProductionTask).filter(models.ProductionTask.order_id == order.id).all()
-        actual_tasks_map = {task.stage_name: task for task in actual_tasks}
+        tech_stages = stages_by_product.get(order.product_id, [])
+        actual_tasks_map = {task.stage_name: task for task in order.tasks}
 
         for stage in tech_stages:
             task_id_counter += 1
@@ -496,10 +876,91 @@ def get_gantt_data(db: Session = Depends(get_db)):
             parent=0
         ))
 
-    return {"data": gantt_tasks}
+    compact = encoding.negotiated_response(request, gantt_tasks, GANTT_FIELDS, envelope="data")
+    return compact if compact is not None else {"data": gantt_tasks}
+
+
+@app.get("/analytics/stage-throughput", response_model=List[schemas.StageThroughputRow], tags=["Analytics"],
+         dependencies=HEAVY)
+def get_stage_throughput(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST])),
+        group_by: List[str] = Query(["stage_name"]),
+        start_date: date = None,
+        end_date: date = None,
+        stage_name: Optional[str] = None,
+        product_id: Optional[int] = None,
+        operator_id: Optional[int] = None
+):
+    """
+    Пропускная способность и длительность этапов по предагрегатам:
+    количество, средняя/перцентильная длительность и отношение факта к норме.
+    group_by: любые из day, stage_name, product_id, operator_id.
+    """
+    unknown = set(group_by) - set(rollups.GROUP_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown group_by fields: {', '.join(sorted(unknown))}")
+
+    return rollups.query_throughput(db, group_by, start_date=start_date, end_date=end_date,
+                                    stage_name=stage_name, product_id=product_id, operator_id=operator_id)
+
+
+@app.post("/analytics/stage-throughput/rebuild", tags=["Analytics"], dependencies=HEAVY)
+def rebuild_stage_throughput(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER]))
+):
+    """Полный пересчет агрегатов по истории задач (после импорта или сида)."""
+    tasks_processed = rollups.rebuild(db)
+    audit.record("analytics.rebuild", user, details={"tasks_processed": tasks_processed})
+    return {"tasks_processed": tasks_processed}
+
+
+@app.get("/analytics/quality", response_model=List[schemas.QualityStatsRow], tags=["Analytics"], dependencies=HEAVY)
+def get_quality_stats(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST])),
+        group_by: List[str] = Query(["stage_name"]),
+        start_date: date = None,
+        end_date: date = None,
+        stage_name: Optional[str] = None,
+        product_id: Optional[int] = None,
+        operator_id: Optional[int] = None
+):
+    """
+    Доля брака и переделок по предагрегатам ОТК.
+    group_by: любые из day, stage_name, product_id, operator_id.
+    """
+    unknown = set(group_by) - set(quality.GROUP_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown group_by fields: {', '.join(sorted(unknown))}")
+
+    return quality.query_quality(db, group_by, start_date=start_date, end_date=end_date,
+                                 stage_name=stage_name, product_id=product_id, operator_id=operator_id)
+
+
+@app.get("/analytics/quality/events", response_model=List[schemas.QualityEventOut], tags=["Analytics"],
+         dependencies=HEAVY)
+def get_quality_events(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST])),
+        order_id: Optional[int] = None,
+        task_id: Optional[int] = None,
+        product_id: Optional[int] = None,
+        stage_name: Optional[str] = None,
+        only_rework: bool = False,
+        start_date: date = None,
+        end_date: date = None,
+        limit: int = Query(100, le=1000)
+):
+    """История ОТК: результаты сдачи партий, включая комментарии к переделкам."""
+    return quality.query_events(db, order_id=order_id, task_id=task_id, product_id=product_id,
+                                stage_name=stage_name, only_rework=only_rework,
+                                start_date=start_date, end_date=end_date, limit=limit)
 
 
-@app.get("/analytics/inventory-check", response_model=List[schemas.AvailabilityCheckItem], tags=["Analytics"])
+@app.get("/analytics/inventory-check", response_model=List[schemas.AvailabilityCheckItem], tags=["Analytics"],
+         dependencies=HEAVY)
 def check_inventory_availability(
         db: Session = Depends(get_db),
         user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER, models.UserRole.TECHNOLOGIST]))
@@ -551,4 +1012,57 @@ def check_inventory_availability(
             deficit_amount=round(deficit_amount, 2)
         ))
 
-    return report
\ No newline at end of file
+    return report
+
+
+# =======================================================
+#               VI. ЖУРНАЛ ДЕЙСТВИЙ
+# =======================================================
+
+@app.get("/audit/events", response_model=List[schemas.AuditEventOut], tags=["Audit"])
+def get_audit_events(
+        db: Session = Depends(get_db),
+        user=Depends(auth.RoleChecker([models.UserRole.DISPATCHER])),
+        order_id: Optional[int] = None,
+        task_id: Optional[int] = None,
+        user_id: Optional[int] = None,
+        action: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        before_id: Optional[int] = None,
+        limit: int = Query(100, ge=1, le=audit.MAX_QUERY_LIMIT)
+):
+    """
+    Кто что назначил, завершил, забраковал или изменил — от новых событий к старым.
+    Следующая страница: тот же запрос с end = created_at и before_id = id последнего события.
+    """
+    return audit.query_events(db, order_id=order_id, task_id=task_id, user_id=user_id, action=action,
+                              start=start, end=end, before_id=before_id, limit=limit)
+
+
+# =======================================================
+#               VII. СИНХРОНИЗАЦИЯ ТЕРМИНАЛОВ
+# =======================================================
+
+@app.get("/sync/changes", response_model=schemas.SyncChanges, tags=["Sync"])
+def get_sync_changes(
+        db: Session = Depends(get_db),
+        user=Depends(auth.get_current_user),
+        since: int = Query(0, ge=0),
+        limit: int = Query(sync.SYNC_PAGE_LIMIT, ge=1, le=sync.SYNC_PAGE_LIMIT),
+        after_entity: Optional[schemas.SyncEntity] = None,
+        after_id: Optional[int] = None
+):
+    """
+    Задачи, заказы и материалы, измененные после версии since, и id удаленных строк.
+    since=0 — полная загрузка. В следующий раз передать since=version из ответа
+    (и after_entity/after_id, если они есть); при has_more=true — сразу.
+    410 — версия клиента устарела, нужна полная загрузка.
+    """
+    if (after_entity is None) != (after_id is None):
+        raise HTTPException(status_code=422, detail="after_entity and after_id go together")
+    after = (after_entity, after_id) if after_entity is not None else None
+    try:
+        return sync.changes(db, since=since, limit=limit, after=after)
+    except sync.ResyncRequired:
+        raise HTTPException(status_code=410, detail="Sync version is too old, download everything with since=0")
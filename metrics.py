@@ -0,0 +1,236 @@
+"""
+Метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей.
+
+- по маршрутам: количество запросов, гистограмма латентности, запросы "в полете";
+- по запросу: количество SQL-выражений и время в БД (через события движка SQLAlchemy);
+- состояние пула соединений database.engine.
+"""
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SQL_TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class RequestSqlStats:
+    """Счетчики SQL одного HTTP-запроса."""
+    __slots__ = ("statements", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+# Статистика текущего запроса. Starlette копирует контекст в пул потоков,
+# поэтому синхронные эндпоинты пишут в тот же объект.
+current_sql_stats: ContextVar[Optional[RequestSqlStats]] = ContextVar("current_sql_stats", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.sql_count: Dict[Tuple[str, str], Histogram] = {}
+        self.sql_time: Dict[Tuple[str, str], Histogram] = {}
+        self.in_flight: Dict[Tuple[str, str], int] = {}
+        self.sql_statements_total = 0
+        self.sql_seconds_total = 0.0
+
+    def request_started(self, method: str, route: str):
+        key = (method, route)
+        with self.lock:
+            self.in_flight[key] = self.in_flight.get(key, 0) + 1
+
+    def request_finished(self, method: str, route: str, status_code: int, seconds: float, sql: RequestSqlStats):
+        key = (method, route)
+        with self.lock:
+            self.in_flight[key] -= 1
+            status_key = (method, route, str(status_code))
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.sql_count.setdefault(key, Histogram(SQL_COUNT_BUCKETS)).observe(sql.statements)
+            self.sql_time.setdefault(key, Histogram(SQL_TIME_BUCKETS)).observe(sql.seconds)
+
+    def sql_executed(self, seconds: float):
+        with self.lock:
+            self.sql_statements_total += 1
+            self.sql_seconds_total += seconds
+
+
+registry = Registry()
+
+
+# --- SQLALCHEMY ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["metrics_query_start"].pop()
+    elapsed = time.perf_counter() - started
+    registry.sql_executed(elapsed)
+
+    stats = current_sql_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.seconds += elapsed
+
+
+def _handle_error(context):
+    # after_cursor_execute не вызывается при ошибке — снимаем отметку времени вручную
+    conn = context.connection
+    if conn is not None and conn.info.get("metrics_query_start"):
+        conn.info["metrics_query_start"].pop()
+
+
+def instrument_engine(engine):
+    """Подписывается на события движка. Повторный вызов для того же движка безопасен."""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+# --- ASGI MIDDLEWARE ---
+
+def _route_path(scope) -> str:
+    """Шаблон маршрута до вызова приложения — тем же сопоставлением, что и роутер Starlette."""
+    app = scope.get("app")
+    partial = None
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", None) or "<unmatched>"
+        if match == Match.PARTIAL and partial is None:
+            partial = route  # Путь совпал, метод нет — роутер ответит 405 этим маршрутом
+    # Неизвестные пути сводим в одну метку, чтобы не раздувать кардинальность
+    return getattr(partial, "path", None) or "<unmatched>"
+
+
+class MetricsMiddleware:
+    """Считает латентность и SQL по шаблону маршрута (например, /tasks/{task_id}/complete)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_holder = {"code": 500}
+        stats = RequestSqlStats()
+        token = current_sql_stats.set(stats)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["code"] = message["status"]
+            await send(message)
+
+        # Маршрут нужен уже для счетчика "в полете", поэтому определяется до обработки запроса
+        route_path = _route_path(scope)
+        registry.request_started(method, route_path)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_sql_stats.reset(token)
+            registry.request_finished(method, route_path, status_holder["code"], elapsed, stats)
+
+
+# --- ЭКСПОРТ ---
+
+def format_labels(**labels) -> str:
+    """Метки в синтаксисе Prometheus: {key="value",...} с экранированием значений."""
+    parts = []
+    for key, value in labels.items():
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _render_histogram(lines, name: str, help_text: str, histograms: Dict[Tuple[str, str], Histogram]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for (method, route), hist in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(hist.buckets, hist.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{format_labels(method=method, route=route, le=bound)} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels(method=method, route=route, le='+Inf')} {hist.count}")
+        lines.append(f"{name}_sum{format_labels(method=method, route=route)} {hist.total}")
+        lines.append(f"{name}_count{format_labels(method=method, route=route)} {hist.count}")
+
+
+def _render_pool(lines, engine):
+    pool = engine.pool
+    gauges = {
+        "db_pool_size": ("Размер пула соединений", "size"),
+        "db_pool_checked_out": ("Соединения, выданные запросам", "checkedout"),
+        "db_pool_checked_in": ("Свободные соединения в пуле", "checkedin"),
+        "db_pool_overflow": ("Соединения сверх размера пула", "overflow"),
+    }
+    for name, (help_text, method) in gauges.items():
+        getter = getattr(pool, method, None)
+        if getter is None:  # Например, StaticPool/NullPool
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {getter()}")
+
+
+def render(engine=None) -> str:
+    lines = []
+    with registry.lock:
+        lines.append("# HELP http_requests_total Количество HTTP-запросов")
+        lines.append("# TYPE http_requests_total counter")
+        for (method, route, code), value in sorted(registry.requests.items()):
+            lines.append(f"http_requests_total{format_labels(method=method, route=route, status=code)} {value}")
+
+        lines.append("# HELP http_requests_in_flight Запросы в обработке")
+        lines.append("# TYPE http_requests_in_flight gauge")
+        for (method, route), value in sorted(registry.in_flight.items()):
+            lines.append(f"http_requests_in_flight{format_labels(method=method, route=route)} {value}")
+
+        _render_histogram(lines, "http_request_duration_seconds", "Латентность запроса", registry.latency)
+        _render_histogram(lines, "db_statements_per_request", "SQL-выражений на запрос", registry.sql_count)
+        _render_histogram(lines, "db_time_per_request_seconds", "Время в БД на запрос", registry.sql_time)
+
+        lines.append("# HELP db_statements_total Всего выполнено SQL-выражений")
+        lines.append("# TYPE db_statements_total counter")
+        lines.append(f"db_statements_total {registry.sql_statements_total}")
+        lines.append("# HELP db_statement_seconds_total Суммарное время SQL-выражений")
+        lines.append("# TYPE db_statement_seconds_total counter")
+        lines.append(f"db_statement_seconds_total {registry.sql_seconds_total}")
+
+    if engine is not None:
+        _render_pool(lines, engine)
+    return "\n".join(lines) + "\n"
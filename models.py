@@ -1,11 +1,34 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Enum, Boolean
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Enum, Boolean, Index, Date, JSON, \
+    UniqueConstraint, BigInteger, DDL, event
+from sqlalchemy.orm import relationship, declared_attr
 from sqlalchemy.ext.declarative import declarative_base
 import enum
 from datetime import datetime
 
 Base = declarative_base()
 
+# Триграммные индексы поиска (search.py) — только в PostgreSQL, расширение pg_trgm
+event.listen(Base.metadata, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"))
+
+
+def trigram_index(name: str, column: str) -> Index:
+    """GIN-индекс для ILIKE '%...%' и word_similarity по колонке; в других СУБД не создается."""
+    return Index(name, column, postgresql_using="gin",
+                 postgresql_ops={column: "gin_trgm_ops"}).ddl_if(dialect="postgresql")
+
+
+class PlantScoped:
+    """
+    Данные завода. Запросы сессии завода автоматически фильтруются по plant_id,
+    новым строкам он проставляется при flush (см. plants.py).
+    Модель может переопределить колонку (другие индексы, nullable).
+    """
+
+    @declared_attr
+    def plant_id(cls):
+        return Column(Integer, ForeignKey("plants.id"), nullable=False, index=True)
+
 
 # --- ENUMS (Статусы) ---
 class OrderStatus(enum.Enum):
@@ -15,6 +38,16 @@ class OrderStatus(enum.Enum):
     DELAYED = "delayed"
 
 
+# --- ЗАВОДЫ ---
+
+class Plant(Base):  # Площадка; данные завода могут жить в отдельной БД (database.PLANT_DATABASES)
+    __tablename__ = "plants"
+    id = Column(Integer, primary_key=True)
+    code = Column(String, unique=True)
+    name = Column(String)
+    reference_version = Column(BigInteger, default=0, nullable=False)  # Счетчик правок справочников (reports.py)
+
+
 # --- СПРАВОЧНИКИ (Task 3.1) --- [cite: 11]
 
 class UserRole(enum.Enum):
@@ -24,7 +57,7 @@ class UserRole(enum.Enum):
 
 
 # 2. Обновляем модель пользователя
-class User(Base):
+class User(PlantScoped, Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True, index=True)
@@ -41,22 +74,33 @@ class User(Base):
     is_active = Column(Boolean, default=True)
 
 
-class Product(Base):  # Изделия
+class Product(PlantScoped, Base):  # Изделия
     __tablename__ = "products"
+    __table_args__ = (
+        UniqueConstraint("plant_id", "code", name="uq_products_plant_code"),  # Код уникален в пределах завода
+        trigram_index("ix_products_name_trgm", "name"),
+        trigram_index("ix_products_code_trgm", "code"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, index=True)
-    code = Column(String, unique=True)
+    code = Column(String)
     description = Column(String)
     # Связь с техкартой (один ко многим этапам)
     tech_stages = relationship("TechStage", back_populates="product")
 
 
-class Material(Base):  # Материалы
+class Material(PlantScoped, Base):  # Материалы
     __tablename__ = "materials"
+    __table_args__ = (
+        Index("ix_materials_plant_name", "plant_id", "name"),
+        trigram_index("ix_materials_name_trgm", "name"),
+    )
     id = Column(Integer, primary_key=True, index=True)
+    plant_id = Column(Integer, ForeignKey("plants.id"), nullable=False)
     name = Column(String)
     unit = Column(String)  # шт, кг, м
     quantity_in_stock = Column(Float, default=0.0)  # Остаток на складе
+    row_version = Column(BigInteger, default=0, nullable=False, index=True)  # Версия для /sync/changes (sync.py)
 
 
 # --- ТЕХНОЛОГИЯ ---
@@ -71,6 +115,7 @@ class TechStage(Base):  # Этапы производства для издел
 
     product = relationship("Product", back_populates="tech_stages")
     requirements = relationship("StageMaterialRequirement", back_populates="stage")
+    components = relationship("StageComponentRequirement", back_populates="stage")
 
 
 class StageMaterialRequirement(Base):  # Сколько материалов нужно на этап
@@ -84,21 +129,40 @@ class StageMaterialRequirement(Base):  # Сколько материалов н
     material = relationship("Material")
 
 
+class StageComponentRequirement(Base):  # Полуфабрикат (другое изделие) на входе этапа: вал, рама
+    __tablename__ = "stage_component_requirements"
+    id = Column(Integer, primary_key=True, index=True)
+    tech_stage_id = Column(Integer, ForeignKey("tech_stages.id"), index=True)
+    component_product_id = Column(Integer, ForeignKey("products.id"), index=True)
+    quantity_needed = Column(Float)  # Штук полуфабриката на единицу изделия
+
+    stage = relationship("TechStage", back_populates="components")
+    component = relationship("Product")
+
+
 # --- ПРОИЗВОДСТВО (Task 3.2) --- [cite: 14]
 
-class ProductionTask(Base):
+class ProductionTask(PlantScoped, Base):  # Конкретная задача в рамках заказа (на основе TechStage)
     __tablename__ = "production_tasks"
+    __table_args__ = (
+        # Очередь оператора: WHERE responsible_user_id = ? AND status IN (...)
+        Index("ix_production_tasks_responsible_status", "responsible_user_id", "status"),
+        Index("ix_production_tasks_plant_status", "plant_id", "status"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("production_orders.id"))
-    stage_name = Column(String)
-    status = Column(String, default="pending")
+    plant_id = Column(Integer, ForeignKey("plants.id"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id"))
+    stage_name = Column(String)  # Копируем имя из TechStage
+    status = Column(String, default="pending")  # pending, working, done, rework_needed
 
     # --- НОВОЕ ПОЛЕ: ОТВЕТСТВЕННОЕ ЛИЦО ---
     responsible_user_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    assigned_at = Column(DateTime(timezone=True), nullable=True)  # Когда назначен ответственный (в т.ч. автоназначением)
 
     start_time_actual = Column(DateTime(timezone=True), nullable=True)
     end_time_actual = Column(DateTime(timezone=True), nullable=True)
+    row_version = Column(BigInteger, default=0, nullable=False, index=True)  # Версия для /sync/changes (sync.py)
 
     # Связи
     order = relationship("ProductionOrder", back_populates="tasks")
@@ -106,9 +170,14 @@ class ProductionTask(Base):
     # --- НОВАЯ СВЯЗЬ: ОТВЕТСТВЕННЫЙ ПОЛЬЗОВАТЕЛЬ ---
     responsible_user = relationship("User")
 
-class ProductionOrder(Base):  # Заказ
+class ProductionOrder(PlantScoped, Base):  # Заказ
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_plant_status", "plant_id", "status"),
+        trigram_index("ix_orders_client_name_trgm", "client_name"),
+    )
     id = Column(Integer, primary_key=True, index=True)
+    plant_id = Column(Integer, ForeignKey("plants.id"), nullable=False)
     client_name = Column(String)
     product_id = Column(Integer, ForeignKey("products.id"))
     quantity = Column(Integer)  # Сколько штук производим
@@ -116,19 +185,193 @@ class ProductionOrder(Base):  # Заказ
     deadline_date = Column(DateTime)
     status = Column(Enum(OrderStatus), default=OrderStatus.NEW)
 
+    # Прогноз завершения (deadlines.py): обновляется по событиям задач и периодически
+    predicted_finish_at = Column(DateTime(timezone=True), nullable=True)
+    slack_minutes = Column(Float, nullable=True, index=True)  # deadline_date - прогноз; < 0 — опоздание
+    row_version = Column(BigInteger, default=0, nullable=False, index=True)  # Версия для /sync/changes (sync.py)
+
     product = relationship("Product")
     tasks = relationship("ProductionTask", back_populates="order")
 
 
-class ProductionTask(Base):  # Конкретная задача в рамках заказа (на основе TechStage)
-    __tablename__ = "production_tasks"
+# --- АРХИВ (завершенные заказы, перенесенные из горячих таблиц, см. archive.py) ---
+
+class ArchivedOrder(PlantScoped, Base):  # Копия строки orders; id сохраняется
+    __tablename__ = "orders_archive"
+    id = Column(Integer, primary_key=True)
+    client_name = Column(String)
+    product_id = Column(Integer, ForeignKey("products.id"))
+    quantity = Column(Integer)
+    start_date = Column(DateTime)
+    deadline_date = Column(DateTime)
+    status = Column(Enum(OrderStatus))
+    archived_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+
+    product = relationship("Product")
+    tasks = relationship("ArchivedTask", back_populates="order")
+
+
+class ArchivedTask(PlantScoped, Base):  # Копия строки production_tasks; поля совпадают, чтобы отчеты работали с обеими
+    __tablename__ = "production_tasks_archive"
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders_archive.id"), index=True)
+    stage_name = Column(String)
+    status = Column(String)
+    responsible_user_id = Column(Integer, nullable=True)  # Без FK: пользователь может быть удален позже
+    assigned_at = Column(DateTime(timezone=True), nullable=True)
+    start_time_actual = Column(DateTime(timezone=True), nullable=True)
+    end_time_actual = Column(DateTime(timezone=True), nullable=True, index=True)  # Фильтр отчетов по периоду
+
+    order = relationship("ArchivedOrder", back_populates="tasks")
+
+
+
+# --- АНАЛИТИКА (предагрегаты) ---
+
+class StageCycleRollup(PlantScoped, Base):  # Суточный агрегат длительности этапов
+    __tablename__ = "stage_cycle_rollups"
+    __table_args__ = (
+        UniqueConstraint("day", "stage_name", "product_id", "operator_id", name="uq_stage_cycle_rollup_key"),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
-    stage_name = Column(String)  # Копируем имя из TechStage
-    status = Column(String, default="pending")  # pending, working, done
+    day = Column(Date, index=True)
+    stage_name = Column(String)  # Этап = цех
+    product_id = Column(Integer, ForeignKey("products.id"))
+    operator_id = Column(Integer, default=0)  # 0 — ответственный не назначен
+
+    task_count = Column(Integer, default=0)  # Все завершения, в том числе без времени начала
+    timed_count = Column(Integer, default=0)  # Завершения с известной длительностью (по ним — суммы и гистограмма)
+    total_cycle_minutes = Column(Float, default=0.0)  # Факт: end_time_actual - start_time_actual
+    total_norm_minutes = Column(Float, default=0.0)  # Норма: norm_time_minutes * quantity (только timed_count задач)
+    min_cycle_minutes = Column(Float, nullable=True)
+    max_cycle_minutes = Column(Float, nullable=True)
+    cycle_histogram = Column(JSON)  # Счетчики по корзинам rollups.CYCLE_BUCKETS (для перцентилей)
+
 
-    # Для Ганта
-    start_time_actual = Column(DateTime, nullable=True)
-    end_time_actual = Column(DateTime, nullable=True)
+# --- КОНТРОЛЬ КАЧЕСТВА (ОТК) ---
+
+class QualityEvent(PlantScoped, Base):  # Результат ОТК при каждом завершении задачи
+    __tablename__ = "quality_events"
+    __table_args__ = (
+        Index("ix_quality_events_product_created", "product_id", "created_at"),
+        Index("ix_quality_events_stage_created", "stage_name", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow, index=True)
 
-    order = relationship("ProductionOrder", back_populates="tasks")
\ No newline at end of file
+    # Без внешних ключей на задачи/заказы: история ОТК переживает архивацию
+    task_id = Column(Integer, index=True)
+    order_id = Column(Integer, index=True)
+    product_id = Column(Integer)
+    stage_name = Column(String)
+    operator_id = Column(Integer, nullable=True)  # Ответственный за задачу
+    reported_by_id = Column(Integer, ForeignKey("users.id"))  # Кто отметил завершение
+
+    quantity = Column(Integer)  # Размер партии
+    good_quantity = Column(Integer)
+    defective_quantity = Column(Integer)
+    is_rework = Column(Boolean, default=False)
+    comment = Column(String, nullable=True)
+
+
+class QualityRollup(PlantScoped, Base):  # Суточный агрегат брака и переделок
+    __tablename__ = "quality_rollups"
+    __table_args__ = (
+        UniqueConstraint("day", "stage_name", "product_id", "operator_id", name="uq_quality_rollup_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    day = Column(Date, index=True)
+    stage_name = Column(String)
+    product_id = Column(Integer, ForeignKey("products.id"))
+    operator_id = Column(Integer, default=0)  # 0 — ответственный не назначен
+
+    completions = Column(Integer, default=0)  # Сколько раз этап сдавался в ОТК
+    rework_count = Column(Integer, default=0)  # Из них отправлено на переделку
+    total_quantity = Column(Integer, default=0)
+    defective_quantity = Column(Integer, default=0)
+
+
+# --- ФОНОВЫЕ ОТЧЕТЫ ---
+
+class ReportJob(PlantScoped, Base):  # Задание на построение тяжелого отчета
+    __tablename__ = "report_jobs"
+    __table_args__ = (
+        # Поиск готового результата для тех же параметров и версии данных
+        Index("ix_report_jobs_dedup", "report_type", "params_key", "data_version"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    report_type = Column(String)  # Например: "materials-by-stage"
+    params = Column(JSON)
+    params_key = Column(String)  # Канонический JSON параметров
+    data_version = Column(String)
+    status = Column(String, default="queued")  # queued, running, done, failed
+
+    file_path = Column(String, nullable=True)
+    row_count = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+
+    created_by_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+# --- ИДЕМПОТЕНТНОСТЬ ---
+
+class IdempotencyRecord(Base):  # Сохраненный ответ на запрос с заголовком Idempotency-Key
+    __tablename__ = "idempotency_keys"
+
+    # sha256(пользователь, операция, ключ клиента) — компактный ключ фиксированной длины
+    key_hash = Column(String(64), primary_key=True)
+    request_hash = Column(String(64))  # sha256 тела запроса: тот же ключ с другим телом — ошибка
+    status_code = Column(Integer)
+    response_body = Column(JSON)
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    expires_at = Column(DateTime(timezone=True), index=True)
+
+
+# --- ЖУРНАЛ ДЕЙСТВИЙ ---
+
+class AuditEvent(PlantScoped, Base):  # Кто что сделал (только добавление, пишется пачками из audit.py)
+    __tablename__ = "audit_events"
+    __table_args__ = (
+        Index("ix_audit_events_plant_created", "plant_id", "created_at"),
+        Index("ix_audit_events_order_created", "order_id", "created_at"),
+        Index("ix_audit_events_task_created", "task_id", "created_at"),
+        Index("ix_audit_events_user_created", "user_id", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    plant_id = Column(Integer, nullable=True)  # Без FK; NULL — системное событие без пользователя
+    created_at = Column(DateTime(timezone=True), index=True)  # Момент действия, а не записи в журнал
+    action = Column(String)  # Например: "task.assign", "task.complete", "order.create"
+    user_id = Column(Integer, nullable=True)  # Без FK: журнал переживает удаление пользователя
+    username = Column(String, nullable=True)
+    order_id = Column(Integer, nullable=True)  # Без FK: заказы уходят в архив
+    task_id = Column(Integer, nullable=True)
+    entity = Column(String, nullable=True)  # Справочники: "product", "material", ...
+    entity_id = Column(Integer, nullable=True)
+    details = Column(JSON)  # Параметры действия: комментарий ОТК, брак, назначенный оператор и т.п.
+
+
+# --- СИНХРОНИЗАЦИЯ ТЕРМИНАЛОВ (sync.py) ---
+
+class SyncClock(Base):  # Единственная строка: последняя выданная версия строк
+    __tablename__ = "sync_clock"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, default=0, nullable=False)
+    tombstone_floor = Column(BigInteger, default=0, nullable=False)  # Удаления с версией <= этой уже забыты
+
+
+class SyncTombstone(PlantScoped, Base):  # Удаленная строка синхронизируемой таблицы
+    __tablename__ = "sync_tombstones"
+    id = Column(Integer, primary_key=True)
+    plant_id = Column(Integer, index=True)
+    entity = Column(String)  # "tasks", "orders", "materials"
+    entity_id = Column(Integer)
+    row_version = Column(BigInteger, index=True)
+    deleted_at = Column(DateTime(timezone=True), default=datetime.utcnow, index=True)
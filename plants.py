@@ -0,0 +1,71 @@
+"""
+Разделение данных по заводам (площадкам).
+
+Модели PlantScoped несут plant_id. Сессия завода (database.plant_session, зависимость
+auth.get_plant_db) ограничивает заводом ВСЕ свои ORM-запросы — и в main.py, и в модулях,
+которым эндпоинт передает сессию (отчеты, синхронизация, автоназначение, разузлование):
+к каждому SELECT, UPDATE и DELETE добавляется plant_id = :plant через with_loader_criteria,
+включая JOIN, подзапросы relationship и ленивые загрузки связей. Новым строкам plant_id
+проставляется при flush; строку чужого завода сессия записать не даст.
+
+Сессия без завода (plant_id=None: фоновые задачи, сид) видит всю свою БД, новые строки
+без plant_id получают DEFAULT_PLANT_ID.
+
+Завод может жить в своей БД (database.PLANT_DATABASES): тогда его запросы идут только
+туда и не конкурируют с другими заводами ни за строки, ни за индексы.
+"""
+from typing import List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, with_loader_criteria
+
+import database
+import models
+
+
+def plant_of(session: Session) -> Optional[int]:
+    """Завод сессии; None — сессия без ограничения."""
+    return session.info.get("plant_id")
+
+
+@event.listens_for(database.SessionLocal, "do_orm_execute")
+def _limit_to_plant(execute_state):
+    plant_id = plant_of(execute_state.session)
+    if plant_id is None or execute_state.is_column_load or execute_state.is_relationship_load:
+        return  # Загрузки связей наследуют условие от исходного запроса
+    if execute_state.is_select or execute_state.is_update or execute_state.is_delete:
+        execute_state.statement = execute_state.statement.options(
+            with_loader_criteria(models.PlantScoped, lambda cls: cls.plant_id == plant_id, include_aliases=True)
+        )
+
+
+@event.listens_for(database.SessionLocal, "before_flush")
+def _stamp_plant(session, flush_context, instances):
+    plant_id = plant_of(session)
+    for obj in session.new:
+        if not isinstance(obj, models.PlantScoped):
+            continue
+        if obj.plant_id is None:
+            obj.plant_id = plant_id if plant_id is not None else database.DEFAULT_PLANT_ID
+        elif plant_id is not None and obj.plant_id != plant_id:
+            raise ValueError(f"Запись завода {obj.plant_id} в сессии завода {plant_id}")
+
+
+# --- СПРАВОЧНИК ЗАВОДОВ ---
+
+def ensure_plants():
+    """Строки plants для основного завода и заводов из карты шардов — каждая в своей БД."""
+    for plant_id in {database.DEFAULT_PLANT_ID, *database.PLANT_DATABASES}:
+        with database.SessionLocal(bind=database.get_engine(plant_id)) as db:
+            if db.get(models.Plant, plant_id) is None:
+                db.add(models.Plant(id=plant_id, code=f"PLANT-{plant_id}", name=f"Завод {plant_id}"))
+                db.commit()
+
+
+def plant_ids() -> List[int]:
+    """Все заводы установки: каждый читается из своей БД, без дублей."""
+    ids = set()
+    for bind in database.all_engines():
+        with database.SessionLocal(bind=bind) as db:
+            ids.update(row.id for row in db.query(models.Plant.id) if database.get_engine(row.id) is bind)
+    return sorted(ids)
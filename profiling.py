@@ -0,0 +1,282 @@
+"""
+Профилирование запросов по требованию и детектор N+1.
+
+Запрос профилируется, если пришел заголовок `X-Debug-Profile: <PROFILE_SECRET>` или он попал
+в выборку PROFILE_SAMPLE_RATE. Без PROFILE_SECRET заголовок игнорируется: профиль запускает
+поток-сэмплер, и анонимный вызывающий не должен включать его по своему желанию. Для него собираются:
+- полная трассировка SQL (текст, время, поток);
+- сэмплирующий профиль: стеки потоков запроса снимаются каждые PROFILE_INTERVAL секунд;
+- список "N+1": одинаковые по форме SQL-выражения, повторенные PROFILE_N_PLUS_ONE_THRESHOLD раз и более.
+
+Отчеты хранятся в памяти (последние PROFILE_KEEP_REPORTS), id отчета возвращается
+в заголовке X-Profile-Id. Для тестов есть assert_max_queries().
+"""
+import hmac
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, UTC
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+PROFILE_HEADER = b"x-debug-profile"
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "").encode()  # Пусто — профилирование по заголовку выключено
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_N_PLUS_ONE_THRESHOLD = int(os.getenv("PROFILE_N_PLUS_ONE_THRESHOLD", "5"))
+PROFILE_KEEP_REPORTS = int(os.getenv("PROFILE_KEEP_REPORTS", "100"))
+MAX_STACK_DEPTH = 40
+
+
+# --- ТРАССИРОВКА SQL ---
+
+_NUMBER_RE = re.compile(r"\b\d+(\.\d+)?\b")
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_IN_LIST_RE = re.compile(r"\bIN\s*\((?:\s*(?:\?|%\([^)]*\)s|:\w+|__\[POSTCOMPILE_\w+\])\s*,?)+\)", re.IGNORECASE)
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_sql(statement: str) -> str:
+    """Приводит SQL к "форме": без литералов, с одним пробелом между токенами."""
+    shape = _STRING_RE.sub("?", statement)
+    shape = _NUMBER_RE.sub("?", shape)
+    shape = _IN_LIST_RE.sub("IN (?)", shape)
+    return _SPACE_RE.sub(" ", shape).strip()
+
+
+class SqlTrace:
+    """Собирает SQL-выражения одного запроса (или блока assert_max_queries)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements: List[Dict] = []
+        self.thread_ids = set()
+
+    def add(self, statement: str, seconds: float):
+        with self.lock:
+            self.thread_ids.add(threading.get_ident())
+            self.statements.append({"sql": statement, "ms": round(seconds * 1000, 3)})
+
+    def n_plus_one(self, threshold: int = PROFILE_N_PLUS_ONE_THRESHOLD) -> List[Dict]:
+        shapes = Counter()
+        total_ms: Dict[str, float] = {}
+        for item in self.statements:
+            shape = normalize_sql(item["sql"])
+            shapes[shape] += 1
+            total_ms[shape] = total_ms.get(shape, 0.0) + item["ms"]
+        return [
+            {"sql_shape": shape, "count": count, "total_ms": round(total_ms[shape], 3)}
+            for shape, count in shapes.most_common() if count >= threshold
+        ]
+
+
+current_trace: ContextVar[Optional[SqlTrace]] = ContextVar("current_trace", default=None)
+
+# Трассировки, которые видят все выражения движка независимо от контекста
+# (TestClient выполняет приложение в другом потоке, контекст туда не попадает).
+_global_traces: List[SqlTrace] = []
+_global_lock = threading.Lock()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("profiling_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["profiling_query_start"].pop()
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(statement, elapsed)
+    if _global_traces:
+        with _global_lock:
+            for global_trace in _global_traces:
+                if global_trace is not trace:
+                    global_trace.add(statement, elapsed)
+
+
+def _handle_error(context):
+    conn = context.connection
+    if conn is not None and conn.info.get("profiling_query_start"):
+        conn.info["profiling_query_start"].pop()
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+
+
+# --- СЭМПЛИРУЮЩИЙ ПРОФИЛЬ ---
+
+class StackSampler(threading.Thread):
+    """
+    Снимает стеки потоков запроса: потока event loop и рабочих потоков,
+    в которых запрос выполнял SQL (синхронные эндпоинты работают в пуле потоков).
+    """
+
+    def __init__(self, trace: SqlTrace, loop_thread_id: int, interval: float = PROFILE_INTERVAL):
+        super().__init__(daemon=True, name="request-profiler")
+        self.trace = trace
+        self.loop_thread_id = loop_thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.trace.lock:
+                thread_ids = set(self.trace.thread_ids)
+            thread_ids.add(self.loop_thread_id)
+
+            frames = sys._current_frames()
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self.samples[_collapse_stack(frame)] += 1
+
+    def stop(self) -> Dict[str, int]:
+        self.stopped.set()
+        self.join()
+        return dict(self.samples.most_common())
+
+
+def _collapse_stack(frame) -> str:
+    """Стек в формате collapsed stacks (flamegraph.pl / speedscope): корень;...;лист."""
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+# --- ХРАНИЛИЩЕ ОТЧЕТОВ ---
+
+_reports: "OrderedDict[int, Dict]" = OrderedDict()
+_reports_lock = threading.Lock()
+_report_ids = itertools.count(1)
+
+
+def _store_report(report: Dict) -> int:
+    with _reports_lock:
+        report_id = next(_report_ids)
+        report["id"] = report_id
+        _reports[report_id] = report
+        while len(_reports) > PROFILE_KEEP_REPORTS:
+            _reports.popitem(last=False)
+    return report_id
+
+
+def list_reports() -> List[Dict]:
+    with _reports_lock:
+        reports = list(_reports.values())
+    return [
+        {key: report.get(key) for key in ("id", "created_at", "method", "path", "status", "duration_ms",
+                                      "query_count", "n_plus_one")}
+        for report in reversed(reports)
+    ]
+
+
+def get_report(report_id: int) -> Optional[Dict]:
+    with _reports_lock:
+        return _reports.get(report_id)
+
+
+# --- ASGI MIDDLEWARE ---
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        if PROFILE_SECRET:
+            for name, value in scope.get("headers", ()):
+                if name == PROFILE_HEADER and hmac.compare_digest(value, PROFILE_SECRET):
+                    return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        trace = SqlTrace()
+        token = current_trace.set(trace)
+        sampler = StackSampler(trace, threading.get_ident())
+        status_holder = {"code": 500}
+        report = {
+            "created_at": datetime.now(UTC).isoformat(),
+            "method": scope["method"],
+            "path": scope["path"],
+        }
+        # id резервируем заранее, чтобы вернуть его в заголовке ответа
+        report_id = _store_report(report)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_holder["code"] = message["status"]
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-profile-id", str(report_id).encode())]
+            await send(message)
+
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            samples = sampler.stop()
+            current_trace.reset(token)
+            route = scope.get("route")
+            report.update({
+                "route": getattr(route, "path", None),
+                "status": status_holder["code"],
+                "duration_ms": round(duration * 1000, 3),
+                "query_count": len(trace.statements),
+                "sql_ms": round(sum(item["ms"] for item in trace.statements), 3),
+                "n_plus_one": trace.n_plus_one(),
+                "queries": trace.statements,
+                "profile": samples,
+            })
+
+
+# --- ПОМОЩНИК ДЛЯ PYTEST ---
+
+@contextmanager
+def assert_max_queries(max_queries: int, engine=None):
+    """
+    Проверяет, что блок выполнил не больше max_queries SQL-выражений:
+
+        with profiling.assert_max_queries(5):
+            client.get("/tasks/", headers=auth_headers)
+
+    Считаются все выражения движка (в том числе из потока TestClient).
+    """
+    if engine is not None:
+        instrument_engine(engine)
+
+    trace = SqlTrace()
+    with _global_lock:
+        _global_traces.append(trace)
+    try:
+        yield trace
+    finally:
+        with _global_lock:
+            _global_traces.remove(trace)
+
+    if len(trace.statements) > max_queries:
+        details = "\n".join(f"  {item['sql']}" for item in trace.statements)
+        patterns = "\n".join(f"  x{item['count']}: {item['sql_shape']}" for item in trace.n_plus_one())
+        raise AssertionError(
+            f"Выполнено {len(trace.statements)} SQL-выражений, допускается не более {max_queries}.\n"
+            f"Вероятные N+1:\n{patterns or '  нет'}\nВсе выражения:\n{details}"
+        )
@@ -0,0 +1,136 @@
+"""
+События ОТК (QualityEvent) и агрегаты брака/переделок (QualityRollup).
+
+Каждое завершение задачи пишет событие и инкрементально обновляет суточный агрегат
+(день, этап, изделие, оператор) в той же транзакции. Тренды качества за месяцы
+читаются из агрегатов, история партий — из событий по индексам.
+"""
+from datetime import date, datetime, timedelta, UTC
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+import models
+import rollups
+import schemas
+
+GROUP_FIELDS = rollups.GROUP_FIELDS
+
+
+def record_completion(
+        db: Session,
+        task: models.ProductionTask,
+        reported_by: models.User,
+        good_qty: int,
+        defective_qty: int,
+        comment: Optional[str] = None,
+) -> models.QualityEvent:
+    """Пишет событие ОТК и обновляет агрегат. Коммит — на стороне вызывающего."""
+    now = datetime.now(UTC)
+    is_rework = defective_qty > 0
+
+    quality_event = models.QualityEvent(
+        created_at=now,
+        task_id=task.id,
+        order_id=task.order_id,
+        product_id=task.order.product_id,
+        stage_name=task.stage_name,
+        operator_id=task.responsible_user_id,
+        reported_by_id=reported_by.id,
+        quantity=good_qty + defective_qty,
+        good_quantity=good_qty,
+        defective_quantity=defective_qty,
+        is_rework=is_rework,
+        comment=comment,
+    )
+    db.add(quality_event)
+
+    key = {
+        "day": now.date(),
+        "stage_name": task.stage_name,
+        "product_id": task.order.product_id,
+        "operator_id": task.responsible_user_id or 0,
+    }
+    rollup = rollups.get_or_create_rollup(db, models.QualityRollup, key, completions=0, rework_count=0,
+                                          total_quantity=0, defective_quantity=0)
+    rollup.completions += 1
+    rollup.rework_count += int(is_rework)
+    rollup.total_quantity += good_qty + defective_qty
+    rollup.defective_quantity += defective_qty
+    return quality_event
+
+
+def query_quality(
+        db: Session,
+        group_by: Iterable[str],
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        stage_name: Optional[str] = None,
+        product_id: Optional[int] = None,
+        operator_id: Optional[int] = None,
+) -> List[schemas.QualityStatsRow]:
+    group_by = [field for field in GROUP_FIELDS if field in set(group_by)]
+
+    query = db.query(models.QualityRollup)
+    if start_date:
+        query = query.filter(models.QualityRollup.day >= start_date)
+    if end_date:
+        query = query.filter(models.QualityRollup.day <= end_date)
+    if stage_name:
+        query = query.filter(models.QualityRollup.stage_name == stage_name)
+    if product_id is not None:
+        query = query.filter(models.QualityRollup.product_id == product_id)
+    if operator_id is not None:
+        query = query.filter(models.QualityRollup.operator_id == operator_id)
+
+    groups: Dict[Tuple, List[int]] = {}
+    for rollup in query.all():
+        key = tuple(getattr(rollup, field) for field in group_by)
+        totals = groups.setdefault(key, [0, 0, 0, 0])
+        totals[0] += rollup.completions
+        totals[1] += rollup.rework_count
+        totals[2] += rollup.total_quantity
+        totals[3] += rollup.defective_quantity
+
+    result = []
+    for key, (completions, reworks, total_qty, defective_qty) in sorted(
+            groups.items(), key=lambda item: tuple(str(v) for v in item[0])):
+        result.append(schemas.QualityStatsRow(
+            **dict(zip(group_by, key)),
+            completions=completions,
+            rework_count=reworks,
+            rework_rate=round(reworks / completions, 4) if completions else None,
+            total_quantity=total_qty,
+            defective_quantity=defective_qty,
+            defect_rate=round(defective_qty / total_qty, 4) if total_qty else None,
+        ))
+    return result
+
+
+def query_events(
+        db: Session,
+        order_id: Optional[int] = None,
+        task_id: Optional[int] = None,
+        product_id: Optional[int] = None,
+        stage_name: Optional[str] = None,
+        only_rework: bool = False,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        limit: int = 100,
+) -> List[models.QualityEvent]:
+    query = db.query(models.QualityEvent)
+    if order_id is not None:
+        query = query.filter(models.QualityEvent.order_id == order_id)
+    if task_id is not None:
+        query = query.filter(models.QualityEvent.task_id == task_id)
+    if product_id is not None:
+        query = query.filter(models.QualityEvent.product_id == product_id)
+    if stage_name:
+        query = query.filter(models.QualityEvent.stage_name == stage_name)
+    if only_rework:
+        query = query.filter(models.QualityEvent.is_rework.is_(True))
+    if start_date:
+        query = query.filter(models.QualityEvent.created_at >= start_date)
+    if end_date:
+        query = query.filter(models.QualityEvent.created_at < end_date + timedelta(days=1))
+    return query.order_by(models.QualityEvent.created_at.desc()).limit(limit).all()
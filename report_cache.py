@@ -0,0 +1,115 @@
+"""
+LRU-кэш отчета о списании материалов по ключу (plant_id, start_date, end_date).
+
+- Запись сбрасывается, когда complete_task фиксирует завершение внутри ее периода.
+- Закрытые периоды (end_date в прошлом) измениться не могут и хранятся без срока жизни.
+- Открытые периоды дополнительно ограничены REPORT_CACHE_OPEN_TTL секунд — на случай
+  изменений, которые не проходят через complete_task (правка справочников, сид).
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, UTC
+from typing import List, Optional, Tuple
+
+import invalidation
+from invalidation import EventKind
+
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "128"))
+REPORT_CACHE_OPEN_TTL = float(os.getenv("REPORT_CACHE_OPEN_TTL", "300"))
+
+CacheKey = Tuple[Optional[int], Optional[date], Optional[date]]
+
+
+def _today() -> date:
+    return datetime.now(UTC).date()
+
+
+def _as_date(value) -> date:
+    if isinstance(value, datetime):
+        return (value if value.tzinfo is None else value.astimezone(UTC)).date()
+    return value
+
+
+class _Entry:
+    __slots__ = ("rows", "created_at", "closed")
+
+    def __init__(self, rows, closed: bool):
+        self.rows = rows
+        self.created_at = time.monotonic()
+        self.closed = closed
+
+
+class ReportCache:
+    def __init__(self, maxsize: int = REPORT_CACHE_SIZE, open_ttl: float = REPORT_CACHE_OPEN_TTL):
+        self.maxsize = maxsize
+        self.open_ttl = open_ttl
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, start_date: Optional[date], end_date: Optional[date], plant_id: Optional[int] = None) -> Optional[List]:
+        key = (plant_id, start_date, end_date)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not entry.closed and time.monotonic() - entry.created_at > self.open_ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.rows
+
+    def put(self, start_date: Optional[date], end_date: Optional[date], rows: List, plant_id: Optional[int] = None):
+        closed = end_date is not None and end_date < _today()
+        key = (plant_id, start_date, end_date)
+        with self._lock:
+            self._entries[key] = _Entry(rows, closed)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate_completion(self, completed_at, plant_id: Optional[int] = None) -> int:
+        """Сбрасывает записи, чей период содержит дату завершения задачи (plant_id=None — всех заводов)."""
+        day = _as_date(completed_at)
+        with self._lock:
+            stale = [
+                key for key in self._entries
+                if (plant_id is None or key[0] is None or key[0] == plant_id)
+                and (key[1] is None or key[1] <= day) and (key[2] is None or day <= key[2])
+            ]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+materials_report_cache = ReportCache()
+
+
+# --- ИНВАЛИДАЦИЯ (в том числе из других воркеров) ---
+
+def _on_task_completed(event: invalidation.InvalidationEvent):
+    # day пуст у переделки (задача не done): в отчет она не попадает, кэш не трогаем
+    if event.day:
+        materials_report_cache.invalidate_completion(date.fromisoformat(event.day), event.plant_id)
+
+
+def _on_reference_changed(event: invalidation.InvalidationEvent):
+    # В строках отчета хранятся названия изделий и материалов
+    materials_report_cache.clear()
+
+
+invalidation.subscribe(EventKind.TASK_COMPLETED, _on_task_completed)
+invalidation.subscribe([EventKind.PRODUCT_CHANGED, EventKind.MATERIAL_CHANGED, EventKind.TECHCARD_CHANGED,
+                        EventKind.RESYNC], _on_reference_changed)
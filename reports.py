@@ -0,0 +1,193 @@
+"""
+Построение отчета о списании материалов по этапам.
+
+Используется эндпоинтами /reports/materials-by-stage (JSON и CSV) и фоновыми задачами jobs.py.
+"""
+from datetime import date, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import event, func, inspect, update
+from sqlalchemy.orm import Session, joinedload, selectinload
+
+import database
+
+import models
+import plants
+import schemas
+from report_cache import materials_report_cache
+
+# Справочные поля, попадающие в отчет: их правка меняет Plant.reference_version.
+# None — любое поле модели (этапы и нормы расхода целиком); у материала остаток не в счет.
+REFERENCE_FIELDS = {
+    models.Product: ("name",),
+    models.Material: ("name", "unit"),
+    models.TechStage: None,
+    models.StageMaterialRequirement: None,
+}
+_REFERENCE_PENDING = "reference_changed"  # Флаг в session.info до коммита
+
+CSV_HEADER = [
+    "ID Заказа", "Изделие", "Этап", "Материал", "Ед. изм.",
+    "Кол-во потрачено", "Дата завершения"
+]
+
+
+def _completed_tasks(db: Session, model, order_model, start_date: Optional[date], end_date: Optional[date]) -> List:
+    query = db.query(model).options(
+        joinedload(model.order).joinedload(order_model.product)
+    ).filter(model.status == 'done')
+
+    if start_date:
+        query = query.filter(model.end_time_actual >= start_date)
+    if end_date:
+        # Учитываем весь день end_date
+        next_day = end_date + timedelta(days=1)
+        query = query.filter(model.end_time_actual < next_day)
+
+    return query.all()
+
+
+def _needs_archive(db: Session, start_date: Optional[date]) -> bool:
+    """Архив читается, только если период начинается не позже последнего архивного завершения."""
+    last_archived = db.query(func.max(models.ArchivedTask.end_time_actual)).scalar()
+    if last_archived is None:
+        return False
+    return start_date is None or start_date <= last_archived.date()
+
+
+def build_materials_report(
+        db: Session,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None
+) -> List[schemas.MaterialReportRow]:
+    """Строки отчета по завершенным задачам с фильтром по дате завершения (вместе с архивом)."""
+    completed_tasks = _completed_tasks(db, models.ProductionTask, models.ProductionOrder, start_date, end_date)
+    if _needs_archive(db, start_date):
+        # ArchivedTask/ArchivedOrder повторяют поля горячих таблиц — цикл ниже для них тот же
+        completed_tasks = _completed_tasks(db, models.ArchivedTask, models.ArchivedOrder, start_date, end_date) + completed_tasks
+
+    report_data = []
+    # Этапы всех изделий отчета с нормами и материалами — одним набором запросов, а не на задачу
+    stages: Dict[Tuple[int, str], models.TechStage] = {}
+    product_ids = {task.order.product_id for task in completed_tasks if task.order}
+    if product_ids:
+        for stage in db.query(models.TechStage).join(models.Product).options(
+                selectinload(models.TechStage.requirements).joinedload(models.StageMaterialRequirement.material)
+        ).filter(models.Product.id.in_(product_ids)).order_by(models.TechStage.id):
+            stages.setdefault((stage.product_id, stage.name), stage)
+
+    for task in completed_tasks:
+        stage = stages.get((task.order.product_id, task.stage_name)) if task.order else None
+
+        if stage and task.order and task.order.product:
+            order_qty = task.order.quantity
+
+            for req in stage.requirements:
+                total_spent = req.quantity_needed * order_qty
+
+                report_data.append(schemas.MaterialReportRow(
+                    order_id=task.order_id,
+                    product_name=task.order.product.name,
+                    stage_name=task.stage_name,
+                    material_name=req.material.name,
+                    unit=req.material.unit,
+                    quantity_spent=round(total_spent, 2),
+                    completion_date=task.end_time_actual
+                ))
+
+    return report_data
+
+
+def get_materials_report_cached(
+        db: Session,
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None
+) -> List[schemas.MaterialReportRow]:
+    """build_materials_report через LRU-кэш по заводу и периоду (см. report_cache.py)."""
+    plant_id = plants.plant_of(db)
+    rows = materials_report_cache.get(start_date, end_date, plant_id)
+    if rows is None:
+        rows = build_materials_report(db, start_date=start_date, end_date=end_date)
+        materials_report_cache.put(start_date, end_date, rows, plant_id)
+    return rows
+
+
+def iter_materials_csv(report_data: Iterable[schemas.MaterialReportRow]) -> Iterator[str]:
+    """CSV для русской версии Excel: разделитель ';', десятичная запятая."""
+    # Первая строка - заголовки
+    yield ";".join(CSV_HEADER) + "\n"
+    for row in report_data:
+        date_str = row.completion_date.strftime("%Y-%m-%d %H:%M") if row.completion_date else ""
+
+        # Собираем строку CSV, заменяем точку на запятую для корректной работы в русской версии Excel
+        csv_row = [
+            str(row.order_id),
+            row.product_name,
+            row.stage_name,
+            row.material_name,
+            row.unit,
+            str(row.quantity_spent).replace('.', ','),
+            date_str
+        ]
+        yield ";".join(csv_row) + "\n"
+
+
+# --- ВЕРСИЯ ДАННЫХ ---
+
+def _reference_changed(obj) -> bool:
+    fields = REFERENCE_FIELDS[type(obj)]
+    if fields is None:
+        return True
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in fields)
+
+
+@event.listens_for(database.SessionLocal, "before_flush")
+def _collect_reference_changes(session, flush_context, instances):
+    if session.info.get(_REFERENCE_PENDING):
+        return
+    for obj in session.new | session.deleted:
+        if type(obj) in REFERENCE_FIELDS:
+            session.info[_REFERENCE_PENDING] = True
+            return
+    for obj in session.dirty:
+        if type(obj) in REFERENCE_FIELDS and _reference_changed(obj):
+            session.info[_REFERENCE_PENDING] = True
+            return
+
+
+@event.listens_for(database.SessionLocal, "before_commit")
+def _bump_reference_version(session):
+    session.flush()
+    if not session.info.pop(_REFERENCE_PENDING, False):
+        return
+    statement = update(models.Plant).values(reference_version=models.Plant.reference_version + 1)
+    plant_id = plants.plant_of(session)
+    if plant_id is not None:
+        statement = statement.where(models.Plant.id == plant_id)
+    session.execute(statement)  # Сессия без завода (импорт, сид) — все заводы своей БД
+
+
+def materials_data_version(db: Session) -> str:
+    """
+    Версия исходных данных отчета: меняется при каждом завершении задачи и при правке
+    изделий, материалов, этапов и норм расхода (Plant.reference_version).
+    Считается по горячей таблице и архиву вместе, поэтому перенос в архив ее не меняет.
+    """
+    count, max_id, last_end = 0, 0, None
+    for model in (models.ProductionTask, models.ArchivedTask):
+        part_count, part_max_id, part_last_end = db.query(
+            func.count(model.id),
+            func.max(model.id),
+            func.max(model.end_time_actual),
+        ).filter(model.status == 'done').one()
+        count += part_count
+        max_id = max(max_id, part_max_id or 0)
+        if part_last_end is not None and (last_end is None or part_last_end > last_end):
+            last_end = part_last_end
+    reference = db.query(models.Plant.reference_version)
+    plant_id = plants.plant_of(db)
+    if plant_id is not None:
+        reference = reference.filter(models.Plant.id == plant_id)
+    reference_version = sum(row.reference_version for row in reference)
+    return f"{count}:{max_id}:{last_end.isoformat() if last_end else '-'}:r{reference_version}"
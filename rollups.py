@@ -0,0 +1,215 @@
+"""
+Предагрегаты длительности этапов (StageCycleRollup).
+
+Строка агрегата — (день, этап/цех, изделие, оператор). Обновляется инкрементально
+в той же транзакции, что и завершение задачи, поэтому дашборды за год читают
+сотни строк вместо сканирования всех задач. Перцентили считаются по гистограмме
+с фиксированными корзинами (точность — граница корзины).
+"""
+from bisect import bisect_left
+from datetime import date, datetime, UTC
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+
+import models
+import schemas
+
+# Верхние границы корзин, минуты. Последняя корзина — "больше 10080" (неделя).
+CYCLE_BUCKETS = (5, 10, 15, 30, 45, 60, 90, 120, 180, 240, 360, 480, 720, 960, 1440, 2880, 4320, 7200, 10080)
+
+GROUP_FIELDS = ("day", "stage_name", "product_id", "operator_id")
+
+
+def _empty_histogram() -> List[int]:
+    return [0] * (len(CYCLE_BUCKETS) + 1)
+
+
+def _bucket_index(minutes: float) -> int:
+    return bisect_left(CYCLE_BUCKETS, minutes)
+
+
+def _as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo=UTC) if value.tzinfo is None else value.astimezone(UTC)
+
+
+def task_cycle(
+        task: models.ProductionTask, stage: Optional[models.TechStage]
+) -> Optional[Tuple[date, Optional[float], float]]:
+    """
+    (день завершения, факт в минутах, норма в минутах) или None, если задача не завершена.
+    Задача, завершенная без начала (автоназначение), считается от назначения;
+    если нет и его — факт None: задача входит в task_count, но не в длительности.
+    """
+    if task.end_time_actual is None:
+        return None
+    end = _as_utc(task.end_time_actual)
+    started = task.start_time_actual or task.assigned_at
+    if started is None:
+        return end.date(), None, 0.0
+    cycle = max(0.0, (end - _as_utc(started)).total_seconds() / 60)
+    norm = (stage.norm_time_minutes or 0) * task.order.quantity if stage else 0.0
+    return end.date(), cycle, float(norm)
+
+
+def get_or_create_rollup(db: Session, model, key: Dict, **defaults):
+    """Строка агрегата по ключу под блокировкой (SELECT ... FOR UPDATE); создает ее при отсутствии."""
+    query = db.query(model).filter_by(**key).with_for_update()
+    rollup = query.first()
+    if rollup is not None:
+        return rollup
+
+    # Параллельная транзакция могла создать ту же строку — тогда перечитываем
+    try:
+        with db.begin_nested():
+            rollup = model(**key, **defaults)
+            db.add(rollup)
+    except IntegrityError:
+        rollup = query.first()
+    return rollup
+
+
+def _apply(rollup: models.StageCycleRollup, cycle: Optional[float], norm: float, count: int = 1):
+    rollup.task_count += count
+    if cycle is None:
+        return
+    rollup.timed_count = (rollup.timed_count or 0) + count
+    rollup.total_cycle_minutes += cycle
+    rollup.total_norm_minutes += norm
+    rollup.min_cycle_minutes = cycle if rollup.min_cycle_minutes is None else min(rollup.min_cycle_minutes, cycle)
+    rollup.max_cycle_minutes = cycle if rollup.max_cycle_minutes is None else max(rollup.max_cycle_minutes, cycle)
+    histogram = list(rollup.cycle_histogram or _empty_histogram())
+    histogram[_bucket_index(cycle)] += count
+    rollup.cycle_histogram = histogram  # Новый список, чтобы SQLAlchemy заметил изменение JSON
+
+
+def record_task_completion(db: Session, task: models.ProductionTask, stage: Optional[models.TechStage]):
+    """Учитывает завершенную задачу в агрегате. Коммит — на стороне вызывающего."""
+    cycle_data = task_cycle(task, stage)
+    if cycle_data is None:
+        return
+    day, cycle, norm = cycle_data
+    key = {
+        "day": day,
+        "stage_name": task.stage_name,
+        "product_id": task.order.product_id,
+        "operator_id": task.responsible_user_id or 0,
+    }
+    rollup = get_or_create_rollup(db, models.StageCycleRollup, key, task_count=0, timed_count=0,
+                                  total_cycle_minutes=0.0, total_norm_minutes=0.0,
+                                  cycle_histogram=_empty_histogram())
+    _apply(rollup, cycle, norm)
+
+
+def rebuild(db: Session) -> int:
+    """Пересчитывает агрегаты по всей истории (для данных, внесенных в обход complete_task)."""
+    db.query(models.StageCycleRollup).delete()
+
+    stages = {
+        (stage.product_id, stage.name): stage for stage in db.query(models.TechStage).all()
+    }
+    # Архивные задачи (archive.py) тоже входят в историю
+    tasks = []
+    for task_model, order_model in ((models.ProductionTask, models.ProductionOrder),
+                                    (models.ArchivedTask, models.ArchivedOrder)):
+        tasks += db.query(task_model).join(order_model).options(joinedload(task_model.order)).filter(
+            task_model.status == "done",
+            task_model.end_time_actual.isnot(None),
+        ).all()
+
+    rollups: Dict[Tuple, models.StageCycleRollup] = {}
+    for task in tasks:
+        cycle_data = task_cycle(task, stages.get((task.order.product_id, task.stage_name)))
+        if cycle_data is None:
+            continue
+        day, cycle, norm = cycle_data
+        key = (day, task.stage_name, task.order.product_id, task.responsible_user_id or 0)
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollup = rollups[key] = models.StageCycleRollup(
+                **dict(zip(GROUP_FIELDS, key)), task_count=0, timed_count=0, total_cycle_minutes=0.0,
+                total_norm_minutes=0.0, cycle_histogram=_empty_histogram()
+            )
+            db.add(rollup)
+        _apply(rollup, cycle, norm)
+
+    db.commit()
+    return len(tasks)
+
+
+# --- ЧТЕНИЕ ---
+
+def _percentile(histogram: List[int], total: int, fraction: float) -> Optional[float]:
+    if total == 0:
+        return None
+    threshold = fraction * total
+    cumulative = 0
+    for index, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= threshold:
+            # Для последней корзины верхней границы нет — отдаем нижнюю
+            return float(CYCLE_BUCKETS[min(index, len(CYCLE_BUCKETS) - 1)])
+    return float(CYCLE_BUCKETS[-1])
+
+
+def query_throughput(
+        db: Session,
+        group_by: Iterable[str],
+        start_date: Optional[date] = None,
+        end_date: Optional[date] = None,
+        stage_name: Optional[str] = None,
+        product_id: Optional[int] = None,
+        operator_id: Optional[int] = None,
+) -> List[schemas.StageThroughputRow]:
+    group_by = [field for field in GROUP_FIELDS if field in set(group_by)]
+
+    query = db.query(models.StageCycleRollup)
+    if start_date:
+        query = query.filter(models.StageCycleRollup.day >= start_date)
+    if end_date:
+        query = query.filter(models.StageCycleRollup.day <= end_date)
+    if stage_name:
+        query = query.filter(models.StageCycleRollup.stage_name == stage_name)
+    if product_id is not None:
+        query = query.filter(models.StageCycleRollup.product_id == product_id)
+    if operator_id is not None:
+        query = query.filter(models.StageCycleRollup.operator_id == operator_id)
+
+    groups: Dict[Tuple, Dict] = {}
+    for rollup in query.all():
+        key = tuple(getattr(rollup, field) for field in group_by)
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {
+                "count": 0, "timed": 0, "cycle": 0.0, "norm": 0.0, "min": None, "max": None,
+                "histogram": _empty_histogram(),
+            }
+        group["count"] += rollup.task_count
+        group["timed"] += rollup.timed_count or 0
+        group["cycle"] += rollup.total_cycle_minutes
+        group["norm"] += rollup.total_norm_minutes
+        if rollup.min_cycle_minutes is not None:
+            group["min"] = rollup.min_cycle_minutes if group["min"] is None else min(group["min"], rollup.min_cycle_minutes)
+        if rollup.max_cycle_minutes is not None:
+            group["max"] = rollup.max_cycle_minutes if group["max"] is None else max(group["max"], rollup.max_cycle_minutes)
+        for index, count in enumerate(rollup.cycle_histogram or ()):
+            group["histogram"][index] += count
+
+    result = []
+    for key, group in sorted(groups.items(), key=lambda item: tuple(str(v) for v in item[0])):
+        timed = group["timed"]
+        result.append(schemas.StageThroughputRow(
+            **dict(zip(group_by, key)),
+            task_count=group["count"],
+            avg_cycle_minutes=round(group["cycle"] / timed, 2) if timed else None,
+            min_cycle_minutes=round(group["min"], 2) if group["min"] is not None else None,
+            max_cycle_minutes=round(group["max"], 2) if group["max"] is not None else None,
+            p50_cycle_minutes=_percentile(group["histogram"], timed, 0.5),
+            p90_cycle_minutes=_percentile(group["histogram"], timed, 0.9),
+            p95_cycle_minutes=_percentile(group["histogram"], timed, 0.95),
+            total_cycle_minutes=round(group["cycle"], 2),
+            total_norm_minutes=round(group["norm"], 2),
+            actual_to_norm_ratio=round(group["cycle"] / group["norm"], 3) if group["norm"] else None,
+        ))
+    return result
@@ -1,6 +1,6 @@
 from pydantic import BaseModel
-from typing import List, Optional
-from datetime import datetime
+from typing import List, Optional, Literal
+from datetime import datetime, date
 from models import UserRole
 
 
@@ -38,6 +38,20 @@ class OrderOut(BaseModel):
     class Config:
         orm_mode = True
 
+class AtRiskOrder(BaseModel):
+    """Открытый заказ с малым запасом до дедлайна (см. deadlines.py)."""
+    id: int
+    client_name: str
+    product_id: int
+    quantity: int
+    status: str
+    deadline_date: Optional[datetime] = None
+    predicted_finish_at: Optional[datetime] = None
+    slack_minutes: Optional[float] = None  # < 0 — прогноз уже позже дедлайна
+
+    class Config:
+        from_attributes = True
+
 # --- Tasks ---
 
 # --- Gantt Data ---
@@ -45,7 +59,7 @@ class GanttTask(BaseModel):
     id: int
     text: str
     start_date: str
-    duration: int
+    duration: float  # Дни с точностью до 0.01
     progress: float
     parent: int = 0
 
@@ -74,6 +88,32 @@ class TaskCompleteData(BaseModel):
     defective_quantity: int = 0
     comment: Optional[str] = None
 
+class BatchCompleteItem(TaskCompleteData):
+    task_id: int
+
+
+class BatchCompleteRequest(BaseModel):
+    items: List[BatchCompleteItem]
+    partial: bool = True  # Отклонять только ошибочные позиции, а не весь пакет
+
+
+class BatchCompleteItemResult(BaseModel):
+    task_id: int
+    ok: bool
+    status: Optional[str] = None
+    good_quantity: Optional[int] = None
+    defective_quantity: Optional[int] = None
+    logs: List[str] = []
+    error: Optional[str] = None
+
+
+class BatchCompleteResult(BaseModel):
+    committed: bool
+    completed: int
+    rejected: int
+    results: List[BatchCompleteItemResult]
+
+
 class ProductBase(BaseModel):
     name: str
     code: str
@@ -106,12 +146,96 @@ class TaskOut(BaseModel):
     responsible_username: Optional[str] = None
     # --- КОНЕЦ НОВЫХ ПОЛЕЙ ---
 
+    assigned_at: Optional[datetime] = None
     start_time_actual: Optional[datetime] = None
     end_time_actual: Optional[datetime] = None
 
     class Config:
         from_attributes = True
 
+# --- Operator queue ---
+class QueueMaterial(BaseModel):
+    material_id: int
+    material_name: str
+    unit: str
+    quantity_required: float
+    stock_available: float
+
+
+# --- Автоназначение (autoassign.py) ---
+class AutoAssignment(BaseModel):
+    task_id: int
+    order_id: int
+    stage_name: str
+    responsible_user_id: int
+    responsible_username: str
+    estimated_minutes: float  # С учетом скорости оператора на этапе
+    finish_in_minutes: float  # Окончание с учетом очереди оператора, от текущего момента
+
+
+class OperatorLoad(BaseModel):
+    user_id: int
+    username: str
+    assigned: int  # Назначено этим прогоном
+    queue_minutes: float  # Оценка незавершенной работы после назначения
+
+
+class AutoAssignResult(BaseModel):
+    dry_run: bool
+    assigned: int
+    operators: List[OperatorLoad]
+    assignments: List[AutoAssignment]
+
+
+class OperatorQueueItem(BaseModel):
+    task_id: int
+    status: str
+    stage_name: str
+    order_id: int
+    client_name: str
+    order_quantity: int
+    deadline_date: Optional[datetime] = None
+    product_id: int
+    product_name: str
+    product_code: str
+    order_in_chain: Optional[int] = None
+    norm_time_minutes: Optional[int] = None
+    start_time_actual: Optional[datetime] = None
+    materials: List[QueueMaterial] = []
+
+
+# --- Состав изделия (bom.py) ---
+class BomMaterialLine(BaseModel):
+    material_id: int
+    material_name: str
+    unit: str
+    quantity: float
+
+
+class BomStageLine(BaseModel):
+    stage_name: str  # Этап (цех) — суммарно по изделию и полуфабрикатам
+    minutes: float
+
+
+class BomComponentLine(BaseModel):
+    product_id: int
+    product_code: str
+    product_name: str
+    quantity: float  # На всех уровнях состава
+
+
+class BomExplosion(BaseModel):
+    product_id: int
+    product_code: str
+    product_name: str
+    quantity: float
+    depth: int  # Уровней полуфабрикатов
+    total_minutes: float
+    materials: List[BomMaterialLine]
+    stages: List[BomStageLine]
+    components: List[BomComponentLine]
+
+
 class AvailabilityCheckItem(BaseModel):
     material_name: str
     unit: str
@@ -121,6 +245,83 @@ class AvailabilityCheckItem(BaseModel):
     deficit_amount: float
 
 
+# --- Report jobs ---
+class ReportJobCreate(BaseModel):
+    report_type: str = "materials-by-stage"
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    format: Literal["csv", "json"] = "csv"
+
+
+class ReportJobOut(BaseModel):
+    id: int
+    report_type: str
+    params: dict
+    data_version: str
+    status: str
+    row_count: Optional[int] = None
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    download_url: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
+class StageThroughputRow(BaseModel):
+    # Поля группировки (заполнены только выбранные в group_by)
+    day: Optional[date] = None
+    stage_name: Optional[str] = None
+    product_id: Optional[int] = None
+    operator_id: Optional[int] = None
+
+    task_count: int
+    avg_cycle_minutes: Optional[float] = None
+    min_cycle_minutes: Optional[float] = None
+    max_cycle_minutes: Optional[float] = None
+    p50_cycle_minutes: Optional[float] = None
+    p90_cycle_minutes: Optional[float] = None
+    p95_cycle_minutes: Optional[float] = None
+    total_cycle_minutes: float
+    total_norm_minutes: float
+    actual_to_norm_ratio: Optional[float] = None
+
+
+class QualityStatsRow(BaseModel):
+    day: Optional[date] = None
+    stage_name: Optional[str] = None
+    product_id: Optional[int] = None
+    operator_id: Optional[int] = None
+
+    completions: int
+    rework_count: int
+    rework_rate: Optional[float] = None
+    total_quantity: int
+    defective_quantity: int
+    defect_rate: Optional[float] = None
+
+
+class QualityEventOut(BaseModel):
+    id: int
+    created_at: datetime
+    task_id: int
+    order_id: int
+    product_id: int
+    stage_name: str
+    operator_id: Optional[int] = None
+    reported_by_id: int
+    quantity: int
+    good_quantity: int
+    defective_quantity: int
+    is_rework: bool
+    comment: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+
 class MaterialReportRow(BaseModel):
     order_id: int
     product_name: str
@@ -131,4 +332,124 @@ class MaterialReportRow(BaseModel):
     completion_date: Optional[datetime]
 
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+
+# --- Import ---
+class ImportRowError(BaseModel):
+    row: int
+    message: str
+
+
+class ImportReport(BaseModel):
+    rows_total: int = 0
+    rows_imported: int = 0
+    rows_failed: int = 0
+    products_created: int = 0
+    products_updated: int = 0
+    stages_created: int = 0
+    stages_updated: int = 0
+    materials_created: int = 0
+    materials_updated: int = 0
+    requirements_created: int = 0
+    requirements_updated: int = 0
+    components_created: int = 0
+    components_updated: int = 0
+    dry_run: bool = False
+    committed: bool = False  # Изменения зафиксированы; при откате (dry_run, ошибка файла) — False
+    errors: List[ImportRowError] = []
+
+
+class AuditEventOut(BaseModel):
+    id: int
+    created_at: datetime
+    action: str
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    order_id: Optional[int] = None
+    task_id: Optional[int] = None
+    entity: Optional[str] = None
+    entity_id: Optional[int] = None
+    details: dict = {}
+
+    class Config:
+        from_attributes = True
+
+
+class SyncDeleted(BaseModel):
+    tasks: List[int] = []
+    orders: List[int] = []
+    materials: List[int] = []
+
+
+SyncEntity = Literal["tasks", "orders", "materials"]
+
+
+class SyncChanges(BaseModel):
+    """Ответ /sync/changes: version — новая отметка для следующего запроса (since=version)."""
+    version: int
+    has_more: bool  # Страница неполная — сразу запросить еще раз с since=version
+    # Версия version отдана не полностью: передать в следующий запрос вместе с since
+    after_entity: Optional[SyncEntity] = None
+    after_id: Optional[int] = None
+    tasks: List[TaskOut] = []
+    orders: List[OrderOut] = []
+    materials: List[MaterialOut] = []
+    deleted: SyncDeleted = SyncDeleted()
+
+
+SearchKind = Literal["product", "material", "client", "order"]
+
+
+class SearchHit(BaseModel):
+    kind: SearchKind
+    id: int  # Для клиента — его последний заказ
+    title: str
+    subtitle: Optional[str] = None
+    score: float  # 0..1, 1 — запрос целиком найден в тексте
+
+
+class SearchResults(BaseModel):
+    query: str
+    backend: str  # trigram (PostgreSQL) или memory
+    hits: List[SearchHit]
+
+
+class OrderQuoteRequest(BaseModel):
+    product_id: int
+    quantity: int
+    deadline_date: Optional[datetime] = None  # Если указан — проверить, успеваем ли
+
+
+class QuoteStage(BaseModel):
+    stage_name: str
+    start_at: datetime
+    finish_at: datetime
+    wait_minutes: float  # Ожидание линии цеха или поставки материала перед этапом
+
+
+class QuoteMaterial(BaseModel):
+    material_id: int
+    material_name: str
+    unit: str
+    required: float
+    available: float  # Остаток за вычетом потребности открытых заказов
+    shortage: float
+
+
+class QuoteBlocking(BaseModel):
+    kind: Literal["stage", "material"]
+    name: str  # Этап (цех) или материал
+    wait_minutes: float
+
+
+class OrderQuote(BaseModel):
+    """Котировка срока нового заказа (atp.py); в БД ничего не записывается."""
+    product_id: int
+    quantity: int
+    earliest_finish_at: datetime
+    lead_time_minutes: float
+    meets_deadline: Optional[bool] = None
+    blocking: Optional[QuoteBlocking] = None  # Что сильнее всего отодвигает срок; None — ничего
+    stages: List[QuoteStage] = []
+    materials: List[QuoteMaterial] = []
@@ -0,0 +1,302 @@
+"""
+Поиск по справочникам и заказам: изделия (название, код), материалы (название),
+клиенты (client_name заказов) и заказы по номеру ("1234", "#1234", "№1234").
+
+Совпадение нечеткое, по триграммам слов: "прут" находит "Пруток стальной 20мм",
+"nc10" — "PUMP-NC10". Оценка — доля триграмм запроса, найденных в тексте (как
+word_similarity в pg_trgm): 1.0 — запрос целиком совпал с началом слова текста.
+Выдача общая по всем видам, по убыванию оценки; номер заказа — точное совпадение (1.0).
+
+Бэкенды (переменная SEARCH_BACKEND: "trigram", "memory", по умолчанию "auto" — по СУБД):
+- trigram — PostgreSQL: GIN-индексы gin_trgm_ops (models.trigram_index), отбор операторами
+  <% и ILIKE идет по индексу, таблица целиком не читается;
+- memory — n-граммный индекс в памяти процесса, свой у каждого завода (SQLite в тестах).
+  Строится при первом поиске, дальше обновляется точечно по событиям шины инвалидации.
+"""
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+from sqlalchemy import func, literal, or_, text
+from sqlalchemy.orm import Session
+
+import invalidation
+import models
+import plants
+import schemas
+from invalidation import EventKind
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto")
+SEARCH_THRESHOLD = float(os.getenv("SEARCH_THRESHOLD", "0.5"))  # Минимальная оценка совпадения
+KINDS = ("product", "material", "client", "order")
+
+_WORD = re.compile(r"\w+")
+_ORDER_NUMBER = re.compile(r"^[#№]?\s*(\d+)$")
+
+
+def trigrams(value: Optional[str]) -> Set[str]:
+    """Триграммы слов как в pg_trgm: слово в нижнем регистре с двумя пробелами слева и одним справа."""
+    grams = set()
+    for word in _WORD.findall((value or "").lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NgramIndex:
+    """Инвертированный индекс "триграмма -> ключи" с оценкой как у word_similarity."""
+
+    def __init__(self):
+        self._texts: Dict[Hashable, str] = {}
+        self._grams: Dict[Hashable, Set[str]] = {}
+        self._postings: Dict[str, Set[Hashable]] = defaultdict(set)
+
+    def put(self, key: Hashable, value: Optional[str]):
+        self.remove(key)
+        grams = trigrams(value)
+        self._texts[key] = (value or "").lower()
+        self._grams[key] = grams
+        for gram in grams:
+            self._postings[gram].add(key)
+
+    def remove(self, key: Hashable):
+        for gram in self._grams.pop(key, ()):
+            keys = self._postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[gram]
+        self._texts.pop(key, None)
+
+    def search(self, query: str, limit: int, threshold: float = SEARCH_THRESHOLD) -> List[Tuple[Hashable, float]]:
+        grams = trigrams(query)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        needle = query.strip().lower()
+        hits = []
+        for key, count in shared.items():
+            score = 1.0 if needle in self._texts[key] else count / len(grams)
+            if score >= threshold:
+                hits.append((key, score))
+        hits.sort(key=lambda hit: (-hit[1], len(self._texts[hit[0]]), hit[0]))
+        return hits[:limit]
+
+    def __len__(self):
+        return len(self._texts)
+
+
+# --- ИНДЕКС В ПАМЯТИ ---
+
+class _PlantIndex:
+    """Индексы одного завода. dirty: вид -> id для перечитывания; None — перестроить целиком."""
+
+    def __init__(self):
+        self.products = NgramIndex()
+        self.product_info: Dict[int, Tuple[str, str]] = {}
+        self.materials = NgramIndex()
+        self.material_info: Dict[int, Tuple[str, str]] = {}
+        self.clients = NgramIndex()  # Ключ — имя клиента
+        self.client_of: Dict[int, str] = {}  # order_id -> client_name
+        self.client_orders: Dict[str, Set[int]] = defaultdict(set)
+        self.dirty: Dict[str, Optional[Set[int]]] = {"product": None, "material": None, "order": None}
+
+    def mark(self, kind: str, ids: List[int]):
+        if not ids:
+            self.dirty[kind] = None
+        elif kind not in self.dirty:
+            self.dirty[kind] = set(ids)
+        elif self.dirty[kind] is not None:
+            self.dirty[kind].update(ids)
+
+    def refresh(self, db: Session):
+        for kind, ids in list(self.dirty.items()):
+            getattr(self, f"_load_{kind}s")(db, ids)
+        self.dirty.clear()
+
+    def _load_products(self, db: Session, ids: Optional[Set[int]]):
+        query = db.query(models.Product.id, models.Product.name, models.Product.code)
+        if ids is None:
+            self.products, self.product_info = NgramIndex(), {}
+        else:
+            query = query.filter(models.Product.id.in_(ids))
+        found = set()
+        for row in query:
+            found.add(row.id)
+            self.products.put(row.id, f"{row.name or ''} {row.code or ''}")
+            self.product_info[row.id] = (row.name or "", row.code or "")
+        for product_id in (ids or set()) - found:
+            self.products.remove(product_id)
+            self.product_info.pop(product_id, None)
+
+    def _load_materials(self, db: Session, ids: Optional[Set[int]]):
+        query = db.query(models.Material.id, models.Material.name, models.Material.unit)
+        if ids is None:
+            self.materials, self.material_info = NgramIndex(), {}
+        else:
+            query = query.filter(models.Material.id.in_(ids))
+        found = set()
+        for row in query:
+            found.add(row.id)
+            self.materials.put(row.id, row.name)
+            self.material_info[row.id] = (row.name or "", row.unit or "")
+        for material_id in (ids or set()) - found:
+            self.materials.remove(material_id)
+            self.material_info.pop(material_id, None)
+
+    def _load_orders(self, db: Session, ids: Optional[Set[int]]):
+        query = db.query(models.ProductionOrder.id, models.ProductionOrder.client_name)
+        if ids is None:
+            self.clients, self.client_of, self.client_orders = NgramIndex(), {}, defaultdict(set)
+        else:
+            query = query.filter(models.ProductionOrder.id.in_(ids))
+        found = set()
+        for row in query:
+            found.add(row.id)
+            self._set_client(row.id, row.client_name or "")
+        for order_id in (ids or set()) - found:
+            self._set_client(order_id, None)
+
+    def _set_client(self, order_id: int, client_name: Optional[str]):
+        old = self.client_of.pop(order_id, None)
+        if old is not None:
+            self.client_orders[old].discard(order_id)
+            if not self.client_orders[old]:
+                del self.client_orders[old]
+                self.clients.remove(old)
+        if client_name:
+            self.client_of[order_id] = client_name
+            if client_name not in self.client_orders:
+                self.clients.put(client_name, client_name)
+            self.client_orders[client_name].add(order_id)
+
+
+class _MemoryBackend:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._plants: Dict[Optional[int], _PlantIndex] = {}
+
+    def search(self, db: Session, query: str, kinds: Set[str], limit: int) -> List[schemas.SearchHit]:
+        with self._lock:
+            index = self._plants.setdefault(plants.plant_of(db), _PlantIndex())
+            index.refresh(db)
+            hits = []
+            if "product" in kinds:
+                for product_id, score in index.products.search(query, limit):
+                    name, code = index.product_info[product_id]
+                    hits.append(schemas.SearchHit(kind="product", id=product_id, title=name, subtitle=code, score=score))
+            if "material" in kinds:
+                for material_id, score in index.materials.search(query, limit):
+                    name, unit = index.material_info[material_id]
+                    hits.append(schemas.SearchHit(kind="material", id=material_id, title=name, subtitle=unit,
+                                                  score=score))
+            if "client" in kinds:
+                for client_name, score in index.clients.search(query, limit):
+                    order_ids = index.client_orders[client_name]
+                    hits.append(schemas.SearchHit(kind="client", id=max(order_ids), title=client_name,
+                                                  subtitle=f"Заказов: {len(order_ids)}", score=score))
+            return hits
+
+    def on_event(self, kind: str, event: invalidation.InvalidationEvent):
+        with self._lock:
+            for plant_id, index in self._plants.items():
+                if event.plant_id is None or event.plant_id == plant_id:
+                    index.mark(kind, event.ids)
+
+    def reset(self):
+        with self._lock:
+            self._plants.clear()
+
+
+memory_backend = _MemoryBackend()
+
+
+# --- ТРИГРАММНЫЕ ИНДЕКСЫ POSTGRESQL ---
+
+def _matches(query: str, *columns):
+    pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    conditions = []
+    for column in columns:
+        conditions += [literal(query).op("<%")(column), column.ilike(pattern, escape="\\")]
+    return or_(*conditions)
+
+
+def _score(query: str, *columns):
+    scores = [func.coalesce(func.word_similarity(query, column), 0) for column in columns]
+    return scores[0] if len(scores) == 1 else func.greatest(*scores)
+
+
+def _trigram_search(db: Session, query: str, kinds: Set[str], limit: int) -> List[schemas.SearchHit]:
+    # Порог оператора <% — как у поиска в памяти; действует до конца транзакции
+    db.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :value, true)"),
+               {"value": str(SEARCH_THRESHOLD)})
+    hits = []
+    if "product" in kinds:
+        score = _score(query, models.Product.name, models.Product.code)
+        for row in db.query(models.Product.id, models.Product.name, models.Product.code, score.label("score")).filter(
+                _matches(query, models.Product.name, models.Product.code)
+        ).order_by(score.desc(), func.length(models.Product.name), models.Product.id).limit(limit):
+            hits.append(schemas.SearchHit(kind="product", id=row.id, title=row.name or "", subtitle=row.code,
+                                          score=row.score))
+    if "material" in kinds:
+        score = _score(query, models.Material.name)
+        for row in db.query(models.Material.id, models.Material.name, models.Material.unit, score.label("score")).filter(
+                _matches(query, models.Material.name)
+        ).order_by(score.desc(), func.length(models.Material.name), models.Material.id).limit(limit):
+            hits.append(schemas.SearchHit(kind="material", id=row.id, title=row.name or "", subtitle=row.unit,
+                                          score=row.score))
+    if "client" in kinds:
+        client = models.ProductionOrder.client_name
+        score = _score(query, client)
+        for row in db.query(client, func.count(models.ProductionOrder.id).label("orders"),
+                            func.max(models.ProductionOrder.id).label("last_order_id"), score.label("score")).filter(
+                _matches(query, client)
+        ).group_by(client).order_by(score.desc(), func.length(client), client).limit(limit):
+            hits.append(schemas.SearchHit(kind="client", id=row.last_order_id, title=row.client_name,
+                                          subtitle=f"Заказов: {row.orders}", score=row.score))
+    return hits
+
+
+# --- ПОИСК ---
+
+def backend_for(db: Session) -> str:
+    if SEARCH_BACKEND != "auto":
+        return SEARCH_BACKEND
+    return "trigram" if db.get_bind().dialect.name == "postgresql" else "memory"
+
+
+def _order_hits(db: Session, query: str) -> List[schemas.SearchHit]:
+    match = _ORDER_NUMBER.match(query.strip())
+    if match is None:
+        return []
+    order = db.query(models.ProductionOrder.id, models.ProductionOrder.client_name).filter(
+        models.ProductionOrder.id == int(match.group(1))
+    ).first()
+    if order is None:
+        return []
+    return [schemas.SearchHit(kind="order", id=order.id, title=f"Заказ №{order.id}", subtitle=order.client_name,
+                              score=1.0)]
+
+
+def search(db: Session, query: str, kinds: Optional[List[str]] = None, limit: int = 20) -> schemas.SearchResults:
+    """Ранжированная выдача по видам kinds (по умолчанию — все) в пределах завода сессии."""
+    kinds = set(kinds or KINDS)
+    backend = backend_for(db)
+    hits = _order_hits(db, query) if "order" in kinds else []
+    if backend == "trigram":
+        hits += _trigram_search(db, query, kinds, limit)
+    else:
+        hits += memory_backend.search(db, query, kinds, limit)
+    hits.sort(key=lambda hit: -hit.score)  # Устойчивая: при равной оценке порядок видов и внутри вида сохраняется
+    return schemas.SearchResults(query=query, backend=backend, hits=hits[:limit])
+
+
+# --- ИНВАЛИДАЦИЯ ---
+
+invalidation.subscribe(EventKind.PRODUCT_CHANGED, lambda event: memory_backend.on_event("product", event))
+invalidation.subscribe(EventKind.MATERIAL_CHANGED, lambda event: memory_backend.on_event("material", event))
+invalidation.subscribe(EventKind.ORDER_CHANGED, lambda event: memory_backend.on_event("order", event))
+invalidation.subscribe(EventKind.RESYNC, lambda event: memory_backend.reset())
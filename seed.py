@@ -1,5 +1,9 @@
 from database import SessionLocal, engine
 import models
+import plants
+import rollups
+import deadlines
+import sync  # noqa: F401  (версии строк для /sync/changes выдаются при коммите сида)
 from security import get_password_hash
 from datetime import datetime, timedelta, timezone, UTC
 from sqlalchemy.orm import Session
@@ -8,6 +12,7 @@ from typing import List
 # 1. Чистим базу данных
 models.Base.metadata.drop_all(bind=engine)
 models.Base.metadata.create_all(bind=engine)
+plants.ensure_plants()
 
 db = SessionLocal()
 
@@ -235,6 +240,12 @@ def seed_data():
         models.StageMaterialRequirement(tech_stage_id=s3_p6.id, material_id=mat_paint_blue.id, quantity_needed=1.5),
     ])
 
+    # Полуфабрикаты: насос собирается на раме-основании с валом ВН-12
+    db.add_all([
+        models.StageComponentRequirement(tech_stage_id=s3_p1.id, component_product_id=p4.id, quantity_needed=1.0),
+        models.StageComponentRequirement(tech_stage_id=s3_p1.id, component_product_id=p6.id, quantity_needed=1.0),
+    ])
+
     db.commit()
     print("✅ 6 техкарт настроены с общими этапами.")
 
@@ -276,6 +287,12 @@ def seed_data():
 
     print("✅ 8 тестовых заказов с разными статусами созданы.")
 
+    rollups.rebuild(db)
+    print("✅ Агрегаты длительности этапов пересчитаны.")
+
+    deadlines.evaluate(db)
+    print("✅ Прогнозы сроков и статусы заказов обновлены.")
+
     db.close()
     print("🚀 Успех! База данных полностью готова к демонстрации (Металлургия/Машиностроение).")
 
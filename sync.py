@@ -0,0 +1,254 @@
+"""
+Дельта-синхронизация для терминалов цеха: задачи, заказы, материалы.
+
+У каждой синхронизируемой строки есть row_version. Версии выдает счетчик sync_clock
+(одна строка) в момент коммита: UPDATE счетчика — последняя блокировка транзакции и
+держится только до COMMIT, поэтому порядок версий совпадает с порядком коммитов.
+Следствие: если закоммичено значение счетчика V, все строки с версией <= V уже видны.
+
+Версия меняется, только если изменилось поле, которое отдается терминалам
+(фоновый пересчет прогноза сроков не гоняет заказы через синхронизацию).
+Удаления (в том числе перенос в архив) оставляют строки sync_tombstones;
+старше SYNC_TOMBSTONE_DAYS они удаляются, и клиенту с более старой версией
+отвечают 410 — нужна полная загрузка с since=0.
+
+Клиент:
+    GET /sync/changes?since=0        -> полная загрузка (постранично, пока has_more)
+    GET /sync/changes?since=<version> -> только изменившиеся и удаленные строки
+    Пока has_more, следующий запрос — since=version (и after_entity/after_id, если они в ответе).
+"""
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, insert, inspect, select, tuple_, update
+from sqlalchemy.orm import Session, joinedload
+
+import database
+import models
+import schemas
+
+SYNC_TOMBSTONE_DAYS = int(os.getenv("SYNC_TOMBSTONE_DAYS", "30"))
+SYNC_PAGE_LIMIT = 5000
+CLOCK_ID = 1
+
+
+class ResyncRequired(Exception):
+    """Версия клиента старше забытых удалений или новее сервера — нужна полная загрузка."""
+
+
+# Сущность -> (модель, схема ответа). Синхронизируются поля схемы, которые есть в таблице.
+ENTITIES: Dict[str, Tuple[type, type]] = {
+    "tasks": (models.ProductionTask, schemas.TaskOut),
+    "orders": (models.ProductionOrder, schemas.OrderOut),
+    "materials": (models.Material, schemas.MaterialOut),
+}
+_ENTITY_ORDER = list(ENTITIES)  # Порядок сущностей внутри одной версии (курсор страницы)
+_ENTITY_BY_MODEL = {model: name for name, (model, _) in ENTITIES.items()}
+_SYNCED_FIELDS = {
+    model: [name for name in schema.model_fields if name in model.__table__.columns]
+    for model, schema in ENTITIES.values()
+}
+
+_PENDING = "sync_pending"  # Ключ в session.info: {"changed": [...], "changed_ids": [...], "deleted": [...]}
+
+
+# --- ВЕРСИИ ---
+
+def ensure_clock(db: Session):
+    """Создает счетчик и выдает версию строкам, созданным без нее (сид, старые данные)."""
+    if db.get(models.SyncClock, CLOCK_ID) is None:
+        db.add(models.SyncClock(id=CLOCK_ID, version=0, tombstone_floor=0))
+        db.flush()
+    models_without_version = [
+        model for model, _ in ENTITIES.values()
+        if db.query(model.id).filter(model.row_version == 0).first() is not None
+    ]
+    if models_without_version:
+        version = _next_version(db)
+        for model in models_without_version:
+            db.query(model).filter(model.row_version == 0).update(
+                {model.row_version: version}, synchronize_session=False
+            )
+    db.commit()
+
+
+def _next_version(session: Session) -> int:
+    conn = session.connection()
+    result = conn.execute(
+        update(models.SyncClock).where(models.SyncClock.id == CLOCK_ID).values(version=models.SyncClock.version + 1)
+    )
+    if result.rowcount == 0:  # Счетчик еще не создан (ensure_clock не вызывался)
+        conn.execute(insert(models.SyncClock).values(id=CLOCK_ID, version=1, tombstone_floor=0))
+    return conn.execute(select(models.SyncClock.version).where(models.SyncClock.id == CLOCK_ID)).scalar_one()
+
+
+def _pending(session: Session) -> Dict[str, list]:
+    return session.info.setdefault(_PENDING, {"changed": [], "changed_ids": [], "deleted": []})
+
+
+def _synced_fields_changed(obj) -> bool:
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in _SYNCED_FIELDS[type(obj)])
+
+
+def mark_changed(session: Session, entity: str, ids: Iterable[int]):
+    """Изменения в обход ORM (bulk update): версия будет выдана строкам при коммите."""
+    _pending(session)["changed_ids"].extend((entity, entity_id) for entity_id in ids)
+
+
+def mark_deleted(session: Session, entity: str, ids: Iterable[int]):
+    """Удаления в обход ORM (bulk delete) в сессии завода: надгробия будут записаны при коммите."""
+    plant_id = session.info.get("plant_id")
+    _pending(session)["deleted"].extend((entity, entity_id, plant_id) for entity_id in ids)
+
+
+@event.listens_for(database.SessionLocal, "before_flush")
+def _collect_changes(session, flush_context, instances):
+    pending = None
+    for obj in session.new:
+        if type(obj) in _ENTITY_BY_MODEL:
+            pending = pending or _pending(session)
+            pending["changed"].append(obj)
+    for obj in session.dirty:
+        if type(obj) in _ENTITY_BY_MODEL and _synced_fields_changed(obj):
+            pending = pending or _pending(session)
+            pending["changed"].append(obj)
+    for obj in session.deleted:
+        if type(obj) in _ENTITY_BY_MODEL:
+            pending = pending or _pending(session)
+            pending["deleted"].append((_ENTITY_BY_MODEL[type(obj)], obj.id, obj.plant_id))
+
+
+@event.listens_for(database.SessionLocal, "before_commit")
+def _assign_versions(session):
+    session.flush()  # Изменения после последнего flush тоже попадают в pending
+    pending = session.info.pop(_PENDING, None)
+    if not pending or not (pending["changed"] or pending["changed_ids"] or pending["deleted"]):
+        return
+
+    version = _next_version(session)
+    for obj in pending["changed"]:
+        if obj in session and not inspect(obj).deleted:
+            obj.row_version = version
+    ids_by_entity = defaultdict(set)
+    for entity, entity_id in pending["changed_ids"]:
+        ids_by_entity[entity].add(entity_id)
+    for entity, ids in ids_by_entity.items():
+        model = ENTITIES[entity][0]
+        session.execute(
+            update(model).where(model.id.in_(ids)).values(row_version=version),
+            execution_options={"synchronize_session": False},
+        )
+    if pending["deleted"]:
+        session.execute(insert(models.SyncTombstone), [
+            {"entity": entity, "entity_id": entity_id, "plant_id": plant_id, "row_version": version,
+             "deleted_at": datetime.now(UTC)}
+            for entity, entity_id, plant_id in pending["deleted"]
+        ])
+    # row_version допишется финальным flush внутри commit()
+
+
+@event.listens_for(database.SessionLocal, "after_rollback")
+def _discard_changes(session):
+    session.info.pop(_PENDING, None)
+
+
+# --- ЧТЕНИЕ ИЗМЕНЕНИЙ ---
+
+def _serialize(entity: str, rows: List) -> List:
+    model, schema = ENTITIES[entity]
+    items = []
+    for row in rows:
+        item = schema.model_validate(row, from_attributes=True)
+        if entity == "tasks" and row.responsible_user is not None:
+            item.responsible_username = row.responsible_user.username
+        items.append(item)
+    return items
+
+
+def _query(db: Session, entity: str, since: int, upper: int, after: Optional[Tuple[str, int]], limit: int) -> List:
+    """Строки сущности после курсора в порядке (row_version, id), не старше upper."""
+    model = ENTITIES[entity][0]
+    query = db.query(model).filter(model.row_version <= upper)
+    position = _ENTITY_ORDER.index(entity)
+    if after is None or position < _ENTITY_ORDER.index(after[0]):
+        query = query.filter(model.row_version > since)
+    elif position == _ENTITY_ORDER.index(after[0]):
+        query = query.filter(tuple_(model.row_version, model.id) > tuple_(since, after[1]))
+    else:
+        query = query.filter(model.row_version >= since)  # Версия since этой сущностью еще не отдана
+    if entity == "tasks":
+        query = query.options(joinedload(models.ProductionTask.responsible_user))
+    return query.order_by(model.row_version, model.id).limit(limit).all()
+
+
+def changes(db: Session, since: int = 0, limit: int = SYNC_PAGE_LIMIT,
+            after: Optional[Tuple[str, int]] = None) -> schemas.SyncChanges:
+    """
+    Строки, измененные после версии since, и удаленные id. since=0 — полная загрузка.
+
+    Страница — первые limit строк в порядке (row_version, сущность, id). Если одна версия
+    не помещается в страницу (ensure_clock выдает одну версию всем строкам сида), ответ
+    останавливается внутри нее: after_entity/after_id — последняя отданная строка, и
+    следующий запрос передает их вместе с since=version.
+    """
+    clock = db.get(models.SyncClock, CLOCK_ID)
+    current, floor = (clock.version, clock.tombstone_floor) if clock else (0, 0)
+    if since > current or 0 < since < floor:
+        raise ResyncRequired()
+
+    candidates = sorted(
+        (row.row_version, _ENTITY_ORDER.index(entity), row.id, entity, row)
+        for entity in ENTITIES
+        for row in _query(db, entity, since, current, after, limit + 1)
+    )
+    page, rest = candidates[:limit], candidates[limit:]
+
+    version, cursor = current, None
+    if rest:
+        last, following = page[-1], rest[0]
+        version = last[0]
+        if following[0] == version:
+            cursor = (last[3], last[2])  # Версия отдана не полностью
+
+    fetched = {entity: [] for entity in ENTITIES}
+    for _, _, _, entity, row in page:
+        fetched[entity].append(row)
+
+    deleted = {entity: [] for entity in ENTITIES}
+    if since > 0:
+        for tombstone in db.query(models.SyncTombstone).filter(
+                models.SyncTombstone.row_version > since, models.SyncTombstone.row_version <= version
+        ).order_by(models.SyncTombstone.row_version):
+            deleted[tombstone.entity].append(tombstone.entity_id)
+
+    return schemas.SyncChanges(
+        version=version,
+        has_more=bool(rest),
+        after_entity=cursor[0] if cursor else None,
+        after_id=cursor[1] if cursor else None,
+        tasks=_serialize("tasks", fetched["tasks"]),
+        orders=_serialize("orders", fetched["orders"]),
+        materials=_serialize("materials", fetched["materials"]),
+        deleted=schemas.SyncDeleted(**deleted),
+    )
+
+
+def purge_tombstones(db: Session, older_than_days: int = SYNC_TOMBSTONE_DAYS) -> int:
+    """Удаляет старые надгробия и поднимает tombstone_floor (клиентам старше — 410)."""
+    cutoff = datetime.now(UTC) - timedelta(days=older_than_days)
+    floor = db.query(func.max(models.SyncTombstone.row_version)).filter(
+        models.SyncTombstone.deleted_at < cutoff
+    ).scalar()
+    if floor is None:
+        return 0
+    purged = db.query(models.SyncTombstone).filter(
+        models.SyncTombstone.row_version <= floor
+    ).delete(synchronize_session=False)
+    db.execute(update(models.SyncClock).where(models.SyncClock.id == CLOCK_ID).where(
+        models.SyncClock.tombstone_floor < floor
+    ).values(tombstone_floor=floor))
+    db.commit()
+    return purged
@@ -0,0 +1,356 @@
+"""
+Потоковый импорт техкарт, изделий и материалов из CSV/XLSX.
+
+Файл читается построчно (без загрузки целиком в память). Каждая строка может описывать
+изделие, материал, этап техкарты и потребность этапа в материале — в любом сочетании:
+
+    product_code;product_name;product_description;stage_name;order_in_chain;norm_time_minutes;
+    material_name;unit;quantity_in_stock;quantity_needed;component_code
+
+quantity_needed относится к material_name (норма расхода материала) или к component_code
+(сколько штук полуфабриката — другого изделия — идет на этап). Перед коммитом состав
+изделий проверяется на циклы.
+
+Ссылки на изделия, этапы и материалы разрешаются через словари в памяти, загруженные
+одним запросом на таблицу. Изменения сбрасываются в БД пачками (flush), а фиксируются
+одной транзакцией в конце импорта.
+"""
+import codecs
+import csv
+from typing import Dict, Iterator, Optional, Tuple
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+
+import bom
+import models
+import schemas
+
+try:  # XLSX — опциональная зависимость
+    import openpyxl
+except ImportError:  # pragma: no cover
+    openpyxl = None
+
+BATCH_SIZE = 1000  # Сколько строк копим в сессии перед flush
+MAX_REPORTED_ERRORS = 500  # Ошибки сверх лимита только считаются
+
+
+class RowError(ValueError):
+    """Ошибка валидации конкретной строки файла."""
+
+
+# --- ЧТЕНИЕ ФАЙЛОВ ---
+
+def iter_csv_rows(binary_file) -> Iterator[Dict[str, str]]:
+    """Построчно читает CSV (разделитель ';' или ',', кодировка UTF-8 с BOM или без)."""
+    reader = codecs.getreader("utf-8-sig")(binary_file)
+    header_line = reader.readline()
+    delimiter = ";" if header_line.count(";") >= header_line.count(",") else ","
+    header = [h.strip().lower() for h in next(csv.reader([header_line], delimiter=delimiter))]
+
+    for values in csv.reader(reader, delimiter=delimiter):
+        if not any(v.strip() for v in values):
+            continue
+        yield dict(zip(header, values))
+
+
+def iter_xlsx_rows(binary_file) -> Iterator[Dict[str, str]]:
+    """Построчно читает первый лист XLSX в режиме read_only."""
+    if openpyxl is None:
+        raise RowError("Для импорта XLSX требуется пакет openpyxl")
+
+    workbook = openpyxl.load_workbook(binary_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(h).strip().lower() if h is not None else "" for h in next(rows, ())]
+        for values in rows:
+            if not any(v not in (None, "") for v in values):
+                continue
+            yield {key: ("" if value is None else str(value)) for key, value in zip(header, values)}
+    finally:
+        workbook.close()
+
+
+def iter_rows(filename: str, binary_file) -> Iterator[Dict[str, str]]:
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        return iter_xlsx_rows(binary_file)
+    return iter_csv_rows(binary_file)
+
+
+# --- РАЗБОР ЗНАЧЕНИЙ ---
+
+def _text(row: Dict[str, str], key: str) -> Optional[str]:
+    value = (row.get(key) or "").strip()
+    return value or None
+
+
+def _number(row: Dict[str, str], key: str, cast=float):
+    value = _text(row, key)
+    if value is None:
+        return None
+    try:
+        # Excel в русской локали отдает десятичную запятую
+        number = float(value.replace(" ", "").replace(",", "."))
+    except ValueError:
+        raise RowError(f"Колонка '{key}': '{value}' не является числом")
+    if number < 0:
+        raise RowError(f"Колонка '{key}': значение не может быть отрицательным")
+    return cast(number)
+
+
+# --- ИМПОРТ ---
+
+class TechCardImporter:
+    """Держит словари поиска и счетчики одного импорта."""
+
+    def __init__(self, db: Session):
+        self.db = db
+        self.report = schemas.ImportReport()
+
+        self.products: Dict[str, models.Product] = {
+            p.code: p for p in db.query(models.Product).all()
+        }
+        self.materials: Dict[str, models.Material] = {
+            m.name: m for m in db.query(models.Material).all()
+        }
+        self.stages: Dict[Tuple[str, str], models.TechStage] = {
+            (code, stage.name): stage
+            for stage, code in db.query(models.TechStage, models.Product.code).join(models.Product)
+        }
+        self.requirements: Dict[Tuple[str, str, str], models.StageMaterialRequirement] = {
+            (code, stage_name, material_name): req
+            for req, code, stage_name, material_name in db.query(
+                models.StageMaterialRequirement, models.Product.code, models.TechStage.name, models.Material.name
+            ).join(models.TechStage, models.StageMaterialRequirement.stage)
+            .join(models.Product, models.TechStage.product)
+            .join(models.Material, models.StageMaterialRequirement.material)
+        }
+        component_product = aliased(models.Product)
+        self.components: Dict[Tuple[str, str, str], models.StageComponentRequirement] = {
+            (code, stage_name, component_code): req
+            for req, code, stage_name, component_code in db.query(
+                models.StageComponentRequirement, models.Product.code, models.TechStage.name, component_product.code
+            ).join(models.TechStage, models.StageComponentRequirement.stage)
+            .join(models.Product, models.TechStage.product)
+            .join(component_product, models.StageComponentRequirement.component)
+        }
+
+    def _count(self, entity: str, created: bool):
+        field = f"{entity}_{'created' if created else 'updated'}"
+        setattr(self.report, field, getattr(self.report, field) + 1)
+
+    def _parse(self, row: Dict[str, str]) -> Dict:
+        """Разбирает и проверяет строку целиком до каких-либо изменений в сессии."""
+        values = {
+            "product_code": _text(row, "product_code"),
+            "product_name": _text(row, "product_name"),
+            "product_description": _text(row, "product_description"),
+            "stage_name": _text(row, "stage_name"),
+            "order_in_chain": _number(row, "order_in_chain", int),
+            "norm_time_minutes": _number(row, "norm_time_minutes", int),
+            "material_name": _text(row, "material_name"),
+            "unit": _text(row, "unit"),
+            "quantity_in_stock": _number(row, "quantity_in_stock"),
+            "quantity_needed": _number(row, "quantity_needed"),
+            "component_code": _text(row, "component_code"),
+        }
+        code, stage_name, material_name = values["product_code"], values["stage_name"], values["material_name"]
+        component_code = values["component_code"]
+
+        if code and code not in self.products and not values["product_name"]:
+            raise RowError(f"Изделие '{code}' не найдено, а product_name не указан")
+        if material_name and material_name not in self.materials and not values["unit"]:
+            raise RowError(f"Материал '{material_name}' не найден, а unit не указан")
+        if stage_name:
+            if not code:
+                raise RowError(f"Для этапа '{stage_name}' не указан product_code")
+            if (code, stage_name) not in self.stages and \
+                    (values["order_in_chain"] is None or values["norm_time_minutes"] is None):
+                raise RowError(f"Новый этап '{stage_name}' требует order_in_chain и norm_time_minutes")
+        if component_code:
+            if material_name:
+                raise RowError("quantity_needed относится либо к material_name, либо к component_code — не к обоим")
+            if component_code not in self.products:
+                raise RowError(f"Полуфабрикат '{component_code}' не найден среди изделий")
+            if component_code == code:
+                raise RowError(f"Изделие '{code}' не может входить само в себя")
+            if not stage_name or values["quantity_needed"] is None:
+                raise RowError("component_code требует stage_name и quantity_needed в той же строке")
+        if values["quantity_needed"] is not None and not (stage_name and (material_name or component_code)):
+            raise RowError("quantity_needed требует stage_name и material_name (или component_code) в той же строке")
+        if not (code or material_name):
+            raise RowError("Строка не содержит ни product_code, ни material_name")
+        return values
+
+    def _upsert_product(self, values) -> Optional[models.Product]:
+        code = values["product_code"]
+        if code is None:
+            return None
+
+        name, description = values["product_name"], values["product_description"]
+        product = self.products.get(code)
+
+        if product is None:
+            product = models.Product(code=code, name=name, description=description)
+            self.db.add(product)
+            self.products[code] = product
+            self._count("products", created=True)
+        elif (name and name != product.name) or (description and description != product.description):
+            product.name = name or product.name
+            product.description = description or product.description
+            self._count("products", created=False)
+        return product
+
+    def _upsert_material(self, values) -> Optional[models.Material]:
+        name = values["material_name"]
+        if name is None:
+            return None
+
+        unit, stock = values["unit"], values["quantity_in_stock"]
+        material = self.materials.get(name)
+
+        if material is None:
+            material = models.Material(name=name, unit=unit, quantity_in_stock=stock or 0.0)
+            self.db.add(material)
+            self.materials[name] = material
+            self._count("materials", created=True)
+        elif (unit and unit != material.unit) or (stock is not None and stock != material.quantity_in_stock):
+            material.unit = unit or material.unit
+            if stock is not None:
+                material.quantity_in_stock = stock
+            self._count("materials", created=False)
+        return material
+
+    def _upsert_stage(self, values, product: Optional[models.Product]) -> Optional[models.TechStage]:
+        stage_name = values["stage_name"]
+        if stage_name is None:
+            return None
+
+        order_in_chain, norm_time = values["order_in_chain"], values["norm_time_minutes"]
+        key = (product.code, stage_name)
+        stage = self.stages.get(key)
+
+        if stage is None:
+            stage = models.TechStage(product=product, name=stage_name,
+                                     order_in_chain=order_in_chain, norm_time_minutes=norm_time)
+            self.db.add(stage)
+            self.stages[key] = stage
+            self._count("stages", created=True)
+        elif (order_in_chain is not None and order_in_chain != stage.order_in_chain) or \
+                (norm_time is not None and norm_time != stage.norm_time_minutes):
+            if order_in_chain is not None:
+                stage.order_in_chain = order_in_chain
+            if norm_time is not None:
+                stage.norm_time_minutes = norm_time
+            self._count("stages", created=False)
+        return stage
+
+    def _upsert_requirement(self, values, product, stage, material):
+        quantity = values["quantity_needed"]
+        if quantity is None:
+            return
+
+        key = (product.code, stage.name, material.name)
+        requirement = self.requirements.get(key)
+
+        if requirement is None:
+            requirement = models.StageMaterialRequirement(stage=stage, material=material, quantity_needed=quantity)
+            self.db.add(requirement)
+            self.requirements[key] = requirement
+            self._count("requirements", created=True)
+        elif requirement.quantity_needed != quantity:
+            requirement.quantity_needed = quantity
+            self._count("requirements", created=False)
+
+    def _upsert_component(self, values, product, stage):
+        component_code, quantity = values["component_code"], values["quantity_needed"]
+        if component_code is None:
+            return
+
+        key = (product.code, stage.name, component_code)
+        requirement = self.components.get(key)
+
+        if requirement is None:
+            requirement = models.StageComponentRequirement(
+                stage=stage, component=self.products[component_code], quantity_needed=quantity
+            )
+            self.db.add(requirement)
+            self.components[key] = requirement
+            self._count("components", created=True)
+        elif requirement.quantity_needed != quantity:
+            requirement.quantity_needed = quantity
+            self._count("components", created=False)
+
+    def import_row(self, row: Dict[str, str]):
+        values = self._parse(row)
+        product = self._upsert_product(values)
+        material = self._upsert_material(values)
+        stage = self._upsert_stage(values, product)
+        if material is not None:
+            self._upsert_requirement(values, product, stage, material)
+        self._upsert_component(values, product, stage)
+
+    def add_error(self, row_number: int, message: str):
+        self.report.rows_failed += 1
+        if len(self.report.errors) < MAX_REPORTED_ERRORS:
+            self.report.errors.append(schemas.ImportRowError(row=row_number, message=message))
+
+    def run(self, rows: Iterator[Dict[str, str]]) -> schemas.ImportReport:
+        pending = 0
+        for row_number, row in enumerate(rows, start=2):  # Строка 1 — заголовок
+            self.report.rows_total += 1
+            try:
+                self.import_row(row)
+                self.report.rows_imported += 1
+            except RowError as e:
+                self.add_error(row_number, str(e))
+                continue
+
+            pending += 1
+            if pending >= BATCH_SIZE:
+                self.db.flush()
+                pending = 0
+
+        self.db.flush()
+        return self.report
+
+
+def _reject_file(db: Session, importer: TechCardImporter, message: str) -> schemas.ImportReport:
+    """Файл отклонен целиком: откат, счетчики изменений обнулены — в БД ничего не попало."""
+    db.rollback()
+    report = importer.report
+    importer.report = schemas.ImportReport(rows_total=report.rows_total, rows_failed=report.rows_failed,
+                                           errors=report.errors)
+    importer.add_error(0, message)
+    return importer.report
+
+
+def import_tech_cards(db: Session, filename: str, binary_file, dry_run: bool = False) -> schemas.ImportReport:
+    """
+    Импортирует файл одной транзакцией. При dry_run изменения откатываются.
+    report.committed — изменения действительно зафиксированы (только по нему публикуются события).
+    """
+    importer = TechCardImporter(db)
+    try:
+        report = importer.run(iter_rows(filename, binary_file))
+    except RowError as e:
+        report = _reject_file(db, importer, str(e))
+    except (csv.Error, UnicodeDecodeError) as e:
+        report = _reject_file(db, importer, f"Не удалось прочитать файл: {e}")
+    except IntegrityError as e:
+        # Например, то же изделие параллельно создал другой импорт
+        report = _reject_file(db, importer, f"Конфликт с данными в БД: {e.orig}")
+    else:
+        cycle = bom.find_cycle(db)
+        if cycle is not None:
+            report = _reject_file(db, importer, str(bom.BomCycleError(cycle)))
+        elif dry_run:
+            db.rollback()
+        else:
+            try:
+                db.commit()
+                report.committed = True
+            except IntegrityError as e:
+                report = _reject_file(db, importer, f"Конфликт с данными в БД: {e.orig}")
+    report.dry_run = dry_run
+    return report
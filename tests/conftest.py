@@ -0,0 +1,93 @@
+"""
+Общие фикстуры тестов: приложение на SQLite во временном файле (DATABASE_URL),
+чистая схема и сброшенные кэши процесса перед каждым тестом.
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, UTC
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import admission
+import atp
+import auth
+import bom
+import database
+import main
+import models
+import plants
+import report_cache
+import search
+import security
+import sync
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    plants.ensure_plants()
+    with database.SessionLocal() as session:
+        sync.ensure_clock(session)
+    report_cache.materials_report_cache.clear()
+    bom.engine.invalidate()
+    search.memory_backend.reset()
+    atp.engine.reset()
+    admission._role_cache.clear()
+    yield
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    yield session
+    session.close()
+
+
+def make_user(db, username: str, role: models.UserRole, plant_id: int = database.DEFAULT_PLANT_ID) -> models.User:
+    user = models.User(username=username, hashed_password=security.get_password_hash("secret"), role=role,
+                       plant_id=plant_id)
+    db.add(user)
+    db.commit()
+    return user
+
+
+def auth_headers(username: str, plant_id: int = database.DEFAULT_PLANT_ID) -> dict:
+    return {"Authorization": "Bearer " + auth.create_access_token({"sub": username, "plant": plant_id})}
+
+
+def make_product(db, code: str = "PUMP", stages=(("Литье", 10), ("Окраска", 5)), material=None,
+                 per_unit: float = 2.0, plant_id: int = database.DEFAULT_PLANT_ID) -> models.Product:
+    """Изделие с цепочкой этапов; material расходуется на первом этапе."""
+    product = models.Product(name=f"Изделие {code}", code=code, plant_id=plant_id)
+    db.add(product)
+    db.flush()
+    for position, (name, minutes) in enumerate(stages, start=1):
+        stage = models.TechStage(product_id=product.id, name=name, order_in_chain=position,
+                                 norm_time_minutes=minutes)
+        db.add(stage)
+        db.flush()
+        if material is not None and position == 1:
+            db.add(models.StageMaterialRequirement(tech_stage_id=stage.id, material_id=material.id,
+                                                   quantity_needed=per_unit))
+    db.commit()
+    return product
+
+
+def create_order(client, headers: dict, product_id: int, quantity: int = 1) -> dict:
+    response = client.post("/orders/", headers=headers, json={
+        "client_name": "ООО Ромашка", "product_id": product_id, "quantity": quantity,
+        "deadline_date": (datetime.now(UTC) + timedelta(days=3)).isoformat(),
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
@@ -0,0 +1,72 @@
+"""Лимитер допуска: 429 при полной очереди, 503 по таймауту, передача слота следующему в очереди."""
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import admission
+import invalidation
+from admission import Limit, Limiter
+from invalidation import EventKind, InvalidationEvent
+
+
+def test_full_queue_is_rejected_with_429():
+    async def scenario():
+        limiter = Limiter("heavy", Limit(concurrency=1, queue=1, max_wait=5))
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as error:
+            await limiter.acquire()
+        limiter.release()
+        await waiting
+        return limiter, error.value
+
+    limiter, error = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert error.headers["Retry-After"] == "5"
+    assert limiter.rejected == 1
+    assert limiter.active == 1  # Слот передан ожидавшему, а не освобожден
+
+
+def test_wait_timeout_is_rejected_with_503():
+    async def scenario():
+        limiter = Limiter("heavy", Limit(concurrency=1, queue=1, max_wait=0.05))
+        await limiter.acquire()
+        with pytest.raises(HTTPException) as error:
+            await limiter.acquire()
+        return limiter, error.value
+
+    limiter, error = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "1"
+    assert limiter.waiting == 0
+
+
+def test_cancelled_waiter_does_not_keep_the_slot():
+    async def scenario():
+        limiter = Limiter("heavy", Limit(concurrency=1, queue=2, max_wait=5))
+        await limiter.acquire()
+        cancelled = asyncio.create_task(limiter.acquire())
+        next_in_line = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.waiting == 2
+
+        cancelled.cancel()  # Клиент отключился, пока ждал
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        limiter.release()
+        await asyncio.wait_for(next_in_line, timeout=1)
+        state = (limiter.active, limiter.waiting)
+        limiter.release()
+        return limiter, state
+
+    limiter, (active, waiting) = asyncio.run(scenario())
+    assert (active, waiting) == (1, 0)
+    assert limiter.active == 0
+
+
+def test_resync_clears_role_cache():
+    admission._role_cache[(1, "ivanov")] = ("technologist", 0.0)
+    invalidation.publish(InvalidationEvent(EventKind.RESYNC))
+    assert admission._role_cache == {}
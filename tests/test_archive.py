@@ -0,0 +1,43 @@
+"""Архивация: старые завершенные заказы уходят в архив вместе с задачами и оставляют надгробия."""
+from datetime import datetime, timedelta, UTC
+
+import archive
+import database
+import models
+from conftest import make_product
+
+
+def _order(db, product, status, days_ago):
+    moment = datetime.now(UTC) - timedelta(days=days_ago)
+    order = models.ProductionOrder(client_name="ООО Ромашка", product_id=product.id, quantity=1, status=status,
+                                   start_date=moment, deadline_date=moment + timedelta(days=5))
+    db.add(order)
+    db.flush()
+    for stage in product.tech_stages:
+        done = status == models.OrderStatus.COMPLETED
+        db.add(models.ProductionTask(order_id=order.id, stage_name=stage.name, status="done" if done else "working",
+                                     start_time_actual=moment, end_time_actual=moment + timedelta(days=1) if done else None))
+    db.commit()
+    return order.id
+
+
+def test_old_completed_orders_move_to_archive_with_tombstones(db):
+    product = make_product(db)
+    old = _order(db, product, models.OrderStatus.COMPLETED, days_ago=200)
+    recent = _order(db, product, models.OrderStatus.COMPLETED, days_ago=10)
+    stuck = _order(db, product, models.OrderStatus.IN_PROGRESS, days_ago=200)
+    old_tasks = {task.id for task in db.query(models.ProductionTask).filter_by(order_id=old)}
+
+    with database.plant_session(database.DEFAULT_PLANT_ID) as session:
+        assert archive.run(session, older_than_days=90) == 1
+
+    db.expire_all()
+    assert {order.id for order in db.query(models.ProductionOrder)} == {recent, stuck}
+    assert [order.id for order in db.query(models.ArchivedOrder)] == [old]
+    archived = db.query(models.ArchivedOrder).one()
+    assert archived.archived_at is not None and archived.status == models.OrderStatus.COMPLETED
+    assert {task.id for task in db.query(models.ArchivedTask)} == old_tasks
+    assert db.query(models.ProductionTask).filter_by(order_id=old).count() == 0
+
+    tombstones = {(t.entity, t.entity_id) for t in db.query(models.SyncTombstone)}
+    assert tombstones == {("orders", old)} | {("tasks", task_id) for task_id in old_tasks}
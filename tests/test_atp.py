@@ -0,0 +1,37 @@
+"""ATP-котировка: срок растет с открытыми заказами, нехватка материала становится узким местом."""
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+def _quote(client, headers, product_id, quantity=1):
+    response = client.post("/orders/quote", headers=headers, json={"product_id": product_id, "quantity": quantity})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_quote_accounts_for_open_orders(client, db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    headers = auth_headers("dispatcher")
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=10)
+    db.add(material)
+    db.commit()
+    product = make_product(db, material=material, per_unit=2.0)  # Литье 10 мин + Окраска 5 мин
+
+    empty = _quote(client, headers, product.id)
+    assert empty["lead_time_minutes"] == 15.0
+    assert empty["blocking"] is None
+
+    for _ in range(3):
+        create_order(client, headers, product.id)
+    busy = _quote(client, headers, product.id)
+    assert busy["lead_time_minutes"] > empty["lead_time_minutes"]
+    assert busy["blocking"]["kind"] == "stage"
+    [line] = busy["materials"]
+    assert line["available"] == 4.0  # 10 на складе минус 3 заказа по 2
+
+    short = _quote(client, headers, product.id, quantity=4)
+    assert short["materials"][0]["shortage"] == 4.0
+    assert (short["blocking"]["kind"], short["blocking"]["name"]) == ("material", "Чугун")
+
+    # Котировка ничего не записывает
+    assert db.query(models.ProductionOrder).count() == 3
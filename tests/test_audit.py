@@ -0,0 +1,24 @@
+"""Журнал действий: постраничное чтение не теряет события с одинаковым created_at."""
+from datetime import datetime
+
+import models
+from conftest import auth_headers, make_user
+
+
+def test_keyset_pages_through_events_sharing_a_timestamp(client, db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    moment = datetime(2026, 3, 1, 12, 0)  # Одна пачка audit.record — одно время у всех событий
+    db.add_all(models.AuditEvent(plant_id=1, created_at=moment, action="task.complete", task_id=task_id,
+                                 details={}) for task_id in range(5))
+    db.commit()
+
+    seen, params = [], {"limit": 2}
+    while True:
+        page = client.get("/audit/events", headers=auth_headers("dispatcher"), params=params).json()
+        if not page:
+            break
+        seen += [event["id"] for event in page]
+        params = {"limit": 2, "end": page[-1]["created_at"], "before_id": page[-1]["id"]}
+
+    assert len(seen) == 5 and len(set(seen)) == 5
+    assert seen == sorted(seen, reverse=True)
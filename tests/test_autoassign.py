@@ -0,0 +1,46 @@
+"""Автоназначение: нагрузка распределяется между операторами, dry_run ничего не пишет."""
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+def _setup(client, db, orders=4):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operators = [make_user(db, name, models.UserRole.OPERATOR) for name in ("ivanov", "petrov")]
+    product = make_product(db)  # Литье 10 мин + Окраска 5 мин
+    headers = auth_headers("dispatcher")
+    for _ in range(orders):
+        create_order(client, headers, product.id)
+    return headers, operators
+
+
+def test_auto_assign_spreads_load_across_operators(client, db):
+    headers, operators = _setup(client, db)
+
+    response = client.post("/tasks/auto-assign", headers=headers)
+    assert response.status_code == 200, response.text
+    result = response.json()
+    assert result["assigned"] == 8
+
+    loads = {op["user_id"]: op["queue_minutes"] for op in result["operators"]}
+    assert set(loads) == {op.id for op in operators}
+    # Без истории у обоих коэффициент UNFAMILIAR_PENALTY: разница не больше самой длинной задачи
+    assert abs(loads[operators[0].id] - loads[operators[1].id]) <= 10 * 1.25
+    assert {op["assigned"] for op in result["operators"]} == {4}
+
+    db.expire_all()
+    tasks = db.query(models.ProductionTask).all()
+    assert all(task.responsible_user_id in loads for task in tasks)
+    assert all(task.assigned_at is not None and task.status == "pending" for task in tasks)
+    assert {a["task_id"]: a["responsible_user_id"] for a in result["assignments"]} == \
+        {task.id: task.responsible_user_id for task in tasks}
+
+
+def test_dry_run_writes_nothing(client, db):
+    headers, _ = _setup(client, db, orders=2)
+
+    result = client.post("/tasks/auto-assign", headers=headers, params={"dry_run": "true"}).json()
+    assert result["dry_run"] is True and result["assigned"] == 4
+
+    db.expire_all()
+    assert all(task.responsible_user_id is None and task.assigned_at is None
+               for task in db.query(models.ProductionTask))
@@ -0,0 +1,57 @@
+"""Пакетное завершение: partial=True применяет годные позиции, partial=False откатывает весь пакет."""
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+def _setup(client, db, stock):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operator = make_user(db, "operator", models.UserRole.OPERATOR)
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=stock)
+    db.add(material)
+    db.commit()
+    product = make_product(db, material=material, per_unit=2.0)  # На Литье партии 3 шт. нужно 6 кг
+    headers = auth_headers("dispatcher")
+    task_ids = []
+    for _ in range(2):
+        order = create_order(client, headers, product.id, quantity=3)
+        task = db.query(models.ProductionTask).filter_by(order_id=order["id"], stage_name="Литье").one()
+        client.put(f"/tasks/{task.id}/assign", headers=headers, json={"responsible_user_id": operator.id})
+        task_ids.append(task.id)
+    return task_ids, material
+
+
+def _batch(client, task_ids, partial):
+    response = client.post("/tasks/complete-batch", headers=auth_headers("operator"), json={
+        "partial": partial, "items": [{"task_id": task_id} for task_id in task_ids] + [{"task_id": 999999}],
+    })
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_partial_batch_commits_valid_items(client, db):
+    (first, second), material = _setup(client, db, stock=10)  # Хватает только на одну партию
+
+    result = _batch(client, [first, second], partial=True)
+    assert (result["committed"], result["completed"], result["rejected"]) == (True, 1, 2)
+    by_task = {item["task_id"]: item for item in result["results"]}
+    assert by_task[first]["ok"] and by_task[first]["status"] == "done"
+    assert not by_task[second]["ok"] and "Недостаточно" in by_task[second]["error"]
+    assert by_task[999999]["error"] == "Task not found"
+
+    db.expire_all()
+    assert db.get(models.Material, material.id).quantity_in_stock == 4
+    assert db.get(models.ProductionTask, first).status == "done"
+    assert db.get(models.ProductionTask, second).status == "working"  # Назначение начинает задачу
+
+
+def test_all_or_nothing_batch_rolls_back(client, db):
+    (first, second), material = _setup(client, db, stock=100)
+
+    result = _batch(client, [first, second], partial=False)
+    assert (result["committed"], result["completed"], result["rejected"]) == (False, 0, 3)
+    assert all(not item["ok"] for item in result["results"])
+
+    db.expire_all()
+    assert db.get(models.Material, material.id).quantity_in_stock == 100
+    assert {db.get(models.ProductionTask, task_id).status for task_id in (first, second)} == {"working"}
+    assert db.query(models.QualityEvent).count() == 0
@@ -0,0 +1,63 @@
+"""Разузлование состава через уровни полуфабрикатов и отказ импорта с циклом в составе."""
+import pytest
+
+import audit
+import invalidation
+import models
+from conftest import auth_headers, make_user
+
+HEADER = ("product_code;product_name;stage_name;order_in_chain;norm_time_minutes;"
+          "material_name;unit;quantity_in_stock;quantity_needed;component_code")
+
+
+@pytest.fixture(autouse=True)
+def technologist(db):
+    make_user(db, "technologist", models.UserRole.TECHNOLOGIST)
+
+
+def _import(client, *rows):
+    response = client.post("/import/tech-cards", headers=auth_headers("technologist"),
+                           files={"file": ("cards.csv", "\n".join((HEADER,) + rows).encode("utf-8"))})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def test_explosion_through_two_component_levels(client, db):
+    report = _import(
+        client,
+        "BOLT;Болт;Штамповка;1;2;Сталь;кг;1000;0,1;",
+        "SHAFT;Вал;Токарная;1;10;Сталь;кг;;1,5;",
+        "SHAFT;;Токарная;;;;;;3;BOLT",
+        "PUMP;Насос;Сборка;1;20;;;;2;SHAFT",
+        "PUMP;;Окраска;2;5;Краска;л;50;0,2;",
+    )
+    assert report["committed"] is True and report["rows_failed"] == 0
+    pump = db.query(models.Product).filter_by(code="PUMP").one()
+
+    explosion = client.get(f"/products/{pump.id}/bom", headers=auth_headers("technologist"),
+                           params={"quantity": 2}).json()
+    assert explosion["depth"] == 2
+    assert {line["material_name"]: round(line["quantity"], 3) for line in explosion["materials"]} == \
+        {"Краска": 0.4, "Сталь": 7.2}  # Сталь: 2 × (1,5 + 3 × 0,1)
+    assert {line["stage_name"]: line["minutes"] for line in explosion["stages"]} == \
+        {"Сборка": 40, "Окраска": 10, "Токарная": 40, "Штамповка": 24}
+    assert {line["product_code"]: line["quantity"] for line in explosion["components"]} == {"SHAFT": 4, "BOLT": 12}
+
+
+def test_import_with_cycle_is_rejected(client, db, monkeypatch):
+    published, recorded = [], []
+    monkeypatch.setattr(invalidation, "publish", lambda *events: published.extend(events))
+    monkeypatch.setattr(audit, "record", lambda *args, **kwargs: recorded.append(args))
+
+    report = _import(
+        client,
+        "A;Изделие A;Сборка;1;10;;;;;",
+        "B;Изделие B;Сборка;1;10;;;;;",
+        "A;;Сборка;;;;;;1;B",
+        "B;;Сборка;;;;;;1;A",
+    )
+    assert report["committed"] is False
+    assert (report["rows_imported"], report["products_created"], report["components_created"]) == (0, 0, 0)
+    assert "Цикл" in report["errors"][-1]["message"]
+    assert db.query(models.Product).count() == 0
+    assert published == [] and recorded == []
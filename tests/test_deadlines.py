@@ -0,0 +1,79 @@
+"""Прогноз сроков: predicted_finish_at/slack_minutes, смена статусов и /orders/at-risk."""
+from datetime import datetime, timedelta, UTC
+
+import pytest
+
+import deadlines
+import models
+from conftest import auth_headers, make_product, make_user
+
+
+def _order(db, product, deadline_in, task_status="pending"):
+    now = datetime.now(UTC)
+    order = models.ProductionOrder(client_name="ООО Ромашка", product_id=product.id, quantity=1,
+                                   status=models.OrderStatus.NEW, start_date=now, deadline_date=now + deadline_in)
+    db.add(order)
+    db.flush()
+    for stage in product.tech_stages:
+        done = task_status == "done"
+        db.add(models.ProductionTask(order_id=order.id, stage_name=stage.name, status=task_status,
+                                     end_time_actual=now - timedelta(hours=1) if done else None))
+    db.commit()
+    return order
+
+
+def test_evaluate_sets_prediction_and_moves_statuses(db):
+    product = make_product(db)  # 10 + 5 минут на штуку
+    order = _order(db, product, deadline_in=timedelta(days=3))
+
+    before = datetime.now(UTC)
+    deadlines.evaluate(db)
+    db.refresh(order)
+    assert order.status == models.OrderStatus.NEW
+    predicted = deadlines.as_utc(order.predicted_finish_at)
+    assert before + timedelta(minutes=15) <= predicted <= datetime.now(UTC) + timedelta(minutes=15)
+    assert order.slack_minutes == pytest.approx((deadlines.as_utc(order.deadline_date) - predicted).total_seconds() / 60)
+
+    # Назначение задачи — заказ в работе
+    order.tasks[0].assigned_at = datetime.now(UTC)
+    db.commit()
+    assert deadlines.evaluate(db, [order.id]) == 1
+    db.refresh(order)
+    assert order.status == models.OrderStatus.IN_PROGRESS
+
+    # Дедлайн ближе прогноза — опаздывает, запас отрицательный
+    order.deadline_date = datetime.now(UTC) + timedelta(minutes=5)
+    db.commit()
+    deadlines.evaluate(db, [order.id])
+    db.refresh(order)
+    assert order.status == models.OrderStatus.DELAYED
+    assert order.slack_minutes < 0
+
+    # Все задачи выполнены — завершен, прогноз равен фактическому окончанию
+    finished = datetime.now(UTC) - timedelta(minutes=30)
+    for task in order.tasks:
+        task.status, task.end_time_actual = "done", finished
+    db.commit()
+    deadlines.evaluate(db, [order.id])
+    db.refresh(order)
+    assert order.status == models.OrderStatus.COMPLETED
+    assert deadlines.as_utc(order.predicted_finish_at) == finished
+
+
+def test_at_risk_orders_sorted_by_slack(client, db):
+    make_user(db, "disp", models.UserRole.DISPATCHER)
+    product = make_product(db)
+    relaxed = _order(db, product, deadline_in=timedelta(days=3))
+    late = _order(db, product, deadline_in=timedelta(minutes=5))
+    tight = _order(db, product, deadline_in=timedelta(hours=1))
+    _order(db, product, deadline_in=timedelta(minutes=1), task_status="done")  # завершен — не в списке
+    deadlines.evaluate(db)
+
+    response = client.get("/orders/at-risk", params={"within_hours": 24}, headers=auth_headers("disp"))
+    assert response.status_code == 200
+    assert [row["id"] for row in response.json()] == [late.id, tight.id]
+    assert response.json()[0]["status"] == models.OrderStatus.DELAYED.value
+    assert response.json()[0]["slack_minutes"] < 0 < response.json()[1]["slack_minutes"]
+
+    response = client.get("/orders/at-risk", params={"within_hours": 100}, headers=auth_headers("disp"))
+    assert [row["id"] for row in response.json()] == [late.id, tight.id, relaxed.id]
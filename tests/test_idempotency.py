@@ -0,0 +1,81 @@
+"""Idempotency-Key: повтор отдает сохраненный ответ, не выполняя операцию второй раз."""
+from datetime import datetime, timedelta, UTC
+
+import idempotency
+import models
+from conftest import auth_headers, make_product, make_user
+
+ORDER = {"client_name": "ООО Ромашка", "quantity": 2,
+         "deadline_date": "2030-01-01T00:00:00+00:00"}
+
+
+def _setup(db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operator = make_user(db, "operator", models.UserRole.OPERATOR)
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=100)
+    db.add(material)
+    db.commit()
+    product = make_product(db, material=material, per_unit=2.0)
+    return product, operator, material
+
+
+def _post_order(client, product_id, key, **changes):
+    return client.post("/orders/", json={**ORDER, "product_id": product_id, **changes},
+                       headers={**auth_headers("dispatcher"), "Idempotency-Key": key})
+
+
+def test_replayed_order_returns_stored_body(client, db):
+    product, _, _ = _setup(db)
+
+    first = _post_order(client, product.id, "order-1")
+    again = _post_order(client, product.id, "order-1")
+    assert first.status_code == again.status_code == 200
+    assert again.json() == first.json()
+    assert again.headers[idempotency.REPLAY_HEADER] == "true"
+    assert db.query(models.ProductionOrder).count() == 1
+    assert db.query(models.ProductionTask).count() == 2  # Задачи по двум этапам — только один раз
+
+
+def test_replayed_completion_deducts_once(client, db):
+    product, operator, material = _setup(db)
+    order = _post_order(client, product.id, "order-1").json()
+    task = db.query(models.ProductionTask).filter_by(order_id=order["id"], stage_name="Литье").one()
+    client.put(f"/tasks/{task.id}/assign", headers=auth_headers("dispatcher"),
+               json={"responsible_user_id": operator.id})
+
+    headers = {**auth_headers("operator"), "Idempotency-Key": "complete-1"}
+    first = client.post(f"/tasks/{task.id}/complete", headers=headers, json={})
+    again = client.post(f"/tasks/{task.id}/complete", headers=headers, json={})
+    assert first.status_code == again.status_code == 200
+    assert again.json() == first.json()  # Тот же результат с логом списания, а не "уже завершена"
+
+    db.expire_all()
+    assert db.get(models.Material, material.id).quantity_in_stock == 100 - 2 * 2
+
+
+def test_same_key_with_different_body_is_rejected(client, db):
+    product, _, _ = _setup(db)
+    assert _post_order(client, product.id, "order-1").status_code == 200
+    response = _post_order(client, product.id, "order-1", quantity=5)
+    assert response.status_code == 422
+    assert db.query(models.ProductionOrder).count() == 1
+
+
+def test_expired_records_are_purged(client, db):
+    product, _, _ = _setup(db)
+    _post_order(client, product.id, "order-1")
+    record = db.query(models.IdempotencyRecord).one()
+    record.expires_at = datetime.now(UTC) - timedelta(minutes=1)
+    db.commit()
+
+    # Просроченный ключ больше не защищает от повтора
+    assert _post_order(client, product.id, "order-1").headers.get(idempotency.REPLAY_HEADER) is None
+    assert db.query(models.ProductionOrder).count() == 2
+
+    db.add(models.IdempotencyRecord(key_hash="stale", request_hash="", status_code=200, response_body={},
+                                    created_at=datetime.now(UTC) - timedelta(days=2),
+                                    expires_at=datetime.now(UTC) - timedelta(days=1)))
+    db.commit()
+    assert idempotency.purge_expired(db) == 1
+    db.commit()
+    assert db.query(models.IdempotencyRecord).count() == 1  # Остался ключ повторного заказа
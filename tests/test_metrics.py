@@ -0,0 +1,16 @@
+"""Метрики: запросы "в полете" считаются по маршруту, а не только по методу."""
+import metrics
+
+
+def test_in_flight_is_labelled_by_route(client):
+    body = client.get("/metrics").text
+    # Сам запрос /metrics в момент отрисовки еще обрабатывается
+    assert 'http_requests_in_flight{method="GET",route="/metrics"} 1' in body
+
+
+def test_in_flight_uses_route_template(client):
+    client.put("/tasks/12345/assign", json={})  # Без токена — 401, но маршрут известен
+    client.get("/no/such/path")
+    assert metrics.registry.in_flight[("PUT", "/tasks/{task_id}/assign")] == 0
+    assert metrics.registry.in_flight[("GET", "<unmatched>")] == 0
+    assert ("PUT", "/tasks/12345/assign") not in metrics.registry.in_flight
@@ -0,0 +1,61 @@
+"""Разделение по заводам: пользователь завода не видит и не меняет данные другого завода."""
+from datetime import datetime, timedelta, UTC
+
+import pytest
+
+import database
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+@pytest.fixture
+def second_plant(db):
+    db.add(models.Plant(id=2, code="PLANT-2", name="Завод 2"))
+    db.commit()
+    return 2
+
+
+def test_foreign_plant_orders_and_tasks_are_invisible(client, db, second_plant):
+    make_user(db, "disp", models.UserRole.DISPATCHER)
+    make_user(db, "disp2", models.UserRole.DISPATCHER, plant_id=second_plant)
+    operator = make_user(db, "op2", models.UserRole.OPERATOR, plant_id=second_plant)
+    product = make_product(db)
+    order = create_order(client, auth_headers("disp"), product.id)
+    task_id = db.query(models.ProductionTask.id).filter_by(order_id=order["id"]).first().id
+    foreign = auth_headers("disp2", plant_id=second_plant)
+
+    assert client.get("/orders/", headers=foreign).json() == []
+    assert client.get("/tasks/", headers=foreign).json() == []
+    response = client.put(f"/tasks/{task_id}/assign", headers=foreign, json={"responsible_user_id": operator.id})
+    assert response.status_code == 404
+    assert client.post(f"/tasks/{task_id}/complete", headers=foreign, json={}).status_code == 404
+    response = client.post("/orders/", headers=foreign, json={
+        "client_name": "ООО Ромашка", "product_id": product.id, "quantity": 1, "deadline_date": (datetime.now(UTC) + timedelta(days=3)).isoformat(),
+    })
+    assert response.status_code == 404
+
+    db.expire_all()
+    task = db.get(models.ProductionTask, task_id)
+    assert task.status == "pending" and task.responsible_user_id is None
+    assert db.query(models.ProductionOrder).count() == 1
+
+    # Токен чужого завода не открывает пользователя этого завода
+    assert client.get("/orders/", headers=auth_headers("disp", plant_id=second_plant)).status_code == 401
+    assert [row["id"] for row in client.get("/orders/", headers=auth_headers("disp")).json()] == [order["id"]]
+
+
+def test_new_rows_get_session_plant(db, second_plant):
+    with database.plant_session(second_plant) as session:
+        product = models.Product(name="Изделие VALVE", code="VALVE")
+        session.add(product)
+        session.commit()
+        assert product.plant_id == second_plant
+        # Тот же код на другом заводе не конфликтует
+        assert make_product(db, code="VALVE").plant_id == database.DEFAULT_PLANT_ID
+        assert [row.code for row in session.query(models.Product)] == ["VALVE"]
+        assert session.query(models.Product).one().id == product.id
+
+        session.add(models.Material(name="Сталь", unit="кг", quantity_in_stock=10, plant_id=database.DEFAULT_PLANT_ID))
+        with pytest.raises(ValueError):
+            session.flush()
+        session.rollback()
@@ -0,0 +1,41 @@
+"""ОТК: каждое завершение пишет QualityEvent и обновляет суточный QualityRollup."""
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+def test_completion_with_defects_records_rework(client, db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operator = make_user(db, "operator", models.UserRole.OPERATOR)
+    product = make_product(db)
+    headers = auth_headers("dispatcher")
+    order = create_order(client, headers, product.id, quantity=4)
+    tasks = {task.stage_name: task.id for task in db.query(models.ProductionTask).filter_by(order_id=order["id"])}
+    for task_id in tasks.values():
+        client.put(f"/tasks/{task_id}/assign", headers=headers, json={"responsible_user_id": operator.id})
+
+    operator_headers = auth_headers("operator")
+    rework = client.post(f"/tasks/{tasks['Литье']}/complete", headers=operator_headers,
+                         json={"defective_quantity": 1, "comment": "Раковины"}).json()
+    assert rework["status"] == "rework_needed"
+    done = client.post(f"/tasks/{tasks['Окраска']}/complete", headers=operator_headers, json={}).json()
+    assert done["status"] == "done"
+
+    events = {event.stage_name: event for event in db.query(models.QualityEvent)}
+    assert (events["Литье"].is_rework, events["Литье"].good_quantity, events["Литье"].defective_quantity,
+            events["Литье"].comment) == (True, 3, 1, "Раковины")
+    assert (events["Окраска"].is_rework, events["Окраска"].quantity) == (False, 4)
+    assert all(event.operator_id == operator.id for event in events.values())
+
+    rollups = {rollup.stage_name: rollup for rollup in db.query(models.QualityRollup)}
+    assert (rollups["Литье"].completions, rollups["Литье"].rework_count, rollups["Литье"].defective_quantity) == \
+        (1, 1, 1)
+
+    stats = client.get("/analytics/quality", headers=headers, params={"group_by": "product_id"}).json()
+    assert stats == [{
+        "day": None, "stage_name": None, "product_id": product.id, "operator_id": None,
+        "completions": 2, "rework_count": 1, "rework_rate": 0.5,
+        "total_quantity": 8, "defective_quantity": 1, "defect_rate": 0.125,
+    }]
+
+    [history] = client.get("/analytics/quality/events", headers=headers, params={"only_rework": "true"}).json()
+    assert history["task_id"] == tasks["Литье"]
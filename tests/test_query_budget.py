@@ -0,0 +1,67 @@
+"""Бюджет SQL горячих эндпоинтов: число запросов не растет с числом заказов (profiling.assert_max_queries)."""
+import pytest
+
+import database
+import models
+import profiling
+from conftest import auth_headers, create_order, make_product, make_user
+
+
+@pytest.fixture
+def busy_plant(db, client):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operator = make_user(db, "operator", models.UserRole.OPERATOR)
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=10_000)
+    db.add(material)
+    db.commit()
+    headers = auth_headers("dispatcher")
+    for code in ("PUMP", "VALVE", "SHAFT"):
+        product = make_product(db, code=code, material=material)
+        for _ in range(4):
+            create_order(client, headers, product.id, quantity=2)
+    # Часть задач завершена — чтобы отчет по материалам был непустым
+    for task in db.query(models.ProductionTask).filter(models.ProductionTask.stage_name == "Литье").limit(6):
+        client.put(f"/tasks/{task.id}/assign", headers=headers, json={"responsible_user_id": operator.id})
+        response = client.post(f"/tasks/{task.id}/complete", headers=auth_headers("operator"), json={})
+        assert response.status_code == 200, response.text
+    return headers
+
+
+@pytest.mark.parametrize("path, budget", [
+    ("/gantt", 4),
+    ("/reports/materials-by-stage", 6),
+    ("/tasks/", 3),
+])
+def test_hot_endpoints_stay_within_query_budget(client, busy_plant, path, budget):
+    with profiling.assert_max_queries(budget, engine=database.engine):
+        response = client.get(path, headers=busy_plant)
+    assert response.status_code == 200, response.text
+
+
+def test_budget_violation_lists_repeated_statements(db):
+    profiling.instrument_engine(database.engine)
+    with pytest.raises(AssertionError, match="Вероятные N\\+1"):
+        with profiling.assert_max_queries(2):
+            for material_id in range(5):
+                db.get(models.Material, material_id + 1000)
+
+
+def test_profile_header_requires_shared_secret(client, db, monkeypatch):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    headers = auth_headers("dispatcher")
+
+    response = client.get("/materials/", headers={**headers, "X-Debug-Profile": "1"})
+    assert "x-profile-id" not in response.headers
+
+    monkeypatch.setattr(profiling, "PROFILE_SECRET", b"s3cret")
+    response = client.get("/materials/", headers={**headers, "X-Debug-Profile": "guess"})
+    assert "x-profile-id" not in response.headers
+    response = client.get("/materials/", headers={**headers, "X-Debug-Profile": "s3cret"})
+    assert "x-profile-id" in response.headers
+
+
+def test_task_list_names_responsible_operator(client, busy_plant):
+    tasks = client.get("/tasks/", headers=busy_plant).json()
+    assigned = [task for task in tasks if task["responsible_user_id"] is not None]
+    assert len(assigned) == 6
+    assert {task["responsible_username"] for task in assigned} == {"operator"}
@@ -0,0 +1,60 @@
+"""Кэш отчета о списании: сбрасываются только записи завода и периода, куда попало завершение."""
+import json
+from datetime import date
+
+import invalidation
+import models
+from conftest import auth_headers, create_order, make_product, make_user
+from invalidation import EventKind, InvalidationEvent
+from report_cache import ReportCache, materials_report_cache
+
+
+def test_invalidation_is_limited_to_plant_and_period():
+    cache = ReportCache()
+    cache.put(date(2026, 3, 1), date(2026, 3, 31), ["март"], plant_id=1)
+    cache.put(date(2026, 4, 1), date(2026, 4, 30), ["апрель"], plant_id=1)
+    cache.put(date(2026, 3, 1), date(2026, 3, 31), ["март, завод 2"], plant_id=2)
+    cache.put(None, None, ["все время"], plant_id=1)
+
+    assert cache.invalidate_completion(date(2026, 3, 15), plant_id=1) == 2
+    assert cache.get(date(2026, 3, 1), date(2026, 3, 31), plant_id=1) is None
+    assert cache.get(None, None, plant_id=1) is None
+    assert cache.get(date(2026, 4, 1), date(2026, 4, 30), plant_id=1) == ["апрель"]
+    assert cache.get(date(2026, 3, 1), date(2026, 3, 31), plant_id=2) == ["март, завод 2"]
+
+
+def test_completion_refreshes_cached_report(client, db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    operator = make_user(db, "operator", models.UserRole.OPERATOR)
+    headers = auth_headers("dispatcher")
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=100)
+    db.add(material)
+    db.commit()
+    product = make_product(db, material=material)
+    order = create_order(client, headers, product.id)
+
+    assert client.get("/reports/materials-by-stage", headers=headers).json() == []
+    task = db.query(models.ProductionTask).filter_by(order_id=order["id"], stage_name="Литье").one()
+    client.put(f"/tasks/{task.id}/assign", headers=headers, json={"responsible_user_id": operator.id})
+    response = client.post(f"/tasks/{task.id}/complete", headers=auth_headers("operator"), json={})
+    assert response.status_code == 200, response.text
+
+    [row] = client.get("/reports/materials-by-stage", headers=headers).json()
+    assert (row["material_name"], row["quantity_spent"]) == ("Чугун", 2.0)
+
+
+def test_bus_events_invalidate_only_their_plant_and_day():
+    cache = materials_report_cache
+    cache.put(date(2026, 3, 1), date(2026, 3, 31), ["март"], plant_id=1)
+    cache.put(date(2026, 3, 1), date(2026, 3, 31), ["март, завод 2"], plant_id=2)
+
+    # Переделка (задача не done) приходит без day — отчет не меняется
+    invalidation.publish(InvalidationEvent(EventKind.TASK_COMPLETED, [1], day=None, plant_id=1))
+    assert len(cache) == 2
+
+    # Событие другого воркера: применяется так же, как свое
+    invalidation.bus._on_message(json.dumps([
+        InvalidationEvent(EventKind.TASK_COMPLETED, [1], day="2026-03-10", origin="other", plant_id=1).to_dict()
+    ]))
+    assert cache.get(date(2026, 3, 1), date(2026, 3, 31), plant_id=1) is None
+    assert cache.get(date(2026, 3, 1), date(2026, 3, 31), plant_id=2) == ["март, завод 2"]
@@ -0,0 +1,36 @@
+"""Версия данных отчета (ключ дедупликации jobs.submit) учитывает правки справочников."""
+import database
+import models
+import reports
+from conftest import auth_headers, make_product, make_user
+
+
+def _version():
+    with database.plant_session(database.DEFAULT_PLANT_ID) as session:
+        return reports.materials_data_version(session)
+
+
+def test_reference_edits_change_data_version(client, db):
+    make_user(db, "technologist", models.UserRole.TECHNOLOGIST)
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=100)
+    db.add(material)
+    db.commit()
+    make_product(db, material=material)
+    before = _version()
+
+    response = client.put(f"/materials/{material.id}", headers=auth_headers("technologist"),
+                          json={"name": "Чугун СЧ20", "unit": "кг", "quantity_in_stock": 100})
+    assert response.status_code == 200, response.text
+    after_material = _version()
+    assert after_material != before
+
+    requirement = db.query(models.StageMaterialRequirement).one()
+    requirement.quantity_needed = 3.0
+    db.commit()
+    assert _version() != after_material
+
+    # Остаток в отчет не попадает — версию не меняет
+    unchanged = _version()
+    db.get(models.Material, material.id).quantity_in_stock = 50
+    db.commit()
+    assert _version() == unchanged
@@ -0,0 +1,37 @@
+"""Агрегаты длительности этапов: завершения без времени начала учитываются в task_count."""
+from datetime import datetime, timedelta, UTC
+
+import models
+import rollups
+from conftest import make_product
+
+
+def _done_task(db, order, started=None):
+    end = datetime.now(UTC)
+    task = models.ProductionTask(order_id=order.id, stage_name="Литье", status="done",
+                                 start_time_actual=started and end - started, end_time_actual=end)
+    db.add(task)
+    db.flush()
+    return task
+
+
+def test_completion_without_start_is_counted_but_not_timed(db):
+    product = make_product(db)
+    order = models.ProductionOrder(client_name="ООО Ромашка", product_id=product.id, quantity=1)
+    db.add(order)
+    db.flush()
+    stage = product.tech_stages[0]
+    for task in (_done_task(db, order, started=timedelta(minutes=30)), _done_task(db, order)):
+        rollups.record_task_completion(db, task, stage)
+    db.commit()
+
+    def check():
+        [row] = rollups.query_throughput(db, ["stage_name"])
+        assert row.task_count == 2
+        assert row.avg_cycle_minutes == 30.0
+        assert row.p50_cycle_minutes == 30.0
+        assert row.total_norm_minutes == 10.0  # Норма — только по задаче с известной длительностью
+
+    check()
+    assert rollups.rebuild(db) == 2
+    check()
@@ -0,0 +1,76 @@
+"""Поиск: ранжирование n-граммного индекса, номера заказов и точечное обновление по событиям."""
+import database
+import invalidation
+import models
+import search
+from conftest import auth_headers, create_order, make_product, make_user
+from invalidation import EventKind, InvalidationEvent
+
+
+def test_ngram_index_ranks_prefix_and_partial_code():
+    index = search.NgramIndex()
+    index.put(1, "Пруток стальной 20мм")
+    index.put(2, "Проволока медная")
+    index.put(3, "Насос PUMP-NC10")
+    index.put(4, "Пруток стальной 20мм калиброванный h11")
+
+    hits = index.search("прут", limit=10)
+    assert [key for key, _ in hits] == [1, 4]  # При равной оценке короче — выше
+    assert all(score == 1.0 for _, score in hits)
+    assert [key for key, _ in index.search("nc10", limit=10)] == [3]
+    assert index.search("шестерня", limit=10) == []
+
+    index.remove(1)
+    assert [key for key, _ in index.search("прут", limit=10)] == [4]
+    assert len(index) == 3
+
+
+def _search(client, q, **params):
+    response = client.get("/search", params={"q": q, **params}, headers=auth_headers("disp"))
+    assert response.status_code == 200, response.text
+    assert response.json()["backend"] == "memory"
+    return response.json()["hits"]
+
+
+def test_search_products_materials_and_order_numbers(client, db):
+    make_user(db, "disp", models.UserRole.DISPATCHER)
+    pump = make_product(db, code="PUMP-NC10")
+    db.add_all([models.Material(name="Пруток стальной 20мм", unit="кг"), models.Material(name="Краска серая", unit="л")])
+    db.commit()
+    order = create_order(client, auth_headers("disp"), pump.id)
+
+    hits = _search(client, "прут")
+    assert [(hit["kind"], hit["title"]) for hit in hits] == [("material", "Пруток стальной 20мм")]
+    assert [(hit["kind"], hit["id"]) for hit in _search(client, "nc10")] == [("product", pump.id)]
+
+    hits = _search(client, f"№{order['id']}")
+    assert hits[0] == {"kind": "order", "id": order["id"], "title": f"Заказ №{order['id']}",
+                       "subtitle": "ООО Ромашка", "score": 1.0}
+    assert _search(client, "999999") == []
+    assert [hit["kind"] for hit in _search(client, "ромаш")] == ["client"]
+    assert _search(client, "ромаш", kinds=["product"]) == []
+
+
+def test_memory_index_refreshes_on_change_events(client, db):
+    make_user(db, "disp", models.UserRole.DISPATCHER)
+    product = make_product(db, code="PUMP")
+    assert [hit["id"] for hit in _search(client, "pump")] == [product.id]  # Индекс построен
+
+    # Правка мимо API: без события индекс ее не видит, после PRODUCT_CHANGED — перечитывает только это изделие
+    product.name, product.code = "Задвижка чугунная", "VALVE"
+    db.commit()
+    assert [hit["id"] for hit in _search(client, "pump")] == [product.id]
+    invalidation.publish(InvalidationEvent(EventKind.PRODUCT_CHANGED, [product.id],
+                                           plant_id=database.DEFAULT_PLANT_ID))
+    assert _search(client, "pump") == []
+    assert [hit["title"] for hit in _search(client, "задвиж")] == ["Задвижка чугунная"]
+
+    # Новый клиент появляется после ORDER_CHANGED, старый исчезает вместе с последним заказом
+    order = create_order(client, auth_headers("disp"), product.id)
+    assert [hit["title"] for hit in _search(client, "ромаш", kinds=["client"])] == ["ООО Ромашка"]
+    db.query(models.ProductionOrder).filter_by(id=order["id"]).update({"client_name": "АО Василек"})
+    db.commit()
+    invalidation.publish(InvalidationEvent(EventKind.ORDER_CHANGED, [order["id"]],
+                                           plant_id=database.DEFAULT_PLANT_ID))
+    assert _search(client, "ромаш", kinds=["client"]) == []
+    assert [hit["id"] for hit in _search(client, "василек", kinds=["client"])] == [order["id"]]
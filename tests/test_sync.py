@@ -0,0 +1,44 @@
+"""Дельта-синхронизация: версия, которая не помещается в страницу, отдается по курсору (row_version, id)."""
+import models
+from conftest import auth_headers, make_user
+
+
+def _pull(client, headers, since=0, limit=3):
+    """Все страницы начиная с since: (id материалов по порядку, удаленные id, итоговая версия)."""
+    seen, deleted, params = [], [], {"since": since, "limit": limit}
+    while True:
+        page = client.get("/sync/changes", headers=headers, params=params).json()
+        seen += [material["id"] for material in page["materials"]]
+        deleted += page["deleted"]["materials"]
+        assert len(page["materials"]) <= limit
+        params = {"since": page["version"], "limit": limit}
+        if page["after_entity"] is not None:
+            params.update(after_entity=page["after_entity"], after_id=page["after_id"])
+        if not page["has_more"]:
+            return seen, deleted, page["version"]
+
+
+def test_single_version_larger_than_page_is_split(client, db):
+    make_user(db, "operator", models.UserRole.OPERATOR)
+    headers = auth_headers("operator")
+    db.add_all(models.Material(name=f"Материал {n}", unit="кг", quantity_in_stock=n) for n in range(8))
+    db.commit()  # Одна транзакция — одна версия у всех восьми строк
+    assert len({material.row_version for material in db.query(models.Material)}) == 1
+
+    seen, _, version = _pull(client, headers)
+    assert sorted(seen) == sorted(material.id for material in db.query(models.Material))
+    assert len(seen) == len(set(seen))
+
+    changed, removed = db.query(models.Material).order_by(models.Material.id).limit(2).all()
+    changed.quantity_in_stock = 100
+    db.delete(removed)
+    db.commit()
+    seen, deleted, _ = _pull(client, headers, since=version)
+    assert seen == [changed.id]
+    assert deleted == [removed.id]
+
+
+def test_cursor_fields_go_together(client, db):
+    make_user(db, "operator", models.UserRole.OPERATOR)
+    response = client.get("/sync/changes", headers=auth_headers("operator"), params={"after_id": 5})
+    assert response.status_code == 422
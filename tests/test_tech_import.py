@@ -0,0 +1,99 @@
+"""Импорт техкарт: CSV и XLSX, dry_run, ошибочные строки, повторный импорт и отказ файла целиком."""
+import io
+
+import pytest
+
+import database
+import models
+import tech_import
+from conftest import auth_headers, make_user
+
+HEADER = ("product_code;product_name;stage_name;order_in_chain;norm_time_minutes;"
+          "material_name;unit;quantity_in_stock;quantity_needed")
+ROWS = [
+    "PUMP;Насос;Литье;1;30;Чугун;кг;100;2,5",
+    "PUMP;;Окраска;2;15;;;;",
+]
+
+
+def _upload(client, content: bytes, filename="cards.csv", **params):
+    response = client.post("/import/tech-cards", headers=auth_headers("technologist"), params=params,
+                           files={"file": (filename, content)})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def _csv(*rows) -> bytes:
+    return "\n".join((HEADER,) + rows).encode("utf-8")
+
+
+@pytest.fixture(autouse=True)
+def technologist(db):
+    make_user(db, "technologist", models.UserRole.TECHNOLOGIST)
+
+
+def test_csv_import_creates_tech_card(client, db):
+    report = _upload(client, _csv(*ROWS))
+    assert report["committed"] is True
+    assert (report["rows_imported"], report["products_created"], report["stages_created"],
+            report["materials_created"], report["requirements_created"]) == (2, 1, 2, 1, 1)
+
+    product = db.query(models.Product).filter_by(code="PUMP").one()
+    assert [stage.name for stage in sorted(product.tech_stages, key=lambda s: s.order_in_chain)] == ["Литье", "Окраска"]
+    assert db.query(models.StageMaterialRequirement).one().quantity_needed == 2.5
+
+
+def test_xlsx_import(client, db):
+    openpyxl = pytest.importorskip("openpyxl")
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER.split(";"))
+    sheet.append(["VALVE", "Клапан", "Сборка", 1, 20, "Болт", "шт", 500, 4])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    report = _upload(client, buffer.getvalue(), filename="cards.xlsx")
+    assert report["committed"] is True and report["rows_imported"] == 1
+    assert db.query(models.Material).filter_by(name="Болт").one().quantity_in_stock == 500
+
+
+def test_dry_run_writes_nothing(client, db):
+    report = _upload(client, _csv(*ROWS), dry_run="true")
+    assert report["dry_run"] is True and report["committed"] is False
+    assert report["products_created"] == 1  # Отчет показывает, что было бы сделано
+    assert db.query(models.Product).count() == 0
+
+
+def test_bad_rows_are_reported_and_skipped(client, db):
+    report = _upload(client, _csv(ROWS[0], "PUMP;;Сборка;;;;;;", "GEAR;Шестерня;;;;Сталь;кг;-5;"))
+    assert (report["rows_total"], report["rows_imported"], report["rows_failed"]) == (3, 1, 2)
+    assert [error["row"] for error in report["errors"]] == [3, 4]
+    assert db.query(models.TechStage).count() == 1
+
+
+def test_reimport_updates_instead_of_duplicating(client, db):
+    _upload(client, _csv(*ROWS))
+    report = _upload(client, _csv("PUMP;Насос;Литье;1;40;Чугун;кг;100;3"))
+    assert (report["products_created"], report["stages_created"], report["requirements_created"]) == (0, 0, 0)
+    assert (report["stages_updated"], report["requirements_updated"]) == (1, 1)
+    assert db.query(models.TechStage).count() == 2
+    assert db.query(models.TechStage).filter_by(name="Литье").one().norm_time_minutes == 40
+
+
+def test_integrity_error_rejects_the_whole_file(monkeypatch):
+    rows = iter([{"product_code": "PUMP", "product_name": "Насос"}])
+
+    def concurrent_import(filename, binary_file):
+        yield next(rows)
+        # Тот же код успел создать другой импорт, пока этот копил строки
+        with database.plant_session(database.DEFAULT_PLANT_ID) as other:
+            other.add(models.Product(code="PUMP", name="Насос"))
+            other.commit()
+
+    monkeypatch.setattr(tech_import, "iter_rows", concurrent_import)
+    with database.plant_session(database.DEFAULT_PLANT_ID) as db:
+        report = tech_import.import_tech_cards(db, "cards.csv", None)
+        assert report.committed is False
+        assert (report.rows_imported, report.products_created) == (0, 0)
+        assert report.errors[-1].row == 0 and "Конфликт" in report.errors[-1].message
+        assert db.query(models.Product).count() == 1
@@ -0,0 +1,50 @@
+"""Очередь оператора: только его незавершенные задачи, по сроку заказа, фиксированное число запросов."""
+from datetime import datetime, timedelta, UTC
+
+import database
+import models
+import profiling
+from conftest import auth_headers, make_product, make_user
+
+
+def _order(client, headers, product_id, days):
+    response = client.post("/orders/", headers=headers, json={
+        "client_name": f"Клиент {days}", "product_id": product_id, "quantity": 3,
+        "deadline_date": (datetime.now(UTC) + timedelta(days=days)).isoformat(),
+    })
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def test_queue_has_only_callers_open_tasks_by_deadline(client, db):
+    make_user(db, "dispatcher", models.UserRole.DISPATCHER)
+    ivanov = make_user(db, "ivanov", models.UserRole.OPERATOR)
+    petrov = make_user(db, "petrov", models.UserRole.OPERATOR)
+    material = models.Material(name="Чугун", unit="кг", quantity_in_stock=100)
+    db.add(material)
+    db.commit()
+    product = make_product(db, material=material, per_unit=2.0)
+    headers = auth_headers("dispatcher")
+    order_ids = {days: _order(client, headers, product.id, days) for days in (5, 1, 3, 2)}
+
+    def assign(days, stage_name, user):
+        task = db.query(models.ProductionTask).filter_by(order_id=order_ids[days], stage_name=stage_name).one()
+        client.put(f"/tasks/{task.id}/assign", headers=headers, json={"responsible_user_id": user.id})
+        return task.id
+
+    expected = [assign(1, "Литье", ivanov), assign(3, "Окраска", ivanov), assign(5, "Литье", ivanov)]
+    done = assign(2, "Литье", ivanov)
+    assert client.post(f"/tasks/{done}/complete", headers=auth_headers("ivanov"), json={}).status_code == 200
+    assign(2, "Окраска", petrov)
+
+    with profiling.assert_max_queries(3, engine=database.engine):
+        response = client.get("/tasks/my-queue", headers=auth_headers("ivanov"))
+    assert response.status_code == 200, response.text
+    queue = response.json()
+
+    assert [item["task_id"] for item in queue] == expected
+    casting = queue[0]
+    assert (casting["stage_name"], casting["order_quantity"], casting["product_code"]) == ("Литье", 3, "PUMP")
+    assert casting["materials"] == [{"material_id": material.id, "material_name": "Чугун", "unit": "кг",
+                                     "quantity_required": 6.0, "stock_available": 94.0}]
+    assert queue[1]["materials"] == []  # У окраски норм расхода нет